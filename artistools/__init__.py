@@ -8,17 +8,23 @@ from functools import lru_cache
 import gzip
 import hashlib
 import inspect
+import io
+import json
 import lzma
 import math
 import multiprocessing
 import os.path
 import pickle
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import xattr
-from collections import namedtuple
-from itertools import chain
-from functools import wraps
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from itertools import chain, islice
+from functools import partial, wraps
 # from functools import partial
 import matplotlib.ticker as ticker
 import matplotlib.pyplot as plt
@@ -32,6 +38,12 @@ from astropy import units as u
 from astropy import constants as const
 from PyPDF2 import PdfFileMerger
 
+try:
+    import fcntl
+except ImportError:
+    # advisory file locks are not available on Windows, so concurrent processes may duplicate work there
+    fcntl = None
+
 if sys.version_info < (3,):
     print("Python 2 not supported")
 
@@ -42,6 +54,15 @@ num_processes = max(1, int(multiprocessing.cpu_count() / 2))
 
 enable_diskcache = True
 
+# optional folder for cache files (e.g. on fast local storage) instead of inside each model folder
+diskcache_root = os.environ.get('ARTISTOOLS_CACHE_ROOT')
+
+# used only for models in read-only folders when diskcache_root is not set
+diskcache_root_fallback = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'), 'artistools')
+
+# if a cache file is found only in the model folder, copy it to the diskcache_root folder before loading
+diskcache_preferlocal = os.environ.get('ARTISTOOLS_CACHE_PREFERLOCAL', '1') != '0'
+
 figwidth = 5
 
 commandlist = {
@@ -85,6 +106,147 @@ roman_numerals = ('', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX',
                   'X', 'XI', 'XII', 'XIII', 'XIV', 'XV', 'XVI', 'XVII', 'XVIII', 'XIX', 'XX')
 
 
+def set_dropbox_ignored(folderpath):
+    """Mark a folder to be excluded from Dropbox syncing (if the filesystem supports extended attributes)."""
+    try:
+        xattr.setxattr(folderpath, "com.dropbox.ignored", b'1')
+    except OSError:
+        pass
+
+
+@contextmanager
+def diskcache_lock(lockfilepath, quiet=False):
+    """Hold an exclusive advisory lock on lockfilepath, blocking while another process holds it.
+
+    If locking is not possible (no fcntl or the folder is not writable) then proceed without a lock.
+    """
+    lockfile = None
+    if fcntl is not None:
+        try:
+            lockfile = open(lockfilepath, 'a')
+            try:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not quiet:
+                    print(f"diskcache: Waiting for another process to release '{lockfilepath}'")
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        except OSError:
+            if lockfile is not None:
+                lockfile.close()
+            lockfile = None
+
+    try:
+        yield
+    finally:
+        if lockfile is not None:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+            lockfile.close()
+
+
+def get_diskcache_lockpath(filename):
+    """Return the lock file path for a cache file or folder, in a temporary folder instead of the cache folder."""
+    lockfolder = Path(tempfile.gettempdir(), 'artistools-locks')
+    try:
+        lockfolder.mkdir(exist_ok=True)
+    except OSError:
+        pass
+
+    return Path(lockfolder, f'{hashlib.sha1(str(Path(filename).resolve()).encode("utf-8")).hexdigest()}.lock')
+
+
+def diskcache_save(filename, obj, gzipped):
+    """Pickle obj to a temporary file and then atomically rename it to filename.
+
+    Readers in other processes will see either the previous file or the complete new file, never a partial write.
+    """
+    fd, tmpfilename = tempfile.mkstemp(dir=Path(filename).parent, prefix=f'.{Path(filename).name}.', suffix='.partial')
+    try:
+        with os.fdopen(fd, 'wb') as ftmp:
+            if gzipped:
+                with gzip.GzipFile(fileobj=ftmp, mode='wb') as fgz:
+                    pickle.dump(obj, fgz, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                pickle.dump(obj, ftmp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmpfilename, 0o644)
+        os.replace(tmpfilename, filename)
+    except BaseException:
+        os.unlink(tmpfilename)
+        raise
+
+
+def diskcache_copy(filename_src, filename_dest):
+    """Copy a cache file to a temporary file and then atomically rename it to filename_dest."""
+    fd, tmpfilename = tempfile.mkstemp(
+        dir=Path(filename_dest).parent, prefix=f'.{Path(filename_dest).name}.', suffix='.partial')
+    try:
+        with os.fdopen(fd, 'wb') as ftmp, open(filename_src, 'rb') as fsrc:
+            shutil.copyfileobj(fsrc, ftmp)
+        os.chmod(tmpfilename, 0o644)
+        os.replace(tmpfilename, filename_dest)
+    except BaseException:
+        os.unlink(tmpfilename)
+        raise
+
+
+def get_model_fingerprint(modelpath):
+    """Return a hash identifying a model by its resolved path and the sizes and modification times of its inputs.
+
+    Cached results from a model that has been re-run or modified will then not be reused.
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(str(Path(modelpath).resolve()).encode('utf-8'))
+    for inputfilename in ['input.txt', 'model.txt', 'abundances.txt', 'compositiondata.txt', 'adata.txt']:
+        for suffix in ['.xz', '.gz', '']:
+            inputfilepath = Path(modelpath, inputfilename + suffix)
+            if inputfilepath.is_file():
+                filestat = inputfilepath.stat()
+                fingerprint.update(f'{inputfilename}{suffix} {filestat.st_size} {filestat.st_mtime_ns}'.encode('utf-8'))
+                break
+
+    return fingerprint.hexdigest()
+
+
+def get_diskcache_folders(modelpath):
+    """Return the list of cache folders for a model in order of preference. New cache files are saved to the first.
+
+    With diskcache_root set, results are saved under the root in a folder named by the model identity, so
+    models on read-only or slow network storage can be cached locally and the cache can be shared between users.
+    Otherwise, results are saved inside the model folder (falling back to diskcache_root_fallback if the model
+    folder is not writable).
+    """
+    modelcachefolder = Path(modelpath, '__artistoolscache__.nosync')
+
+    cacheroot = diskcache_root
+    if not cacheroot and not os.access(modelcachefolder if modelcachefolder.is_dir() else modelpath, os.W_OK):
+        cacheroot = diskcache_root_fallback
+
+    if not cacheroot:
+        return [modelcachefolder]
+
+    modelname = Path(modelpath).resolve().name
+    rootcachefolder = Path(cacheroot, f'{modelname}-{get_model_fingerprint(modelpath)[:16]}')
+
+    return [rootcachefolder, modelcachefolder]
+
+
+def get_modelpath_of_args(args, kwargs):
+    """Return the modelpath keyword argument or the folder of the first file/folder specified in the arguments."""
+    if 'modelpath' in kwargs:
+        return kwargs['modelpath']
+
+    for arg in args:
+        if not isinstance(arg, (str, Path)):
+            continue
+
+        if os.path.isdir(arg):
+            return arg
+
+        if os.path.isfile(arg):
+            return Path(arg).parent
+
+    return Path()
+
+
 def diskcache(ignoreargs=[], ignorekwargs=[], saveonly=False, quiet=False, savegzipped=False,
               funcdepends=None, funcversion=None):
     def printopt(*args, **kwargs):
@@ -96,70 +258,99 @@ def diskcache(ignoreargs=[], ignorekwargs=[], saveonly=False, quiet=False, saveg
 
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # save cached files in the folder of the first file/folder specified in the arguments
-            modelpath = Path()
-            if 'modelpath' in kwargs:
-                modelpath = kwargs['modelpath']
-            else:
-                for arg in args:
-                    if os.path.isdir(arg):
-                        modelpath = arg
-                        break
+            # the flag is checked on each call, so the cache can be switched on or off after the decorator is applied
+            if not enable_diskcache:
+                return func(*args, **kwargs)
 
-                    if os.path.isfile(arg):
-                        modelpath = Path(arg).parent
-                        break
+            # save cached files in the folder of the first file/folder specified in the arguments
+            modelpath = get_modelpath_of_args(args, kwargs)
 
-            cachefolder = Path(modelpath, '__artistoolscache__.nosync')
+            cachefolders = get_diskcache_folders(modelpath)
+            cachefolder = cachefolders[0]
 
             if cachefolder.is_dir():
-                xattr.setxattr(cachefolder, "com.dropbox.ignored", b'1')
+                set_dropbox_ignored(cachefolder)
 
             namearghash = hashlib.sha1()
             namearghash.update(func.__module__.encode('utf-8'))
             namearghash.update(func.__qualname__.encode('utf-8'))
 
+            # the same model folder should give the same key whether specified by a relative or absolute path
             namearghash.update(
-                str(tuple(arg for argindex, arg in enumerate(args) if argindex not in ignoreargs)).encode('utf-8'))
+                str(tuple(arg.resolve() if isinstance(arg, Path) else arg
+                          for argindex, arg in enumerate(args) if argindex not in ignoreargs)).encode('utf-8'))
 
-            namearghash.update(str({k: v for k, v in kwargs.items() if k not in ignorekwargs}).encode('utf-8'))
+            namearghash.update(str({k: v.resolve() if isinstance(v, Path) else v
+                                    for k, v in kwargs.items() if k not in ignorekwargs}).encode('utf-8'))
 
             namearghash_strhex = namearghash.hexdigest()
 
-            filename_nogz = Path(cachefolder, f'cached-{func.__module__}.{func.__qualname__}-{namearghash_strhex}.tmp')
-            filename_gz = Path(cachefolder, f'cached-{func.__module__}.{func.__qualname__}-{namearghash_strhex}.tmp.gz')
-
-            execfunc = True
-            saveresult = False
-            functime = -1
+            filename_stem = f'cached-{func.__module__}.{func.__qualname__}-{namearghash_strhex}'
+            filename_nogz = Path(cachefolder, f'{filename_stem}.tmp')
+            filename_gz = Path(cachefolder, f'{filename_stem}.tmp.gz')
+
+            def loadcached():
+                """Return (True, result) if a cached result with a matching version exists, otherwise (False, None)."""
+                if saveonly:
+                    return False, None
+
+                filename = None
+                for folder in cachefolders:
+                    for candidate in [Path(folder, f'{filename_stem}.tmp'), Path(folder, f'{filename_stem}.tmp.gz')]:
+                        if candidate.exists():
+                            filename = candidate
+                            break
+                    if filename is not None:
+                        break
+                else:
+                    return False, None
+
+                if filename.parent != cachefolder and diskcache_preferlocal:
+                    # found in the model folder (e.g. on network storage), so copy it to the local cache first
+                    filename_local = Path(cachefolder, filename.name)
+                    try:
+                        cachefolder.mkdir(parents=True, exist_ok=True)
+                        diskcache_copy(filename, filename_local)
+                        printopt(f"diskcache: Copied '{filename}' to '{filename_local}'")
+                        filename = filename_local
+                    except OSError as ex:
+                        printopt(f"diskcache: Could not copy '{filename}' to local cache (Error: {ex})")
 
-            if (filename_nogz.exists() or filename_gz.exists()) and not saveonly:
                 # found a candidate file, so load it
-                filename = filename_nogz if filename_nogz.exists() else filename_gz
-
-                filesize = Path(filename).stat().st_size / 1024 / 1024
-
                 try:
+                    filesize = Path(filename).stat().st_size / 1024 / 1024
                     printopt(f"diskcache: Loading '{filename}' ({filesize:.1f} MiB)...")
 
                     with zopen(filename, 'rb') as f:
                         result, version_filein = pickle.load(f)
 
                     if version_filein == str_funcversion:
-                        execfunc = False
+                        return True, result
                     elif (not funcversion) and (not version_filein.startswith('funcversion_')):
-                        execfunc = False
+                        return True, result
                     # elif version_filein == sourcehash_strhex:
-                    #     execfunc = False
-                    else:
-                        printopt(f"diskcache: Overwriting '{filename}' (function version mismatch)")
+                    #     return True, result
+
+                    printopt(f"diskcache: Overwriting '{filename}' (function version mismatch)")
 
                 except Exception as ex:
                     # ex = sys.exc_info()[0]
                     printopt(f"diskcache: Overwriting '{filename}' (Error: {ex})")
-                    pass
 
-            if execfunc:
+                return False, None
+
+            functime = -1
+
+            foundcached, result = loadcached()
+
+            # check if we need to replace the gzipped or non-gzipped file with the correct one
+            # if we so, need to save the new file even though functime is unknown since we read
+            # from disk version instead of executing the function
+            if foundcached and not ((savegzipped and filename_nogz.exists()) or
+                                    (not savegzipped and filename_gz.exists())):
+                return result
+
+            if not foundcached:
                 timestart = time.time()
                 result = func(*args, **kwargs)
                 functime = time.time() - timestart
@@ -168,31 +359,34 @@ def diskcache(ignoreargs=[], ignorekwargs=[], saveonly=False, quiet=False, saveg
                 # slow functions are worth saving to disk
                 saveresult = True
             else:
-                # check if we need to replace the gzipped or non-gzipped file with the correct one
-                # if we so, need to save the new file even though functime is unknown since we read
-                # from disk version instead of executing the function
-                if savegzipped and filename_nogz.exists():
-                    saveresult = True
-                elif not savegzipped and filename_gz.exists():
-                    saveresult = True
+                saveresult = ((savegzipped and filename_nogz.exists()) or
+                              (not savegzipped and filename_gz.exists()))
 
             if saveresult:
-                # if the cache folder doesn't exist, create it
-                if not cachefolder.is_dir():
-                    cachefolder.mkdir(parents=True, exist_ok=True)
-                    xattr.setxattr(cachefolder, "com.dropbox.ignored", b'1')
-
-                if filename_nogz.exists():
-                    filename_nogz.unlink()
-                if filename_gz.exists():
-                    filename_gz.unlink()
-
-                fopen, filename = (gzip.open, filename_gz) if savegzipped else (open, filename_nogz)
-                with fopen(filename, 'wb') as f:
-                    pickle.dump((result, str_funcversion), f, protocol=pickle.HIGHEST_PROTOCOL)
-
-                filesize = Path(filename).stat().st_size / 1024 / 1024
-                printopt(f"diskcache: Saved '{filename}' ({filesize:.1f} MiB, functime {functime:.1f}s)")
+                filename = filename_gz if savegzipped else filename_nogz
+                try:
+                    # if the cache folder doesn't exist, create it
+                    if not cachefolder.is_dir():
+                        cachefolder.mkdir(parents=True, exist_ok=True)
+                        set_dropbox_ignored(cachefolder)
+
+                    # only one process at a time writes a given cache file. Another process might have saved the
+                    # same result while this one was running the function, so check again while holding the lock
+                    with diskcache_lock(get_diskcache_lockpath(filename), quiet=quiet):
+                        if filename.exists():
+                            printopt(f"diskcache: Not saving '{filename}' (saved by another process)")
+                        else:
+                            diskcache_save(filename, (result, str_funcversion), gzipped=savegzipped)
+
+                            # remove the other (gzipped or non-gzipped) version so that it can't be loaded instead
+                            filename_other = filename_nogz if savegzipped else filename_gz
+                            if filename_other.exists():
+                                filename_other.unlink()
+
+                            filesize = Path(filename).stat().st_size / 1024 / 1024
+                            printopt(f"diskcache: Saved '{filename}' ({filesize:.1f} MiB, functime {functime:.1f}s)")
+                except OSError as ex:
+                    printopt(f"diskcache: Could not save '{filename}' (Error: {ex})")
 
             return result
 
@@ -208,11 +402,238 @@ def diskcache(ignoreargs=[], ignorekwargs=[], saveonly=False, quiet=False, saveg
         # sourcehash_strhex = sourcehash.hexdigest()
         str_funcversion = f'funcversion_{funcversion}' if funcversion else f'funcversion_none'
 
-        return wrapper if enable_diskcache else func
+        return wrapper
 
     return diskcacheinner
 
 
+# increment this when the array layout of a converted file changes to force the array caches to be rebuilt
+arraycache_formatversion = 2
+
+# loaded (memory-mapped) arrays for each (cache folder, source stamp)
+arraycache_loaded = {}
+
+
+def get_arraycache_stamp(sourcefilepath):
+    """Return a dict that will change if the source file is replaced or modified."""
+    filestat = Path(sourcefilepath).stat()
+    return {'cacheformatversion': arraycache_formatversion, 'sourcefile': Path(sourcefilepath).name,
+            'size': filestat.st_size, 'mtime_ns': filestat.st_mtime_ns}
+
+
+def read_arraycache(cachefolder, stamp):
+    """Return a dict of memory-mapped arrays if cachefolder contains a complete cache matching stamp, else None."""
+    try:
+        with open(Path(cachefolder, 'meta.json'), 'r') as fmeta:
+            meta = json.load(fmeta)
+    except (OSError, ValueError):
+        return None
+
+    if meta['stamp'] != stamp:
+        return None
+
+    def loadarray(name):
+        filepath = Path(cachefolder, f'{name}.npy')
+        try:
+            return np.load(filepath, mmap_mode='r')
+        except ValueError:
+            # empty arrays can't be memory-mapped
+            return np.load(filepath)
+
+    return {name: loadarray(name) for name in meta['arrays']}
+
+
+def write_arraycache(cachefolder, arrays, stamp):
+    """Write the arrays into a temporary folder and then rename it to cachefolder, replacing any old version."""
+    tmpfolder = Path(tempfile.mkdtemp(dir=Path(cachefolder).parent, prefix=f'.{Path(cachefolder).name}.'))
+    try:
+        for name, arr in arrays.items():
+            np.save(Path(tmpfolder, f'{name}.npy'), arr, allow_pickle=False)
+
+        # meta.json is written last because it marks the cache as complete
+        with open(Path(tmpfolder, 'meta.json'), 'w') as fmeta:
+            json.dump({'stamp': stamp, 'arrays': list(arrays.keys())}, fmeta)
+
+        os.chmod(tmpfolder, 0o755)
+        if Path(cachefolder).exists():
+            shutil.rmtree(cachefolder)
+        os.replace(tmpfolder, cachefolder)
+    except BaseException:
+        shutil.rmtree(tmpfolder, ignore_errors=True)
+        raise
+
+
+def get_cached_arrays(cachefolder, sourcefilepath, convertfunc):
+    """Return a dict of memory-mapped arrays from cachefolder, calling convertfunc(sourcefilepath) if it is stale."""
+    stamp = get_arraycache_stamp(sourcefilepath)
+    cachefolder = Path(cachefolder)
+
+    loadedkey = (str(cachefolder.resolve()), json.dumps(stamp, sort_keys=True))
+    if loadedkey in arraycache_loaded:
+        return arraycache_loaded[loadedkey]
+
+    arrays = read_arraycache(cachefolder, stamp)
+    if arrays is None:
+        cachefolder.parent.mkdir(parents=True, exist_ok=True)
+
+        # another process might be converting the same file, so wait for it and then check again
+        with diskcache_lock(get_diskcache_lockpath(cachefolder)):
+            arrays = read_arraycache(cachefolder, stamp)
+            if arrays is None:
+                print(f'Converting {sourcefilepath} to binary cache {cachefolder}')
+                write_arraycache(cachefolder, convertfunc(sourcefilepath), stamp)
+                arrays = read_arraycache(cachefolder, stamp)
+
+    arraycache_loaded[loadedkey] = arrays
+    return arrays
+
+
+def get_approx_size(obj, maxsamples=32, depth=0):
+    """Return the approximate memory size in bytes of obj, including the contents of containers and DataFrames.
+
+    For large containers, only a sample of the elements is measured and the total is extrapolated.
+    """
+    if depth > 6:
+        return sys.getsizeof(obj)
+
+    def extrapolated_size(samples, count):
+        if len(samples) == 0:
+            return 0
+        return int(sum(get_approx_size(x, maxsamples, depth + 1) for x in samples) / len(samples) * count)
+
+    def sequence_size(seq):
+        return extrapolated_size(seq[::max(1, len(seq) // maxsamples)], len(seq))
+
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            return obj.nbytes + sequence_size(obj.ravel())
+        return obj.nbytes
+
+    if isinstance(obj, pd.DataFrame):
+        size = int(obj.memory_usage(index=True, deep=False).sum())
+        for _, column in obj.items():
+            if column.dtype == object:
+                size += sequence_size(column.values)
+        return size
+
+    if isinstance(obj, pd.Series):
+        size = int(obj.memory_usage(index=True, deep=False))
+        if obj.dtype == object:
+            size += sequence_size(obj.values)
+        return size
+
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sequence_size(obj)
+
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + extrapolated_size(list(islice(obj.items(), maxsamples)), len(obj))
+
+    if isinstance(obj, (set, frozenset)):
+        return sys.getsizeof(obj) + extrapolated_size(list(islice(obj, maxsamples)), len(obj))
+
+    if hasattr(obj, '__dict__') and not isinstance(obj, type):
+        return sys.getsizeof(obj) + get_approx_size(vars(obj), maxsamples, depth + 1)
+
+    return sys.getsizeof(obj)
+
+
+class MemoryCache:
+    """In-process cache of function results with least-recently-used eviction by a total memory budget.
+
+    Unlike lru_cache with a fixed number of entries, the approximate size of each result is counted, so that
+    a few very large results can't exhaust the available memory.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()  # key -> (result, size in bytes, resolved modelpath)
+        self._lock = threading.RLock()
+        self.currbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (True, result) if key is in the cache, otherwise (False, None)."""
+        with self._lock:
+            try:
+                result = self._entries[key][0]
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, result
+
+    def put(self, key, result, modelpath=None):
+        size = get_approx_size(result)
+        if size > self.budget_bytes:
+            # not worth evicting everything else to hold one result
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.currbytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (result, size, str(Path(modelpath).resolve()) if modelpath is not None else None)
+            self.currbytes += size
+
+            while self.currbytes > self.budget_bytes and len(self._entries) > 1:
+                _, (_, evictsize, _) = self._entries.popitem(last=False)
+                self.currbytes -= evictsize
+                self.evictions += 1
+
+    def clear(self, modelpath=None, funcname=None):
+        """Remove entries, optionally only those for a model and/or a function (module.qualname)."""
+        strmodelpath = str(Path(modelpath).resolve()) if modelpath is not None else None
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if strmodelpath is not None and self._entries[key][2] != strmodelpath:
+                    continue
+                if funcname is not None and key[0] != funcname:
+                    continue
+
+                self.currbytes -= self._entries.pop(key)[1]
+
+    def info(self):
+        """Return a dict with the hit, miss, and eviction counts and current size of the cache."""
+        with self._lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'currbytes': self.currbytes, 'budget_bytes': self.budget_bytes}
+
+
+memorycache = MemoryCache(budget_bytes=int(float(os.environ.get('ARTISTOOLS_MEMCACHE_MB', 4096)) * 1024 * 1024))
+
+
+def memcache(func):
+    """Cache function results in the shared memorycache (a replacement for lru_cache on functions with large results).
+
+    Calls with unhashable arguments are not cached.
+    """
+    funcname = f'{func.__module__}.{func.__qualname__}'
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (funcname, args, tuple(sorted(kwargs.items())))
+        try:
+            found, result = memorycache.get(key)
+        except TypeError:
+            # unhashable argument
+            return func(*args, **kwargs)
+
+        if not found:
+            result = func(*args, **kwargs)
+            memorycache.put(key, result, modelpath=get_modelpath_of_args(args, kwargs))
+
+        return result
+
+    wrapper.cache_clear = partial(memorycache.clear, funcname=funcname)
+
+    return wrapper
+
+
 class AppendPath(argparse.Action):
     def __call__(self, parser, args, values, option_string=None):
         # if getattr(args, self.dest) is None:
@@ -345,7 +766,7 @@ def get_composition_data_from_outputfile(modelpath):
     return composition_df
 
 
-@lru_cache(maxsize=8)
+@memcache
 def get_modeldata(filename):
     """Return a list containing named tuples for all model grid cells."""
     if os.path.isdir(filename):
@@ -508,7 +929,7 @@ def save_modeldata(dfmodeldata, t_model_init_days, filename):
             fmodel.write('\n')
 
 
-@lru_cache(maxsize=8)
+@memcache
 def get_initialabundances(modelpath):
     """Return a list of mass fractions."""
     abundancefilepath = firstexisting(['abundances.txt.xz', 'abundances.txt.gz', 'abundances.txt'], path=modelpath)
@@ -528,9 +949,9 @@ def save_initialabundances(dfabundances, abundancefilename):
 @lru_cache(maxsize=16)
 def get_nu_grid(modelpath):
     """Get an array of frequencies at which the ARTIS spectra are binned by exspec."""
-    specfilename = firstexisting(['spec.out.gz', 'spec.out', 'specpol.out'], path=modelpath)
-    specdata = pd.read_csv(specfilename, delim_whitespace=True)
-    return specdata.loc[:, '0'].values
+    import artistools.speccube
+    speccube = artistools.speccube.get_model_speccube(modelpath, ['spec.out.gz', 'spec.out', 'specpol.out'])
+    return speccube.get_nu()
 
 
 def get_deposition(modelpath):
@@ -551,9 +972,9 @@ def get_deposition(modelpath):
 def get_timestep_times(modelpath):
     """Return a list of the mid time in days of each timestep from a spec.out file."""
     try:
-        specfilename = firstexisting(['spec.out.gz', 'spec.out', 'specpol.out'], path=modelpath)
-        time_columns = pd.read_csv(specfilename, delim_whitespace=True, nrows=0)
-        return time_columns.columns[1:]
+        import artistools.speccube
+        speccube = artistools.speccube.get_model_speccube(modelpath, ['spec.out.gz', 'spec.out', 'specpol.out'])
+        return pd.Index(speccube.get_timecolumns())
     except FileNotFoundError:
         return [f'{tdays:.3f}' for tdays in get_timestep_times_float(modelpath, loc='mid')]
 
@@ -699,6 +1120,11 @@ def get_timestep_time(modelpath, timestep):
     return -1
 
 
+def skiplines(fin, count):
+    """Advance the file iterator fin by count lines."""
+    next(islice(fin, count, count), None)
+
+
 def parse_adata(fadata, phixsdict, ionlist):
     """Generate ions and their level lists from adata.txt."""
     firstlevelnumber = 1
@@ -714,26 +1140,32 @@ def parse_adata(fadata, phixsdict, ionlist):
         ionisation_energy_ev = float(ionheader[3])
 
         if not ionlist or (Z, ionstage) in ionlist:
-            level_list = []
-            for levelindex in range(level_count):
-                row = fadata.readline().split()
-
-                levelname = row[4].strip('\'')
-                numberin = int(row[0])
-                assert levelindex == numberin - firstlevelnumber
-                phixstargetlist, phixstable = phixsdict.get((Z, ionstage, numberin), ([], []))
+            # read the ion's levels as one block and convert each column at once
+            levelrows = [row.split(maxsplit=5)[:5] for row in islice(fadata, level_count)]
+            numberin, energy_ev, g, transition_count, levelnames = (
+                zip(*levelrows) if levelrows else ((), (), (), (), ()))
 
-                level_list.append((float(row[1]), float(row[2]), int(row[3]), levelname, phixstargetlist, phixstable))
+            assert np.array_equal(np.array(numberin, dtype=np.int64) - firstlevelnumber, np.arange(level_count))
 
-            dflevels = pd.DataFrame(level_list,
-                                    columns=['energy_ev', 'g', 'transition_count',
-                                             'levelname', 'phixstargetlist', 'phixstable'])
+            phixstargetlists = np.empty(level_count, dtype=object)
+            phixstables = np.empty(level_count, dtype=object)
+            for levelindex in range(level_count):
+                phixstargetlists[levelindex], phixstables[levelindex] = phixsdict.get(
+                    (Z, ionstage, levelindex), ([], []))
+
+            dflevels = pd.DataFrame({
+                'energy_ev': np.array(energy_ev, dtype=np.float64),
+                'g': np.array(g, dtype=np.float64),
+                'transition_count': np.array(transition_count, dtype=np.int64),
+                'levelname': [levelname.strip('\'') for levelname in levelnames],
+                'phixstargetlist': phixstargetlists,
+                'phixstable': phixstables,
+            })
 
             yield Z, ionstage, level_count, ionisation_energy_ev, dflevels
 
         else:
-            for _ in range(level_count):
-                fadata.readline()
+            skiplines(fadata, level_count)
 
 
 def parse_transitiondata(ftransitions, ionlist):
@@ -749,17 +1181,21 @@ def parse_transitiondata(ftransitions, ionlist):
         transition_count = int(ionheader[2])
 
         if not ionlist or (Z, ionstage) in ionlist:
-            translist = []
-            for _ in range(transition_count):
-                row = ftransitions.readline().split()
-                translist.append(
-                    (int(row[0]) - firstlevelnumber, int(row[1]) - firstlevelnumber,
-                     float(row[2]), float(row[3]), int(row[4]) == 1))
-
-            yield Z, ionstage, pd.DataFrame(translist, columns=['lower', 'upper', 'A', 'collstr', 'forbidden'])
+            # read the ion's transitions as one block and parse the first five columns of all rows at once
+            # (some rows have extra columns)
+            translines = list(islice(ftransitions, transition_count))
+            arrtrans = (np.loadtxt(translines, usecols=range(5), ndmin=2) if translines
+                        else np.empty((0, 5), dtype=np.float64))
+
+            yield Z, ionstage, pd.DataFrame({
+                'lower': arrtrans[:, 0].astype(np.int64) - firstlevelnumber,
+                'upper': arrtrans[:, 1].astype(np.int64) - firstlevelnumber,
+                'A': arrtrans[:, 2],
+                'collstr': arrtrans[:, 3],
+                'forbidden': arrtrans[:, 4] == 1,
+            })
         else:
-            for _ in range(transition_count):
-                ftransitions.readline()
+            skiplines(ftransitions, transition_count)
 
 
 def parse_phixsdata(fphixs, ionlist):
@@ -805,9 +1241,19 @@ def parse_phixsdata(fphixs, ionlist):
                 fphixs.readline()
 
 
-@lru_cache(maxsize=8)
+@memcache
 def get_levels(modelpath, ionlist=None, get_transitions=False, get_photoionisations=False):
     """Return a list of lists of levels."""
+    if enable_diskcache:
+        # read from the binary cache (converting the text files the first time)
+        import artistools.atomicdata
+        try:
+            return artistools.atomicdata.get_levels(
+                Path(modelpath), ionlist=ionlist, get_transitions=get_transitions,
+                get_photoionisations=get_photoionisations)
+        except OSError as ex:
+            print(f'Could not use the binary atomic data cache (Error: {ex}). Reading text files instead')
+
     adatafilename = Path(modelpath, 'adata.txt')
 
     transitionsdict = {}
@@ -1050,7 +1496,7 @@ def join_pdf_files(pdf_list, modelpath_list):
     print(f'Files merged and saved to {resultfilename}.pdf')
 
 
-@lru_cache(maxsize=2)
+@memcache
 def get_bflist(modelpath, returntype='dict'):
     compositiondata = get_composition_data(modelpath)
     bflist = {}
@@ -1071,40 +1517,151 @@ def get_bflist(modelpath, returntype='dict'):
     return bflist
 
 
-@lru_cache(maxsize=16)
+def parse_linestat(flinestat):
+    """Return a dict of arrays with the wavelength, element, ion, and upper and lower levels of each line."""
+    linestat = {'lambda_angstroms': np.fromstring(flinestat.readline(), sep=' ') * 1e+8}
+    nlines = len(linestat['lambda_angstroms'])
+
+    for column in ['atomic_number', 'ionstage', 'upperlevelindex', 'lowerlevelindex']:
+        linestat[column] = np.fromstring(flinestat.readline(), dtype=np.int32, sep=' ')
+        assert len(linestat[column]) == nlines
+
+    # the file adds one to the levelindex, i.e. lowest level is 1
+    linestat['upperlevelindex'] -= 1
+    linestat['lowerlevelindex'] -= 1
+
+    return linestat
+
+
+class LineList:
+    """Line list with one array per column, indexed by the line index used for packet emission/absorption types.
+
+    Indexing with a single line index returns a namedtuple like the values of get_linelist(returntype='dict').
+    Wavelength range and closest-line searches use binary search on lines sorted by wavelength, either over all
+    lines or within the partition of lines belonging to one ion.
+    """
+
+    columns = ('lambda_angstroms', 'atomic_number', 'ionstage', 'upperlevelindex', 'lowerlevelindex')
+    linetuple = namedtuple('line', columns)
+
+    def __init__(self, arrays):
+        for column in self.columns:
+            setattr(self, column, arrays[column])
+
+        if 'lambdasortindex' in arrays:
+            self.lambdasortindex = arrays['lambdasortindex']
+        else:
+            self.lambdasortindex = np.argsort(self.lambda_angstroms, kind='stable')
+        self.lambda_sorted = self.lambda_angstroms[self.lambdasortindex]
+
+        # lines sorted by (Z, ion_stage, lambda), with the sorted positions of each ion stored in ionpartitions
+        if 'ionsortindex' in arrays:
+            self.ionsortindex = arrays['ionsortindex']
+        else:
+            self.ionsortindex = np.lexsort((self.lambda_angstroms, self.ionstage, self.atomic_number))
+        self.lambda_ionsorted = self.lambda_angstroms[self.ionsortindex]
+        self.ionpartitions = {}
+
+        ionsorted_Z = self.atomic_number[self.ionsortindex]
+        ionsorted_ionstage = self.ionstage[self.ionsortindex]
+        partitionstarts = np.flatnonzero(
+            np.diff(ionsorted_Z, prepend=-1) | np.diff(ionsorted_ionstage, prepend=-1))
+        partitionends = np.append(partitionstarts[1:], len(self.ionsortindex))
+        for start, end in zip(partitionstarts, partitionends):
+            self.ionpartitions[(int(ionsorted_Z[start]), int(ionsorted_ionstage[start]))] = (int(start), int(end))
+
+    def __len__(self):
+        return len(self.lambda_angstroms)
+
+    def __contains__(self, index):
+        return 0 <= index < len(self)
+
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        index = int(index)
+        return self.linetuple(
+            float(self.lambda_angstroms[index]), int(self.atomic_number[index]), int(self.ionstage[index]),
+            int(self.upperlevelindex[index]), int(self.lowerlevelindex[index]))
+
+    def get_lines(self, indices):
+        """Return a DataFrame of the lines with the given line indices (in the given order)."""
+        indices = np.asarray(indices, dtype=np.int64)
+        dflines = pd.DataFrame({column: getattr(self, column)[indices] for column in self.columns}, index=indices)
+        dflines.index.name = 'linelistindex'
+        return dflines
+
+    def get_sorted(self, atomic_number=None, ion_stage=None):
+        """Return the sorted wavelengths and matching line indices of all lines, or the lines of one ion."""
+        if atomic_number is None:
+            return self.lambda_sorted, self.lambdasortindex
+
+        start, end = self.ionpartitions.get((atomic_number, ion_stage), (0, 0))
+        return self.lambda_ionsorted[start:end], self.ionsortindex[start:end]
+
+    def get_lambdarange_indices(self, lambdamin, lambdamax, atomic_number=None, ion_stage=None):
+        """Return the indices of lines with lambdamin <= lambda_angstroms <= lambdamax, sorted by wavelength.
+
+        If atomic_number and ion_stage are given, only lines of that ion are returned.
+        """
+        lambda_sorted, sortindex = self.get_sorted(atomic_number, ion_stage)
+        sortedstart = np.searchsorted(lambda_sorted, lambdamin, side='left')
+        sortedend = np.searchsorted(lambda_sorted, lambdamax, side='right')
+        return sortindex[sortedstart:sortedend]
+
+    def get_closest_indices(self, lambdas, atomic_number=None, ion_stage=None):
+        """Return an array with the index of the closest line to each of the wavelengths lambdas [Angstroms].
+
+        If atomic_number and ion_stage are given, only lines of that ion are searched. The index is -1 if there
+        are no lines to search.
+        """
+        lambdas = np.atleast_1d(np.asarray(lambdas, dtype=np.float64))
+        lambda_sorted, sortindex = self.get_sorted(atomic_number, ion_stage)
+        if len(lambda_sorted) == 0:
+            return np.full(len(lambdas), -1, dtype=np.int64)
+
+        sortedpos = np.searchsorted(lambda_sorted, lambdas)
+        left = np.clip(sortedpos - 1, 0, len(lambda_sorted) - 1)
+        right = np.clip(sortedpos, 0, len(lambda_sorted) - 1)
+        useright = np.abs(lambda_sorted[right] - lambdas) < np.abs(lambda_sorted[left] - lambdas)
+
+        return sortindex[np.where(useright, right, left)]
+
+    def to_dataframe(self):
+        return self.get_lines(np.arange(len(self)))
+
+
+@memcache
 def get_linelist(modelpath, returntype='dict'):
-    """Load linestat.out containing transitions wavelength, element, ion, upper and lower levels."""
-    with zopen(Path(modelpath, 'linestat.out'), 'rt') as linestatfile:
-        lambda_angstroms = [float(wl) * 1e+8 for wl in linestatfile.readline().split()]
-        nlines = len(lambda_angstroms)
-
-        atomic_numbers = [int(z) for z in linestatfile.readline().split()]
-        assert len(atomic_numbers) == nlines
-        ion_stages = [int(ion_stage) for ion_stage in linestatfile.readline().split()]
-        assert len(ion_stages) == nlines
-
-        # the file adds one to the levelindex, i.e. lowest level is 1
-        upper_levels = [int(levelplusone) - 1 for levelplusone in linestatfile.readline().split()]
-        assert len(upper_levels) == nlines
-        lower_levels = [int(levelplusone) - 1 for levelplusone in linestatfile.readline().split()]
-        assert len(lower_levels) == nlines
-
-    if returntype == 'dict':
-        linetuple = namedtuple('line', 'lambda_angstroms atomic_number ionstage upperlevelindex lowerlevelindex')
+    """Load linestat.out containing transitions wavelength, element, ion, upper and lower levels.
+
+    returntype 'array' gives a LineList of numpy arrays, which is much faster and smaller than the 'dict' of
+    namedtuples or the 'dataframe' for the standard line list of about 1.5 million lines.
+    """
+    linestat = None
+    if enable_diskcache:
+        import artistools.atomicdata
+        try:
+            linestat = artistools.atomicdata.get_part(Path(modelpath), 'linestat')
+        except OSError as ex:
+            print(f'Could not use the binary line list cache (Error: {ex}). Reading text file instead')
+
+    if linestat is None:
+        with zopen(Path(modelpath, 'linestat.out'), 'rt') as linestatfile:
+            linestat = parse_linestat(linestatfile)
+
+    if returntype == 'array':
+        return LineList(linestat)
+    elif returntype == 'dict':
+        linetuple = LineList.linetuple
         linelistdict = {
-            index: linetuple(lambda_a, Z, ionstage, upper, lower) for index, lambda_a, Z, ionstage, upper, lower
-            in zip(range(nlines), lambda_angstroms, atomic_numbers, ion_stages, upper_levels, lower_levels)}
+            index: linetuple(*line) for index, line
+            in enumerate(zip(*[linestat[column].tolist() for column in LineList.columns]))}
         return linelistdict
     elif returntype == 'dataframe':
         # considering our standard lineline is about 1.5 million lines,
         # using a dataframe make the lookup process very slow
-        dflinelist = pd.DataFrame({
-            'lambda_angstroms': lambda_angstroms,
-            'atomic_number': atomic_numbers,
-            'ionstage': ion_stages,
-            'upperlevelindex': upper_levels,
-            'lowerlevelindex': lower_levels,
-        })
+        dflinelist = pd.DataFrame({column: np.array(linestat[column]) for column in LineList.columns})
         dflinelist.index.name = 'linelistindex'
 
         return dflinelist
@@ -1262,6 +1819,58 @@ def get_mpirankofcell(modelgridindex, modelpath):
     return mpirank
 
 
+def get_timestep_cell_selection(timestep, modelgridindex):
+    """Return lists of selected timesteps and cells from a value or a list of values, with None for -1 (all)."""
+    timesteps = None if np.ndim(timestep) == 0 and timestep < 0 else np.atleast_1d(timestep).tolist()
+    modelgridindices = (
+        None if np.ndim(modelgridindex) == 0 and modelgridindex < 0 else np.atleast_1d(modelgridindex).tolist())
+
+    return timesteps, modelgridindices
+
+
+def read_rankfile_filtered(filepath, timesteps=None, modelgridindices=None, **readcsvkwargs):
+    """Read a per-rank output file that starts with timestep and modelgridindex columns (e.g., radfield_0000.out).
+
+    Rows of other timesteps and cells are skipped before their values are parsed. None selects all of them.
+    """
+    if timesteps is None and modelgridindices is None:
+        return pd.read_csv(filepath, delim_whitespace=True, **readcsvkwargs)
+
+    strtimesteps = None if timesteps is None else {str(int(ts)) for ts in timesteps}
+    strmodelgridindices = None if modelgridindices is None else {str(int(mgi)) for mgi in modelgridindices}
+
+    with zopen(filepath, 'rt') as fin:
+        selectedlines = [fin.readline()]
+        for line in fin:
+            rowstart = line.split(maxsplit=2)
+            if (len(rowstart) > 1 and (strtimesteps is None or rowstart[0] in strtimesteps) and
+                    (strmodelgridindices is None or rowstart[1] in strmodelgridindices)):
+                selectedlines.append(line)
+
+    return pd.read_csv(io.StringIO(''.join(selectedlines)), delim_whitespace=True, **readcsvkwargs)
+
+
+def read_rankfiles(filepaths, timesteps=None, modelgridindices=None, **readcsvkwargs):
+    """Read and concatenate per-rank output files in parallel, keeping only the selected timesteps and cells."""
+    readfile = partial(read_rankfile_filtered, timesteps=timesteps, modelgridindices=modelgridindices,
+                       **readcsvkwargs)
+
+    if num_processes > 1 and len(filepaths) > 1:
+        with multiprocessing.Pool(processes=num_processes) as pool:
+            dfs = pool.map(readfile, filepaths)
+            pool.close()
+            pool.join()
+            pool.terminate()
+    else:
+        dfs = [readfile(filepath) for filepath in filepaths]
+
+    dfs = [df for df in dfs if not df.empty]
+    if not dfs:
+        return pd.DataFrame()
+
+    return pd.concat(dfs, ignore_index=True)
+
+
 def get_artisoptions(modelpath=None, srcpath=None, printdefs=False):
     # get artis options specifed in artistoptions.h preprocessor macro definitions
     if not srcpath:
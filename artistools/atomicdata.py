@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""Binary cache of the ARTIS atomic data files adata.txt, transitiondata.txt, phixsdata_v2.txt, and linestat.out.
+
+Each text file is converted once into flat arrays of levels, transitions, or photoionisation cross sections
+with per-ion offset tables. The arrays are saved by artistools.get_cached_arrays() as .npy files in the cache folder
+and memory-mapped when loaded, so any subset of ions can be read quickly and the pages are shared between worker
+processes.
+"""
+
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import artistools as at
+
+sourcefilenames = {
+    'adata': 'adata.txt',
+    'transitions': 'transitiondata.txt',
+    'phixs': 'phixsdata_v2.txt',
+    'linestat': 'linestat.out',
+}
+
+
+def get_sourcefilepath(modelpath, part):
+    filename = sourcefilenames[part]
+    return at.firstexisting([filename + '.xz', filename + '.gz', filename], path=modelpath)
+
+
+def convert_adata(sourcefilepath):
+    """Return a dict of flat arrays with all levels in adata.txt and an ion table with offsets into the level arrays."""
+    ion_Z, ion_stage, ion_levelcount, ion_pot, ion_leveloffset = [], [], [], [], []
+    level_arrays = []
+
+    with at.zopen(sourcefilepath, 'rt') as fadata:
+        leveloffset = 0
+        for Z, ionstage, level_count, ionisation_energy_ev, dflevels in at.parse_adata(fadata, {}, None):
+            ion_Z.append(Z)
+            ion_stage.append(ionstage)
+            ion_levelcount.append(level_count)
+            ion_pot.append(ionisation_energy_ev)
+            ion_leveloffset.append(leveloffset)
+            leveloffset += level_count
+            level_arrays.append(dflevels[['energy_ev', 'g', 'transition_count', 'levelname']])
+
+    dflevels_all = pd.concat(level_arrays, ignore_index=True) if level_arrays else pd.DataFrame(
+        {'energy_ev': [], 'g': [], 'transition_count': [], 'levelname': []})
+
+    return {
+        'ion_Z': np.array(ion_Z, dtype=np.int32),
+        'ion_stage': np.array(ion_stage, dtype=np.int32),
+        'ion_levelcount': np.array(ion_levelcount, dtype=np.int64),
+        'ion_pot': np.array(ion_pot, dtype=np.float64),
+        'ion_leveloffset': np.array(ion_leveloffset, dtype=np.int64),
+        'level_energy_ev': dflevels_all['energy_ev'].values.astype(np.float64),
+        'level_g': dflevels_all['g'].values.astype(np.float64),
+        'level_transitioncount': dflevels_all['transition_count'].values.astype(np.int32),
+        'level_name': np.array([name.encode('utf-8') for name in dflevels_all['levelname']], dtype=np.bytes_),
+    }
+
+
+def convert_transitiondata(sourcefilepath):
+    """Return a dict of flat arrays with all transitions and an ion table with offsets into the transition arrays."""
+    ion_Z, ion_stage, ion_transitioncount, ion_transitionoffset = [], [], [], []
+    trans_arrays = []
+
+    with at.zopen(sourcefilepath, 'rt') as ftransitions:
+        transitionoffset = 0
+        for Z, ionstage, dftransitions in at.parse_transitiondata(ftransitions, None):
+            ion_Z.append(Z)
+            ion_stage.append(ionstage)
+            ion_transitioncount.append(len(dftransitions))
+            ion_transitionoffset.append(transitionoffset)
+            transitionoffset += len(dftransitions)
+            trans_arrays.append(dftransitions)
+
+    dftransitions_all = pd.concat(trans_arrays, ignore_index=True) if trans_arrays else pd.DataFrame(
+        {'lower': [], 'upper': [], 'A': [], 'collstr': [], 'forbidden': []})
+
+    return {
+        'ion_Z': np.array(ion_Z, dtype=np.int32),
+        'ion_stage': np.array(ion_stage, dtype=np.int32),
+        'ion_transitioncount': np.array(ion_transitioncount, dtype=np.int64),
+        'ion_transitionoffset': np.array(ion_transitionoffset, dtype=np.int64),
+        'trans_lower': dftransitions_all['lower'].values.astype(np.int32),
+        'trans_upper': dftransitions_all['upper'].values.astype(np.int32),
+        'trans_A': dftransitions_all['A'].values.astype(np.float64),
+        'trans_collstr': dftransitions_all['collstr'].values.astype(np.float64),
+        'trans_forbidden': dftransitions_all['forbidden'].values.astype(bool),
+    }
+
+
+def convert_phixsdata(sourcefilepath):
+    """Return a dict with one matrix of cross sections (row per lower level) and flat arrays of target levels."""
+    phixs_Z, phixs_lowerionstage, phixs_lowerlevel, phixs_targetoffset = [], [], [], []
+    target_level, target_fraction = [], []
+    sigmarows = []
+    xgrid = np.array([])
+
+    with at.zopen(sourcefilepath, 'rt') as fphixs:
+        for (Z, upperionstage, upperionlevel, lowerionstage,
+             lowerionlevel, phixstargetlist, phixstable) in at.parse_phixsdata(fphixs, None):
+            phixs_Z.append(Z)
+            phixs_lowerionstage.append(lowerionstage)
+            phixs_lowerlevel.append(lowerionlevel)
+            phixs_targetoffset.append(len(target_level))
+            for level, fraction in phixstargetlist:
+                target_level.append(level)
+                target_fraction.append(fraction)
+            xgrid = phixstable[:, 0]
+            sigmarows.append(phixstable[:, 1])
+
+    phixs_targetoffset.append(len(target_level))
+
+    return {
+        'xgrid': np.array(xgrid, dtype=np.float64),
+        'phixs_Z': np.array(phixs_Z, dtype=np.int32),
+        'phixs_lowerionstage': np.array(phixs_lowerionstage, dtype=np.int32),
+        'phixs_lowerlevel': np.array(phixs_lowerlevel, dtype=np.int32),
+        'phixs_sigma': np.array(sigmarows, dtype=np.float64).reshape(len(sigmarows), len(xgrid)),
+        'phixs_targetoffset': np.array(phixs_targetoffset, dtype=np.int64),
+        'target_level': np.array(target_level, dtype=np.int32),
+        'target_fraction': np.array(target_fraction, dtype=np.float64),
+    }
+
+
+def convert_linestat(sourcefilepath):
+    """Return a dict with the line list columns and the line indices sorted by wavelength and by ion and wavelength."""
+    with at.zopen(sourcefilepath, 'rt') as flinestat:
+        linestat = at.parse_linestat(flinestat)
+
+    linestat['lambdasortindex'] = np.argsort(linestat['lambda_angstroms'], kind='stable')
+    linestat['ionsortindex'] = np.lexsort(
+        (linestat['lambda_angstroms'], linestat['ionstage'], linestat['atomic_number']))
+
+    return linestat
+
+
+convertfuncs = {
+    'adata': convert_adata,
+    'transitions': convert_transitiondata,
+    'phixs': convert_phixsdata,
+    'linestat': convert_linestat,
+}
+
+
+def get_part(modelpath, part):
+    """Return a dict of (memory-mapped) arrays for an atomic data file, converting the text file if needed."""
+    sourcefilepath = get_sourcefilepath(modelpath, part)
+    cachefolder = Path(at.get_diskcache_folders(modelpath)[0], f'atomicdata-{part}')
+
+    return at.get_cached_arrays(cachefolder, sourcefilepath, convertfuncs[part])
+
+
+def get_ionindices(ion_Z, ion_stage, ionlist):
+    """Return the indices into the ion table of ions in ionlist (or all ions if ionlist is empty)."""
+    if not ionlist:
+        return list(range(len(ion_Z)))
+
+    return [ionindex for ionindex, (Z, ionstage) in enumerate(zip(ion_Z, ion_stage)) if (Z, ionstage) in ionlist]
+
+
+def get_levels(modelpath, ionlist=None, get_transitions=False, get_photoionisations=False):
+    """Return the same DataFrame as artistools.get_levels(), but read from the binary cache."""
+    adata = get_part(modelpath, 'adata')
+
+    transitionsdict = {}
+    if get_transitions:
+        transdata = get_part(modelpath, 'transitions')
+        for ionindex in get_ionindices(transdata['ion_Z'], transdata['ion_stage'], ionlist):
+            start = transdata['ion_transitionoffset'][ionindex]
+            end = start + transdata['ion_transitioncount'][ionindex]
+            transitionsdict[(int(transdata['ion_Z'][ionindex]), int(transdata['ion_stage'][ionindex]))] = (
+                pd.DataFrame({
+                    'lower': np.array(transdata['trans_lower'][start:end], dtype=np.int64),
+                    'upper': np.array(transdata['trans_upper'][start:end], dtype=np.int64),
+                    'A': np.array(transdata['trans_A'][start:end]),
+                    'collstr': np.array(transdata['trans_collstr'][start:end]),
+                    'forbidden': np.array(transdata['trans_forbidden'][start:end])}))
+
+    if get_photoionisations:
+        phixsdata = get_part(modelpath, 'phixs')
+        xgrid = np.array(phixsdata['xgrid'])
+
+    level_lists = []
+    iontuple = namedtuple('ion', 'Z ion_stage level_count ion_pot levels transitions')
+    for ionindex in get_ionindices(adata['ion_Z'], adata['ion_stage'], ionlist):
+        Z = int(adata['ion_Z'][ionindex])
+        ionstage = int(adata['ion_stage'][ionindex])
+        level_count = int(adata['ion_levelcount'][ionindex])
+        start = adata['ion_leveloffset'][ionindex]
+        end = start + level_count
+
+        phixstargetlists = [[] for _ in range(level_count)]
+        phixstables = [[] for _ in range(level_count)]
+        if get_photoionisations:
+            phixsrows = np.flatnonzero(
+                (phixsdata['phixs_Z'] == Z) & (phixsdata['phixs_lowerionstage'] == ionstage))
+            phixsrows = phixsrows[phixsdata['phixs_lowerlevel'][phixsrows] < level_count]
+
+            # (frequency/threshold, cross section) tables for all levels of the ion in one array
+            iontables = np.empty((len(phixsrows), len(xgrid), 2))
+            iontables[:, :, 0] = xgrid
+            iontables[:, :, 1] = phixsdata['phixs_sigma'][phixsrows]
+            targetoffsets = phixsdata['phixs_targetoffset']
+
+            # later entries for the same level replace earlier ones, as when reading the text file
+            for tableindex, (row, levelindex) in enumerate(zip(phixsrows, phixsdata['phixs_lowerlevel'][phixsrows])):
+                targetstart, targetend = targetoffsets[row], targetoffsets[row + 1]
+                phixstargetlists[levelindex] = list(zip(
+                    phixsdata['target_level'][targetstart:targetend].tolist(),
+                    phixsdata['target_fraction'][targetstart:targetend].tolist()))
+                phixstables[levelindex] = iontables[tableindex]
+
+        dflevels = pd.DataFrame({
+            'energy_ev': np.array(adata['level_energy_ev'][start:end]),
+            'g': np.array(adata['level_g'][start:end]),
+            'transition_count': np.array(adata['level_transitioncount'][start:end], dtype=np.int64),
+            'levelname': [name.decode('utf-8') for name in adata['level_name'][start:end]],
+            'phixstargetlist': phixstargetlists,
+            'phixstable': phixstables,
+        })
+
+        translist = transitionsdict.get((Z, ionstage), pd.DataFrame())
+        level_lists.append(iontuple(Z, ionstage, level_count, float(adata['ion_pot'][ionindex]), dflevels, translist))
+
+    return pd.DataFrame(level_lists)
+
+
+class AtomicData:
+    """Atomic data from get_levels() indexed by (Z, ion_stage) for constant-time lookups.
+
+    Other attributes and methods (e.g., iterrows) are passed through to the get_levels() DataFrame, so an
+    AtomicData can be used wherever the DataFrame was used.
+    """
+
+    def __init__(self, dfadata):
+        self.dfadata = dfadata
+        self.ions = {(int(ion.Z), int(ion.ion_stage)): ion for ion in dfadata.itertuples(index=False, name='ion')}
+        self._levelarrays = {}
+        self._transitionrows = {}
+
+    def __getattr__(self, name):
+        if name == 'dfadata':
+            raise AttributeError(name)
+        return getattr(self.dfadata, name)
+
+    def __contains__(self, ionkey):
+        return ionkey in self.ions
+
+    def __len__(self):
+        return len(self.ions)
+
+    def ion(self, atomic_number, ion_stage):
+        """Return the ion tuple with attributes Z, ion_stage, level_count, ion_pot, levels, and transitions."""
+        return self.ions[(atomic_number, ion_stage)]
+
+    def levels(self, atomic_number, ion_stage):
+        return self.ion(atomic_number, ion_stage).levels
+
+    def transitions(self, atomic_number, ion_stage):
+        return self.ion(atomic_number, ion_stage).transitions
+
+    def _get_levelarray(self, atomic_number, ion_stage, column):
+        key = (atomic_number, ion_stage, column)
+        if key not in self._levelarrays:
+            self._levelarrays[key] = self.levels(atomic_number, ion_stage)[column].values.astype(np.float64)
+        return self._levelarrays[key]
+
+    def level_energies_ev(self, atomic_number, ion_stage):
+        """Return an array of level energies [eV] (indexed by level number)."""
+        return self._get_levelarray(atomic_number, ion_stage, 'energy_ev')
+
+    def level_g(self, atomic_number, ion_stage):
+        """Return an array of level statistical weights (indexed by level number)."""
+        return self._get_levelarray(atomic_number, ion_stage, 'g')
+
+    def get_transition(self, atomic_number, ion_stage, upper, lower):
+        """Return the transition (lower, upper, A, collstr, forbidden) between two levels, or None if not found."""
+        if (atomic_number, ion_stage) not in self._transitionrows:
+            # the first transition between a pair of levels is used, as a query(...).iloc[0] would
+            transitionrows = {}
+            for trans in self.transitions(atomic_number, ion_stage).itertuples(index=False, name='transition'):
+                transitionrows.setdefault((int(trans.upper), int(trans.lower)), trans)
+            self._transitionrows[(atomic_number, ion_stage)] = transitionrows
+
+        return self._transitionrows[(atomic_number, ion_stage)].get((upper, lower))
+
+
+@at.memcache
+def get_atomicdata(modelpath, ionlist=None, get_transitions=False, get_photoionisations=False):
+    """Return an indexed AtomicData for the levels (and optionally transitions and photoionisation data)."""
+    return AtomicData(at.get_levels(
+        modelpath, ionlist=ionlist, get_transitions=get_transitions, get_photoionisations=get_photoionisations))
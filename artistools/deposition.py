@@ -5,6 +5,7 @@ import math
 from astropy import units as u
 # from astropy import constants as c
 import artistools as at
+import artistools.atomicdata
 import artistools.nltepops
 
 
@@ -41,12 +42,11 @@ def main_analytical(args=None, argsraw=None, **kwargs):
     print(f't_now = {t_now.to("d")}')
     print('The following assumes that all 56Ni has decayed to 56Co and all energy comes from emitted positrons')
 
-    adata = at.get_levels(args.modelpath, get_photoionisations=True)
+    adata = at.atomicdata.get_atomicdata(args.modelpath, get_photoionisations=True)
     timestep = at.get_timestep_of_timedays(args.modelpath, args.timedays)
-    dfnltepops = at.nltepops.read_files(
-        args.modelpath, timestep=timestep, noprint=True).query('Z == 26')
+    dfnltepops = at.nltepops.read_files(args.modelpath, timestep=timestep, atomic_number=26)
 
-    phixs = adata.query('Z==26 & ion_stage==1', inplace=False).iloc[0].levels.iloc[0].phixstable[0][1] * 1e-18
+    phixs = adata.ion(26, 1).levels.iloc[0].phixstable[0][1] * 1e-18
 
     for i, row in dfmodel.iterrows():
         v_inner = row['velocity_inner'] * u.km / u.s
@@ -11,7 +11,7 @@ import os
 # import re
 import sys
 from collections import namedtuple
-from functools import lru_cache, partial, reduce
+from functools import partial, reduce
 # from itertools import chain
 from pathlib import Path
 
@@ -268,7 +268,7 @@ def read_estimators_from_file(modelpath, folderpath, arr_velocity_outer, mpirank
     return estimators_thisfile
 
 
-@lru_cache(maxsize=16)
+@at.memcache
 @at.diskcache(savegzipped=True, funcdepends=[read_estimators_from_file, parse_estimfile])
 def read_estimators(modelpath, modelgridindex=None, timestep=None, get_ion_values=True, get_heatingcooling=True):
     """Read estimator files into a nested dictionary structure.
@@ -448,39 +448,46 @@ def get_averageionisation(populations, atomic_number):
     return free_electron_weighted_pop_sum / populations[atomic_number]
 
 
-def get_averageexcitation(modelpath, modelgridindex, timestep, atomic_number, ion_stage, T_exc):
+def get_averageexcitation(modelpath, modelgridindex, timestep, atomic_number, ion_stage, T_exc, dfnltepops=None):
+    """Return the population-weighted average level energy [eV] of an ion in a cell at a timestep.
+
+    dfnltepops can be the NLTE populations read for many cells and timesteps, otherwise they are read here.
+    """
     import artistools.nltepops
-    dfnltepops = at.nltepops.read_files(modelpath, modelgridindex=modelgridindex, timestep=timestep)
-    adata = at.get_levels(modelpath)
-    ionlevels = adata.query('Z == @atomic_number and ion_stage == @ion_stage').iloc[0].levels
+    if dfnltepops is None:
+        dfnltepops = at.nltepops.read_files(modelpath, modelgridindex=modelgridindex, timestep=timestep,
+                                            atomic_number=atomic_number, ion_stage=ion_stage)
+    ionlevels = at.atomicdata.get_atomicdata(modelpath).levels(atomic_number, ion_stage)
 
     energypopsum = 0
     ionpopsum = 0
     if dfnltepops.empty:
         return float('NaN')
-    else:
-        dfnltepops_ion = dfnltepops.query(
-            'modelgridindex==@modelgridindex and timestep==@timestep and Z==@atomic_number & ion_stage==@ion_stage')
 
-        k_b = const.k_B.to('eV / K').value
+    dfnltepops_ion = dfnltepops.query(
+        'modelgridindex==@modelgridindex and timestep==@timestep and Z==@atomic_number & ion_stage==@ion_stage')
+    if dfnltepops_ion.empty:
+        return float('NaN')
 
-        ionpopsum = dfnltepops_ion.n_NLTE.sum()
-        energypopsum = dfnltepops_ion[dfnltepops_ion.level >= 0].eval(
-            '@ionlevels.iloc[level].energy_ev.values * n_NLTE').sum()
+    k_b = const.k_B.to('eV / K').value
 
-        try:
-            superlevelrow = dfnltepops_ion[dfnltepops_ion.level < 0].iloc[0]
-            levelnumber_sl = dfnltepops_ion.level.max() + 1
+    ionpopsum = dfnltepops_ion.n_NLTE.sum()
+    energypopsum = dfnltepops_ion[dfnltepops_ion.level >= 0].eval(
+        '@ionlevels.iloc[level].energy_ev.values * n_NLTE').sum()
 
-            energy_boltzfac_sum = ionlevels.iloc[levelnumber_sl:].eval(
-                'energy_ev * g * exp(- energy_ev / @k_b / @T_exc)').sum()
+    try:
+        superlevelrow = dfnltepops_ion[dfnltepops_ion.level < 0].iloc[0]
+        levelnumber_sl = dfnltepops_ion.level.max() + 1
 
-            boltzfac_sum = ionlevels.iloc[levelnumber_sl:].eval('g * exp(- energy_ev / @k_b / @T_exc)').sum()
-            # adjust to the actual superlevel population from ARTIS
-            energypopsum += energy_boltzfac_sum * superlevelrow.n_NLTE / boltzfac_sum
-        except IndexError:
-            # no superlevel
-            pass
+        energy_boltzfac_sum = ionlevels.iloc[levelnumber_sl:].eval(
+            'energy_ev * g * exp(- energy_ev / @k_b / @T_exc)').sum()
+
+        boltzfac_sum = ionlevels.iloc[levelnumber_sl:].eval('g * exp(- energy_ev / @k_b / @T_exc)').sum()
+        # adjust to the actual superlevel population from ARTIS
+        energypopsum += energy_boltzfac_sum * superlevelrow.n_NLTE / boltzfac_sum
+    except IndexError:
+        # no superlevel
+        pass
 
     return energypopsum / ionpopsum
 
@@ -502,6 +509,13 @@ def plot_average_ionisation_excitation(
         else:
             atomic_number = at.get_atomic_number(paramvalue.split(' ')[0])
             ion_stage = at.decode_roman_numeral(paramvalue.split(' ')[1])
+            # the populations of the ion in all of the cells and timesteps from one read
+            dfnltepops = at.nltepops.read_files(
+                modelpath, timestep=tuple(sorted({timestep for timesteps in timestepslist for timestep in timesteps})),
+                modelgridindex=tuple(sorted(set(mgilist))), atomic_number=atomic_number, ion_stage=ion_stage)
+            dfnltepops_celltimestep = (
+                {} if dfnltepops.empty else dict(iter(dfnltepops.groupby(['modelgridindex', 'timestep']))))
+
         ylist = []
         for modelgridindex, timesteps in zip(mgilist, timestepslist):
             valuesum = 0
@@ -514,7 +528,9 @@ def plot_average_ionisation_excitation(
                 elif seriestype == 'averageexcitation':
                     T_exc = estimators[(timestep, modelgridindex)]['Te']
                     valuesum += (get_averageexcitation(
-                        modelpath, modelgridindex, timestep, atomic_number, ion_stage, T_exc) * arr_tdelta[timestep])
+                        modelpath, modelgridindex, timestep, atomic_number, ion_stage, T_exc,
+                        dfnltepops=dfnltepops_celltimestep.get((modelgridindex, timestep), pd.DataFrame())
+                    ) * arr_tdelta[timestep])
                 tdeltasum += arr_tdelta[timestep]
 
             ylist.append(valuesum / tdeltasum)
@@ -547,10 +563,8 @@ def plot_levelpop(
         ion_stage = at.decode_roman_numeral(paramsplit[1])
         levelindex = int(paramsplit[2])
 
-        # level index query goes outside for caching granularity reasons
         dfnltepops = at.nltepops.read_files(
-            modelpath,
-            dfquery=f'Z=={atomic_number:.0f} and ion_stage=={ion_stage:.0f}').query('level==@levelindex')
+            modelpath, atomic_number=atomic_number, ion_stage=ion_stage, level=levelindex)
 
         ylist = []
         for modelgridindex, timesteps in zip(mgilist, timestepslist):
@@ -71,8 +71,7 @@ def make_hesma_vspecfiles(modelpath):
     angles = [0, 1, 2, 3, 4]
 
     for angle in angles:
-        vspecdata_all = at.spectra.get_polarisation(angle=angle, modelpath=modelpath)
-        vspecdata = vspecdata_all['I']
+        vspecdata = at.spectra.get_polarisationdata(modelpath, angle).to_dataframe('I')
 
         timearray = vspecdata.columns.values[1:]
         vspecdata.sort_values(by='nu', ascending=False, inplace=True)
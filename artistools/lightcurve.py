@@ -7,6 +7,7 @@ import math
 import multiprocessing
 import os
 # import sys
+from functools import lru_cache
 from pathlib import Path
 from typing import Iterable
 
@@ -17,6 +18,7 @@ from astropy import units as u
 
 import artistools as at
 import artistools.spectra
+import artistools.speccube
 import matplotlib.pyplot as plt
 import matplotlib
 from extinction import apply, ccm89
@@ -28,6 +30,12 @@ from matplotlib.legend_handler import HandlerTuple
 
 color_list = list(plt.get_cmap('tab20')(np.linspace(0, 1.0, 20)))
 
+# filter response vectors for each (filter name, wavelength grid)
+filterresponses = {}
+
+# peak magnitude, rise time, and delta m15 of each model, band, and viewing angle for the scatter plots
+viewing_angle_data_filename = 'viewing_angle_peakmag_risetime_deltam15_data.csv'
+
 
 def readfile(filepath_or_buffer):
     lcdata = pd.read_csv(filepath_or_buffer, delim_whitespace=True, header=None, names=['time', 'lum', 'lum_cmf'])
@@ -153,21 +161,16 @@ def get_magnitudes(modelpath, args, angle=None, modelnumber=None):
     """Method adapted from https://github.com/cinserra/S3/blob/master/src/s3/SMS.py"""
     if args and args.plotvspecpol and os.path.isfile(modelpath / 'vpkt.txt'):
         print("Found vpkt.txt, using vitual packets")
-        stokes_params = at.spectra.get_polarisation(angle, modelpath)
-        vspecdata = stokes_params['I']
-        timearray = vspecdata.keys()[1:]
+        timearray = at.spectra.get_polarisationdata(modelpath, angle).timecolumns
     elif args and args.plotviewingangle and os.path.isfile(modelpath / 'specpol_res.out'):
-        specfilename = os.path.join(modelpath, "specpol_res.out")
-        specdataresdata = pd.read_csv(specfilename, delim_whitespace=True)
-        timearray = [i for i in specdataresdata.columns.values[1:] if i[-2] != '.']
+        specpol_res = artistools.speccube.get_specpol_res(Path(modelpath, 'specpol_res.out'))
+        timearray = [col.decode('utf-8') for col in specpol_res['columns'][1:].tolist()]
     elif Path(modelpath, 'specpol.out').is_file():
-        specfilename = os.path.join(modelpath, "specpol.out")
-        specdata = pd.read_csv(specfilename, delim_whitespace=True)
-        timearray = [i for i in specdata.columns.values[1:] if i[-2] != '.']
+        speccube = artistools.speccube.get_model_speccube(modelpath, ['specpol.out'])
+        timearray = [i for i in speccube.get_timecolumns() if i[-2] != '.']
     else:
-        specfilename = at.firstexisting(['spec.out.xz', 'spec.out.gz', 'spec.out'], path=modelpath)
-        specdata = pd.read_csv(specfilename, delim_whitespace=True)
-        timearray = specdata.columns.values[1:]
+        speccube = artistools.speccube.get_model_speccube(modelpath)
+        timearray = speccube.get_timecolumns()
 
     filters_dict = {}
     if not args.filter:
@@ -191,61 +194,116 @@ def get_magnitudes(modelpath, args, angle=None, modelnumber=None):
             filters_dict[filter_name] = []
 
     filterdir = os.path.join(at.PYDIR, 'data/filters/')
+    bandfilters = [filter_name for filter_name in filters_dict if filter_name != 'bol']
+
+    if bandfilters and angle is not None and args.plotvspecpol:
+        for filter_name in bandfilters:
+            zeropointenergyflux, wavefilter, transmission, wavefilter_min, wavefilter_max \
+                = get_filter_data(filterdir, filter_name)
+
+            for timestep, time in enumerate(timearray):
+                time = float(time)
+                wavelength_from_spectrum, flux = \
+                    get_spectrum_in_filter_range(modelpath, timestep, time, wavefilter_min, wavefilter_max, args,
+                                                 angle, res_specdata=res_specdata, modelnumber=modelnumber)
+                spectrumresponse = get_filter_response(filter_name, wavelength_from_spectrum)
+                phot_filtobs_sn = float(get_magnitudes_from_spectra(flux, spectrumresponse, zeropointenergyflux))
+                filters_dict[filter_name].append((time, phot_filtobs_sn))
+
+    elif bandfilters:
+        # the spectra of all timesteps as one (timestep × wavelength) matrix
+        spectra = at.spectra.get_spectra(
+            modelpath, [(timestep, timestep) for timestep in range(len(timearray))],
+            angle=angle if res_specdata is not None else None, res_specdata=res_specdata, args=args)
+
+        # (filter × wavelength) response matrix for a single product with the spectra
+        responsematrix = np.array([
+            get_filter_response(filter_name, spectra.lambda_angstroms) for filter_name in bandfilters])
+        zeropoints = np.array([get_filter_data(filterdir, filter_name)[0] for filter_name in bandfilters])
+        magnitudes = get_magnitudes_from_spectra(spectra.f_lambda, responsematrix, zeropoints)
+
+        for filterindex, filter_name in enumerate(bandfilters):
+            filters_dict[filter_name] = [
+                (float(time), magnitude) for time, magnitude in zip(timearray, magnitudes[:, filterindex])]
+
+    return filters_dict
 
-    for filter_name in filters_list:
-        if filter_name == 'bol':
-            continue
-        zeropointenergyflux, wavefilter, transmission, wavefilter_min, wavefilter_max \
-            = get_filter_data(filterdir, filter_name)
 
+def bolometric_magnitude(modelpath, timearray, args, angle=None, res_specdata=None):
+    if angle is not None and args.plotvspecpol:
+        arr_integrated_flux = []
         for timestep, time in enumerate(timearray):
-            time = float(time)
-            wavelength_from_spectrum, flux = \
-                get_spectrum_in_filter_range(modelpath, timestep, time, wavefilter_min, wavefilter_max, args, angle,
-                                             res_specdata=res_specdata, modelnumber=modelnumber)
-
-            if len(wavelength_from_spectrum) > len(wavefilter):
-                interpolate_fn = interp1d(wavefilter, transmission, bounds_error=False, fill_value=0.)
-                wavefilter = np.linspace(min(wavelength_from_spectrum), int(max(wavelength_from_spectrum)),
-                                         len(wavelength_from_spectrum))
-                transmission = interpolate_fn(wavefilter)
-            else:
-                interpolate_fn = interp1d(wavelength_from_spectrum, flux, bounds_error=False, fill_value=0.)
-                wavelength_from_spectrum = np.linspace(wavefilter_min, wavefilter_max, len(wavefilter))
-                flux = interpolate_fn(wavelength_from_spectrum)
+            spectrum = at.spectra.get_vspecpol_spectrum(modelpath, time, angle, args)
+            arr_integrated_flux.append(np.trapz(spectrum['f_lambda'], spectrum['lambda_angstroms']))
+    else:
+        if angle is not None and res_specdata is None:
+            res_specdata = at.spectra.read_specpol_res(modelpath, angle=angle)
 
-            phot_filtobs_sn = evaluate_magnitudes(flux, transmission, wavelength_from_spectrum, zeropointenergyflux)
+        # the spectra of all timesteps as one (timestep × wavelength) matrix
+        spectra = at.spectra.get_spectra(modelpath, [(timestep, timestep) for timestep in range(len(timearray))],
+                                         angle=angle, res_specdata=res_specdata)
+        arr_integrated_flux = np.trapz(spectra.f_lambda, spectra.lambda_angstroms, axis=1)
 
-            # print(time, phot_filtobs_sn)
-            # if phot_filtobs_sn != 0.0:
-            phot_filtobs_sn = phot_filtobs_sn - 25  # Absolute magnitude
-            filters_dict[filter_name].append((time, phot_filtobs_sn))
+    return [get_bolometric_magnitude_from_flux(integrated_flux) for integrated_flux in arr_integrated_flux]
 
-    return filters_dict
 
+def get_bolometric_magnitude_from_flux(integrated_flux):
+    """Return the absolute bolometric magnitude(s) for integrated f_lambda flux(es) at a distance of 1 Mpc."""
+    integrated_luminosity = integrated_flux * 4 * np.pi * np.power(u.Mpc.to('cm'), 2)
+    return 4.74 - (2.5 * np.log10(integrated_luminosity / const.L_sun.to('erg/s').value))
 
-def bolometric_magnitude(modelpath, timearray, args, angle=None, res_specdata=None):
-    magnitudes = []
-    for timestep, time in enumerate(timearray):
-        if angle is not None:
-            if args.plotvspecpol:
-                spectrum = at.spectra.get_vspecpol_spectrum(modelpath, time, angle, args)
-            else:
-                if res_specdata is None:
-                    res_specdata = at.spectra.read_specpol_res(modelpath, angle=angle)
-                spectrum = at.spectra.get_res_spectrum(modelpath, timestep, timestep, angle=angle,
-                                                       res_specdata=res_specdata)
-        else:
-            spectrum = at.spectra.get_spectrum(modelpath, timestep, timestep)
 
-        integrated_flux = np.trapz(spectrum['f_lambda'], spectrum['lambda_angstroms'])
-        integrated_luminosity = integrated_flux * 4 * np.pi * np.power(u.Mpc.to('cm'), 2)
-        magnitude = 4.74 - (2.5 * np.log10(integrated_luminosity / const.L_sun.to('erg/s').value))
-        magnitudes.append(magnitude)
+def get_viewingangle_magnitudes(modelpath, filters_list, args=None):
+    """Return the times and a dict with an (angle × timestep) array of absolute magnitudes for each filter.
+
+    All viewing angles of specpol_res.out are done at once: the Stokes I cube is read once, and the magnitudes
+    come from a single product of the (angle × timestep × wavelength) spectra with the filter response matrix.
+    """
+    arr_nu, columns, arr_fnu = at.spectra.get_specpol_res_fnu(modelpath, args=args)
+    arr_time = np.array([float(time) for time in columns[1:]])
+
+    # each spectrum is a single timestep, so the window weights are the identity matrix
+    spectra = at.spectra.get_spectra_from_fnu_matrix(arr_nu, arr_fnu, np.identity(len(arr_time)))
+
+    filterdir = os.path.join(at.PYDIR, 'data/filters/')
+    bandfilters = [filter_name for filter_name in filters_list if filter_name != 'bol']
+    if bandfilters:
+        responsematrix = np.array([
+            get_filter_response(filter_name, spectra.lambda_angstroms) for filter_name in bandfilters])
+        zeropoints = np.array([get_filter_data(filterdir, filter_name)[0] for filter_name in bandfilters])
+        bandmagnitudes = get_magnitudes_from_spectra(spectra.f_lambda, responsematrix, zeropoints)
+
+    magnitudes = {}
+    for filter_name in filters_list:
+        if filter_name == 'bol':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                magnitudes['bol'] = get_bolometric_magnitude_from_flux(
+                    np.trapz(spectra.f_lambda, spectra.lambda_angstroms, axis=-1))
+        elif filter_name not in magnitudes:
+            magnitudes[filter_name] = bandmagnitudes[..., bandfilters.index(filter_name)]
+
+    return arr_time, magnitudes
+
+
+def get_viewingangle_filters_dicts(modelpath, args):
+    """Return a list with the filters_dict of get_magnitudes() for every viewing angle of specpol_res.out."""
+    if not args.filter:
+        args.filter = ['B']
+
+    arr_time, magnitudes = get_viewingangle_magnitudes(modelpath, args.filter, args=args)
+    nangles = len(next(iter(magnitudes.values())))
+
+    filters_dicts = []
+    for angle in range(nangles):
+        filters_dicts.append({
+            filter_name: [(float(time), magnitude) for time, magnitude in zip(arr_time, arr_magnitudes[angle])
+                          if filter_name != 'bol' or math.isfinite(magnitude)]
+            for filter_name, arr_magnitudes in magnitudes.items()})
 
-    return magnitudes
+    return filters_dicts
 
 
+@lru_cache(maxsize=32)
 def get_filter_data(filterdir, filter_name):
     """Filter data in 'data/filters' taken from https://github.com/cinserra/S3/tree/master/src/s3/metadata"""
 
@@ -267,6 +325,71 @@ def get_filter_data(filterdir, filter_name):
     return zeropointenergyflux, np.array(wavefilter), np.array(transmission), wavefilter_min, wavefilter_max
 
 
+def get_trapz_weights(x):
+    """Return the weights w such that np.dot(w, y) == np.trapz(y, x)."""
+    weights = np.zeros(len(x))
+    if len(x) > 1:
+        dx = np.diff(x)
+        weights[:-1] += dx / 2.
+        weights[1:] += dx / 2.
+    return weights
+
+
+def calculate_filter_response(filter_name, arr_lambda):
+    """Return the response vector R on the wavelength grid arr_lambda such that the flux through the filter is
+    |R · f_lambda|.
+
+    This is the same resampling as the per-spectrum calculation: the transmission is interpolated onto the
+    spectrum points if there are more of them than filter points, otherwise the spectrum is interpolated onto
+    the filter points. Both are linear in f_lambda, so they are equivalent to a single vector.
+    """
+    filterdir = os.path.join(at.PYDIR, 'data/filters/')
+    _, wavefilter, transmission, wavefilter_min, wavefilter_max = get_filter_data(filterdir, filter_name)
+
+    arr_lambda = np.asarray(arr_lambda, dtype=float)
+    response = np.zeros(len(arr_lambda))
+    # to match the spectrum wavelengths to those of the filter
+    inrange = np.flatnonzero((wavefilter_min <= arr_lambda) & (arr_lambda <= wavefilter_max))
+    if len(inrange) < 2:
+        return response
+    wavelength_from_spectrum = arr_lambda[inrange]
+
+    if len(wavelength_from_spectrum) > len(wavefilter):
+        interpolate_fn = interp1d(wavefilter, transmission, bounds_error=False, fill_value=0.)
+        transmission_resampled = interpolate_fn(np.linspace(
+            min(wavelength_from_spectrum), int(max(wavelength_from_spectrum)), len(wavelength_from_spectrum)))
+        response[inrange] = transmission_resampled * get_trapz_weights(wavelength_from_spectrum)
+    else:
+        wavelength_resampled = np.linspace(wavefilter_min, wavefilter_max, len(wavefilter))
+        # (filter point × spectrum point) linear interpolation matrix
+        interpolationmatrix = interp1d(
+            wavelength_from_spectrum, np.identity(len(wavelength_from_spectrum)), axis=0,
+            bounds_error=False, fill_value=0.)(wavelength_resampled)
+        response[inrange] = (transmission * get_trapz_weights(wavelength_resampled)) @ interpolationmatrix
+
+    return response
+
+
+def get_filter_response(filter_name, arr_lambda):
+    """Return the (cached) response vector of a filter on a wavelength grid (see calculate_filter_response)."""
+    key = (filter_name, np.asarray(arr_lambda, dtype=float).tobytes())
+    if key not in filterresponses:
+        filterresponses[key] = calculate_filter_response(filter_name, arr_lambda)
+    return filterresponses[key]
+
+
+def get_magnitudes_from_spectra(arr_flambda, response, zeropointenergyflux):
+    """Return absolute magnitudes from f_lambda spectra (wavelength on the last axis) and filter response vectors.
+
+    With a (filter × wavelength) response matrix and zero points for each filter, the result has a filter axis last.
+    """
+    flux_obs = np.abs(np.asarray(arr_flambda) @ np.asarray(response).T)
+    with np.errstate(divide='ignore'):
+        phot_filtobs_sn = np.where(flux_obs == 0.0, 0.0, -2.5 * np.log10(flux_obs / zeropointenergyflux))
+
+    return phot_filtobs_sn - 25  # Absolute magnitude
+
+
 def get_spectrum_in_filter_range(modelpath, timestep, time, wavefilter_min, wavefilter_max, args, angle=None,
                                  res_specdata=None, modelnumber=None, spectrum=None):
     if spectrum is None:
@@ -281,17 +404,6 @@ def get_spectrum_in_filter_range(modelpath, timestep, time, wavefilter_min, wave
     return np.array(wavelength_from_spectrum), np.array(flux)
 
 
-def evaluate_magnitudes(flux, transmission, wavelength_from_spectrum, zeropointenergyflux):
-    cf = flux * transmission
-    flux_obs = abs(np.trapz(cf, wavelength_from_spectrum))  # using trapezoidal rule to integrate
-    if flux_obs == 0.0:
-        phot_filtobs_sn = 0.0
-    else:
-        phot_filtobs_sn = -2.5 * np.log10(flux_obs / zeropointenergyflux)
-
-    return phot_filtobs_sn
-
-
 def make_magnitudes_plot(modelpaths, filternames_conversion_dict, outputfolder, args):
     labelfontsize = 22
     font = {'size': labelfontsize}
@@ -370,13 +482,26 @@ def make_magnitudes_plot(modelpaths, filternames_conversion_dict, outputfolder,
             angles = [None]
         # angles.append(None)
 
+        # the light curves of all specpol_res.out viewing angles come from one pass over the Stokes cube
+        if (args.plotviewingangle and os.path.isfile(modelpath / 'specpol_res.out')
+                and not (args.plotvspecpol and os.path.isfile(modelpath / 'vpkt.txt'))):
+            viewingangle_filters_dicts = get_viewingangle_filters_dicts(modelpath, args)
+        else:
+            viewingangle_filters_dicts = None
+
+        # (angle, time, magnitude) for each band, for the peak fits of all angles together
+        peakfit_lightcurves = {}
+
         for index, angle in enumerate(angles):
             linenames = []
 
             modelname = at.get_model_name(modelpath)
             linenames.append(modelname)
             print(f'Reading spectra: {modelname}')
-            filters_dict = get_magnitudes(modelpath, args, angle, modelnumber=modelnumber)
+            if viewingangle_filters_dicts is not None and angle is not None:
+                filters_dict = viewingangle_filters_dicts[angle]
+            else:
+                filters_dict = get_magnitudes(modelpath, args, angle, modelnumber=modelnumber)
 
             if modelnumber == 0 and args.plot_hesma_model:
                 hesma_model = read_hesma_lightcurve(args)
@@ -426,9 +551,11 @@ def make_magnitudes_plot(modelpaths, filternames_conversion_dict, outputfolder,
                         or args.save_angle_averaged_peakmag_risetime_delta_m15_to_file
                         or args.make_viewing_angle_peakmag_risetime_scatter_plot
                         or args.make_viewing_angle_peakmag_delta_m15_scatter_plot):
-                    band_risetime_polyfit, band_peakmag_polyfit, band_deltam15_polyfit = \
-                        calculate_peak_time_mag_deltam15(time, magnitude, modelname, angle, key, band_risetime_polyfit,
-                                                         band_peakmag_polyfit, band_deltam15_polyfit,
+                    peakfit_lightcurves.setdefault(key, []).append((angle, time, magnitude))
+
+                    if args.test_viewing_angle_fit:
+                        # only for the plot of each fit, the values are from the fits of all angles below
+                        calculate_peak_time_mag_deltam15(time, magnitude, modelname, angle, key, [], [], [],
                                                          filternames_conversion_dict, args)
 
                 if args.plotviewingangle and args.plotviewingangles_lightcurves:
@@ -516,12 +643,19 @@ def make_magnitudes_plot(modelpaths, filternames_conversion_dict, outputfolder,
                         # else:
                         ax.plot(time, magnitude, label=linelabel, linewidth=3)  # color=color, linestyle=linestyle)
 
+        # Calculating band peak time, peak magnitude and delta m15 for all angles of each band at once
+        if peakfit_lightcurves:
+            dfpeaks = get_peak_time_mag_deltam15_table(modelname, peakfit_lightcurves, args)
+            band_risetime_polyfit = list(dfpeaks['risetime_polyfit'])
+            band_peakmag_polyfit = list(dfpeaks['peak_mag_polyfit'])
+            band_deltam15_polyfit = list(dfpeaks['deltam15_polyfit'])
+
         # Saving viewing angle data so it can be read in and plotted later on without re-running the script
         #    as it is quite time consuming
         if args.save_viewing_angle_peakmag_risetime_delta_m15_to_file:
-            np.savetxt(key + "band_" + f'{modelname}' + "_viewing_angle_data.txt",
-                       np.c_[band_peakmag_polyfit, band_risetime_polyfit, band_deltam15_polyfit],
-                       delimiter=' ', header='peak_mag_polyfit risetime_polyfit deltam15_polyfit', comments='')
+            # only this model's peaks are saved (there are none if no light curves were fitted)
+            if peakfit_lightcurves:
+                save_viewing_angle_data(dfpeaks)
 
         elif (args.save_angle_averaged_peakmag_risetime_delta_m15_to_file
               or args.make_viewing_angle_peakmag_risetime_scatter_plot
@@ -632,43 +766,100 @@ def make_magnitudes_plot(modelpaths, filternames_conversion_dict, outputfolder,
     print(f'Saved figure: {args.outputfile}')
 
 
+def fit_peak_time_mag_deltam15(time, magnitudes, timemin, timemax):
+    """Return arrays of the peak time, peak magnitude, and delta m15 from polynomial fits to light curves.
+
+    magnitudes is a (light curve × time) array, e.g., one row per viewing angle. The degree 10 polynomials of all
+    rows come from one least-squares solve and are evaluated together on 1000 times between timemin + 1 and
+    timemax - 1.
+    """
+    magnitudes = np.atleast_2d(np.asarray(magnitudes, dtype=float))
+    # polynomial with 10 degrees of freedom used here but change as required if it improves the fit
+    zfit = np.polyfit(x=np.asarray(time, dtype=float), y=magnitudes.T, deg=10)
+    xfit = np.linspace(timemin + 1, timemax - 1, num=1000)
+    fxfit = np.vander(xfit, 11) @ zfit  # (fit time × light curve)
+
+    curveindicies = np.arange(magnitudes.shape[0])
+    index_min = np.argmin(fxfit, axis=0)
+    tmax_polyfit = xfit[index_min]
+    index_after_15_days = np.argmin(np.abs(xfit[:, np.newaxis] - (tmax_polyfit + 15)[np.newaxis, :]), axis=0)
+    peakmag_polyfit = fxfit[index_min, curveindicies]
+    mag_after15days_polyfit = fxfit[index_after_15_days, curveindicies]
+
+    return tmax_polyfit, peakmag_polyfit, (peakmag_polyfit - mag_after15days_polyfit) * -1
+
+
+def get_peak_time_mag_deltam15_table(modelname, bandlightcurves, args):
+    """Return a DataFrame with the polynomial fit peak time, peak magnitude, and delta m15 of light curves.
+
+    bandlightcurves is a dict of band name to a list of (angle, time, magnitude) tuples. The light curves of a band
+    that have the same times (usually all of the viewing angles) are fitted together.
+    """
+    dfpeaks = []
+    for key, lightcurves in bandlightcurves.items():
+        timegroups = {}
+        for index, (_, time, _) in enumerate(lightcurves):
+            timegroups.setdefault(tuple(time), []).append(index)
+
+        tmax_polyfit = np.zeros(len(lightcurves))
+        peakmag_polyfit = np.zeros(len(lightcurves))
+        deltam15_polyfit = np.zeros(len(lightcurves))
+        for time, indicies in timegroups.items():
+            (tmax_polyfit[indicies], peakmag_polyfit[indicies], deltam15_polyfit[indicies]) = \
+                fit_peak_time_mag_deltam15(time, [lightcurves[index][2] for index in indicies],
+                                           args.timemin, args.timemax)
+
+        for peakmag, tmax, deltam15 in zip(peakmag_polyfit, tmax_polyfit, deltam15_polyfit):
+            print(f'{key}_max polyfit = {peakmag} at time = {tmax}')
+            print(f'deltam15 polyfit = {deltam15 * -1}')
+
+        dfpeaks.append(pd.DataFrame({
+            'model': modelname, 'band': key, 'angle': [angle for angle, _, _ in lightcurves],
+            'peak_mag_polyfit': peakmag_polyfit, 'risetime_polyfit': tmax_polyfit,
+            'deltam15_polyfit': deltam15_polyfit}))
+
+    return pd.concat(dfpeaks, ignore_index=True)
+
+
+def save_viewing_angle_data(dfpeaks):
+    """Add the viewing angle peak data of a model to the table read by the scatter plots, replacing older rows of
+    the same model and band."""
+    if os.path.isfile(viewing_angle_data_filename):
+        dfexisting = pd.read_csv(viewing_angle_data_filename)
+        replaced = dfexisting.set_index(['model', 'band']).index.isin(
+            dfpeaks.set_index(['model', 'band']).index.unique())
+        dfpeaks = pd.concat([dfexisting[~replaced], dfpeaks], ignore_index=True)
+
+    dfpeaks.to_csv(viewing_angle_data_filename, index=False)
+    print(f'Saved {viewing_angle_data_filename}')
+
+
+def read_viewing_angle_data(modelname, key):
+    """Return the rows of the viewing angle peak data table for one model and band."""
+    dfviewingangles = pd.read_csv(viewing_angle_data_filename)
+    return dfviewingangles[(dfviewingangles['model'] == modelname) & (dfviewingangles['band'] == key)]
+
+
 def calculate_peak_time_mag_deltam15(time, magnitude, modelname, angle, key, band_risetime_polyfit,
                                      band_peakmag_polyfit, band_deltam15_polyfit, filternames_conversion_dict, args):
     """Calculating band peak time, peak magnitude and delta m15"""
-    zfit = np.polyfit(x=time, y=magnitude, deg=10)
-    xfit = np.linspace(args.timemin + 1, args.timemax - 1, num=1000)
-
-    # Taking line_min and line_max from the limits set for the lightcurve being plotted
-    fxfit = []
-    for j in range(len(xfit)):
-        fxfit.append(zfit[0] * (xfit[j] ** 10) + zfit[1] * (xfit[j] ** 9) + zfit[2] * (xfit[j] ** 8) +
-                     zfit[3] * (xfit[j] ** 7) + zfit[4] * (xfit[j] ** 6) + zfit[5] * (xfit[j] ** 5) +
-                     zfit[6] * (xfit[j] ** 4) + zfit[7] * (xfit[j] ** 3) + zfit[8] * (xfit[j] ** 2) +
-                     zfit[9] * (xfit[j]) + zfit[10])
-        # polynomial with 10 degrees of freedom used here but change as required if it improves the fit
-
-    def match_closest_time_polyfit(reftime_polyfit):
-        return str("{}".format(min([float(x) for x in xfit], key=lambda x: abs(x - reftime_polyfit))))
-
-    index_min = np.argmin(fxfit)
-    tmax_polyfit = xfit[index_min]
-    time_after15days_polyfit = match_closest_time_polyfit(tmax_polyfit + 15)
-    for ii, xfits in enumerate(xfit):
-        if float(xfits) == float(time_after15days_polyfit):
-            index_after_15_days = ii
-
-    mag_after15days_polyfit = fxfit[index_after_15_days]
-    print(f'{key}_max polyfit = {min(fxfit)} at time = {tmax_polyfit}')
-    print(f'deltam15 polyfit = {min(fxfit) - mag_after15days_polyfit}')
+    tmax_polyfit, peakmag_polyfit, deltam15_polyfit = [
+        value[0] for value in fit_peak_time_mag_deltam15(time, magnitude, args.timemin, args.timemax)]
+    print(f'{key}_max polyfit = {peakmag_polyfit} at time = {tmax_polyfit}')
+    print(f'deltam15 polyfit = {deltam15_polyfit * -1}')
 
     band_risetime_polyfit.append(tmax_polyfit)
-    band_peakmag_polyfit.append(min(fxfit))
-    band_deltam15_polyfit.append((min(fxfit) - mag_after15days_polyfit) * -1)
+    band_peakmag_polyfit.append(peakmag_polyfit)
+    band_deltam15_polyfit.append(deltam15_polyfit)
 
     # Plotting the lightcurves for all viewing angles specified in the command line along with the
     # polynomial fit and peak mag, risetime to peak and delta m15 marked on the plots to check the
     # fit is working correctly
     if args.test_viewing_angle_fit:
+        xfit = np.linspace(args.timemin + 1, args.timemax - 1, num=1000)
+        fxfit = np.polyval(np.polyfit(x=time, y=magnitude, deg=10), xfit)
+        time_after15days_polyfit = min(xfit, key=lambda x: abs(x - (tmax_polyfit + 15)))
+
         plt.plot(time, magnitude)
         plt.plot(xfit, fxfit)
 
@@ -683,8 +874,8 @@ def calculate_peak_time_mag_deltam15(time, magnitude, modelname, angle, key, ban
         plt.minorticks_on()
         plt.tick_params(axis='both', which='minor', top=True, right=True, length=5, width=2, labelsize=12)
         plt.tick_params(axis='both', which='major', top=True, right=True, length=8, width=2, labelsize=12)
-        plt.axhline(y=min(fxfit), color="black", linestyle="--")
-        plt.axhline(y=mag_after15days_polyfit, color="black", linestyle="--")
+        plt.axhline(y=peakmag_polyfit, color="black", linestyle="--")
+        plt.axhline(y=peakmag_polyfit + deltam15_polyfit, color="black", linestyle="--")
         plt.axvline(x=tmax_polyfit, color="black", linestyle="--")
         plt.axvline(x=float(time_after15days_polyfit), color="black", linestyle="--")
         print("time after 15 days polyfit = ", time_after15days_polyfit)
@@ -699,8 +890,7 @@ def make_viewing_angle_peakmag_risetime_scatter_plot(modelnames, band_risetime_a
                                                      band_peakmag_angle_averaged_polyfit, colours, colours2,
                                                      plotvalues, key):
     for ii, modelname in enumerate(modelnames):
-        viewing_angle_plot_data = pd.read_csv(key + "band_" + f'{modelname}' + "_viewing_angle_data.txt",
-                                              delimiter=" ")
+        viewing_angle_plot_data = read_viewing_angle_data(modelname, key)
         band_peak_mag_viewing_angles = viewing_angle_plot_data["peak_mag_polyfit"].values
         band_risetime_viewing_angles = viewing_angle_plot_data["risetime_polyfit"].values
 
@@ -730,8 +920,7 @@ def make_viewing_angle_peakmag_delta_m15_scatter_plot(modelnames, key, colours,
                                                       band_delta_m15_angle_averaged_polyfit,
                                                       band_peakmag_angle_averaged_polyfit, plotvalues):
     for ii, modelname in enumerate(modelnames):
-        viewing_angle_plot_data = pd.read_csv(key + "band_" + f'{modelname}' + "_viewing_angle_data.txt",
-                                              delimiter=" ")
+        viewing_angle_plot_data = read_viewing_angle_data(modelname, key)
 
         band_peak_mag_viewing_angles = viewing_angle_plot_data["peak_mag_polyfit"].values
         band_delta_m15_viewing_angles = viewing_angle_plot_data["deltam15_polyfit"].values
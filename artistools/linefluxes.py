@@ -18,6 +18,7 @@ from astropy import units as u
 from scipy import interpolate
 
 import artistools as at
+import artistools.atomicdata
 import artistools.packets
 
 
@@ -102,6 +103,44 @@ def get_line_fluxes_from_packets(emtypecolumn, emfeatures, modelpath, maxpacketf
     return lcdata
 
 
+def get_pop_volume_sums(dfnltepops, levels, modelgridindices, shell_volumes):
+    """Return a DataFrame (timestep × level) of the level populations summed over cells, weighted by shell volume.
+
+    The volume of cells without a population for a level (e.g., empty cells) is added to the next cell with data
+    and the volume of any cells after the last cell with data is dropped. Timesteps without data are missing and a
+    level with no data at a timestep is NaN.
+    """
+    if dfnltepops.empty:
+        return pd.DataFrame(columns=levels, dtype=np.float64)
+
+    cellindex = pd.Index(modelgridindices)
+    levelindex = pd.Index(levels)
+    dfnltepops = dfnltepops[dfnltepops.level.isin(levels) & dfnltepops.modelgridindex.isin(cellindex)]
+    # use the first row for each level in a cell, as a query(...).iloc[0] would
+    dfnltepops = dfnltepops.drop_duplicates(['timestep', 'modelgridindex', 'level'], keep='first')
+
+    cumvolumes = np.concatenate([[0.], np.cumsum(shell_volumes)])
+    cellnumbers = np.arange(len(cellindex))
+
+    dictsums = {}
+    for timestep, dftimesteppops in dfnltepops.groupby('timestep'):
+        arr_pop = np.full((len(levels), len(cellindex)), np.nan)
+        arr_pop[levelindex.get_indexer(dftimesteppops.level.values),
+                cellindex.get_indexer(dftimesteppops.modelgridindex.values)] = dftimesteppops.n_NLTE.values
+        hasdata = ~np.isnan(arr_pop)
+
+        # the volume from after the previous cell with data up to and including each cell
+        lastdatacell = np.maximum.accumulate(np.where(hasdata, cellnumbers, -1), axis=1)
+        prevdatacell = np.concatenate([np.full((len(levels), 1), -1), lastdatacell[:, :-1]], axis=1)
+        carriedvolumes = cumvolumes[1:] - cumvolumes[prevdatacell + 1]
+
+        popvolumesums = np.where(hasdata, arr_pop * carriedvolumes, 0.).sum(axis=1)
+        popvolumesums[~hasdata.any(axis=1)] = np.nan
+        dictsums[timestep] = popvolumesums
+
+    return pd.DataFrame.from_dict(dictsums, orient='index', columns=levels)
+
+
 def get_line_fluxes_from_pops(emtypecolumn, emfeatures, modelpath, arr_tstart=None, arr_tend=None):
     import artistools.nltepops
     if arr_tstart is None:
@@ -114,78 +153,75 @@ def get_line_fluxes_from_pops(emtypecolumn, emfeatures, modelpath, arr_tstart=No
 
     modeldata, _ = at.get_modeldata(modelpath)
 
+    # shell volumes [cm3] at one day, which scale with time cubed in homologous expansion
+    shell_volumes_oneday = (4 * math.pi / 3) * (
+        modeldata.velocity_outer.values ** 3 - modeldata.velocity_inner.values ** 3) * (
+        u.km.to('cm') * u.day.to('s')) ** 3
+
+    arr_timestep = np.array([at.get_timestep_of_timedays(modelpath, timedays) for timedays in arr_tmid])
+
     ionlist = []
     for feature in emfeatures:
         ionlist.append((feature.atomic_number, feature.ion_stage))
 
-    adata = at.get_levels(modelpath, ionlist=tuple(ionlist), get_transitions=True, get_photoionisations=False)
+    adata = at.atomicdata.get_atomicdata(
+        modelpath, ionlist=tuple(ionlist), get_transitions=True, get_photoionisations=False)
 
     timearrayplusend = np.concatenate([arr_tstart, [arr_tend[-1]]])
 
     dictlcdata = {'time': arr_tmid}
 
     for feature in emfeatures:
-        fluxdata = np.zeros_like(arr_tmid, dtype=np.float)
-
-        dfnltepops = at.nltepops.read_files(
-            modelpath,
-            dfquery=f'Z=={feature.atomic_number:.0f} and ion_stage=={feature.ion_stage:.0f}').query('level in @feature.upperlevelindicies')
-
-        ion = adata.query(
-            'Z == @feature.atomic_number and ion_stage == @feature.ion_stage').iloc[0]
-
-        for timeindex, timedays in enumerate(arr_tmid):
-            v_inner = modeldata.velocity_inner.values * u.km / u.s
-            v_outer = modeldata.velocity_outer.values * u.km / u.s
+        ion = adata.ion(feature.atomic_number, feature.ion_stage)
 
-            t_sec = timedays * u.day
-            shell_volumes = ((4 * math.pi / 3) * ((v_outer * t_sec) ** 3 - (v_inner * t_sec) ** 3)).to('cm3').value
+        dftransitions = pd.DataFrame({'upper': feature.upperlevelindicies, 'lower': feature.lowerlevelindicies})
+        if ion.transitions.empty:
+            dftransitions = dftransitions.iloc[:0].assign(A=0.)
+        else:
+            # the first transition between the same levels is used, as in adata.get_transition()
+            dftransitions = dftransitions.merge(
+                ion.transitions.drop_duplicates(['upper', 'lower'], keep='first')[['upper', 'lower', 'A']],
+                on=['upper', 'lower'], how='inner')
 
-            timestep = at.get_timestep_of_timedays(modelpath, timedays)
-            print(f'{feature.approxlambda}A {timedays}d (ts {timestep})')
+        energies_ergs = adata.level_energies_ev(feature.atomic_number, feature.ion_stage) * u.eV.to('erg')
+        dftransitions['lum_per_pop'] = dftransitions.A.values * (
+            energies_ergs[dftransitions.upper.values] - energies_ergs[dftransitions.lower.values])
 
-            for upperlevelindex, lowerlevelindex in zip(feature.upperlevelindicies, feature.lowerlevelindicies):
-                unaccounted_shellvol = 0.  # account for the volume of empty shells
-                unaccounted_shells = []
-                for modelgridindex in modeldata.index:
-                    try:
-                        levelpop = dfnltepops.query(
-                            'modelgridindex==@modelgridindex and timestep==@timestep and Z==@feature.atomic_number'
-                            ' and ion_stage==@feature.ion_stage and level==@upperlevelindex').iloc[0].n_NLTE
+        # luminosity per unit upper level population [erg/s] summed over the transitions from each upper level
+        upperlevelcoeffs = dftransitions.groupby('upper')['lum_per_pop'].sum()
+        upperlevels = upperlevelcoeffs.index.values.tolist()
 
-                        A_val = ion.transitions.query(
-                                'upper == @upperlevelindex and lower == @lowerlevelindex').iloc[0].A
+        print(f'{feature.approxlambda}A: {len(dftransitions)} transitions from {len(upperlevels)} upper levels '
+              f'at {len(arr_tmid)} times')
 
-                        delta_ergs = (
-                            ion.levels.iloc[upperlevelindex].energy_ev -
-                            ion.levels.iloc[lowerlevelindex].energy_ev) * u.eV.to('erg')
+        if not upperlevels:
+            dictlcdata[feature.colname] = np.zeros_like(arr_tmid, dtype=np.float64)
+            continue
 
-                        # l = delta_ergs * A_val * levelpop * (shell_volumes[modelgridindex] + unaccounted_shellvol)
-                        # print(f'  {modelgridindex} outer_velocity {modeldata.velocity_outer.values[modelgridindex]}'
-                        #       f' km/s shell_vol: {shell_volumes[modelgridindex] + unaccounted_shellvol} cm3'
-                        #       f' n_level {levelpop} cm-3 shell_Lum {l} erg/s')
+        dfnltepops = at.nltepops.read_files(
+            modelpath, timestep=tuple(np.unique(arr_timestep).tolist()), atomic_number=feature.atomic_number,
+            ion_stage=feature.ion_stage, level=tuple(upperlevels))
 
-                        fluxdata[timeindex] += delta_ergs * A_val * levelpop * (
-                            shell_volumes[modelgridindex] + unaccounted_shellvol)
+        arr_popvolumesums = get_pop_volume_sums(
+            dfnltepops, upperlevels, modeldata.index, shell_volumes_oneday).reindex(arr_timestep).values
 
-                        unaccounted_shellvol = 0.
+        # must be data for at least one shell
+        assert not np.isnan(arr_popvolumesums).any()
 
-                    except IndexError:
-                        unaccounted_shellvol += shell_volumes[modelgridindex]
-                        unaccounted_shells.append(modelgridindex)
-                if unaccounted_shells:
-                    print(f'No data for cells {unaccounted_shells} (expected for empty cells)')
-                assert len(unaccounted_shells) < len(modeldata.index)  # must be data for at least one shell
-
-        dictlcdata[feature.colname] = fluxdata
+        dictlcdata[feature.colname] = arr_tmid ** 3 * (arr_popvolumesums @ upperlevelcoeffs.values)
 
     lcdata = pd.DataFrame(dictlcdata)
     return lcdata
 
 
 def get_closelines(modelpath, atomic_number, ion_stage, approxlambda, lambdamin=-1, lambdamax=-1, lowerlevelindex=-1, upperlevelindex=-1):
-    dflinelist = at.get_linelist(modelpath, returntype='dataframe')
-    dflinelistclosematches = dflinelist.query('atomic_number == @atomic_number and ionstage == @ion_stage').copy()
+    linelist = at.get_linelist(modelpath, returntype='array')
+    closelineindices = linelist.get_lambdarange_indices(
+        lambdamin if lambdamin > 0 else -np.inf, lambdamax if lambdamax > 0 else np.inf,
+        atomic_number=atomic_number, ion_stage=ion_stage)
+
+    # the range search includes the end points
+    dflinelistclosematches = linelist.get_lines(np.sort(closelineindices))
     if lambdamin > 0:
         dflinelistclosematches.query('@lambdamin < lambda_angstroms', inplace=True)
     if lambdamax > 0:
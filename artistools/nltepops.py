@@ -6,7 +6,6 @@ import multiprocessing
 import os
 import re
 # import sys
-from functools import lru_cache
 from functools import partial
 from pathlib import Path
 from itertools import chain
@@ -20,6 +19,7 @@ import numpy as np
 import matplotlib as mpl
 
 import artistools as at
+import artistools.atomicdata
 import artistools.estimators
 
 defaultoutputfile = 'plotnlte_{elsymbol}_cell{cell:03d}_ts{timestep:02d}_{time_days:.0f}d.pdf'
@@ -79,60 +79,57 @@ def add_lte_pops(modelpath, dfpop, columntemperature_tuples, noprint=False, maxl
     """Add columns to dfpop with LTE populations.
 
     columntemperature_tuples is a sequence of tuples of column name and temperature, e.g., ('mycolumn', 3000)
+    The level energies and g values of each ion are joined to its rows as arrays, so the Boltzmann factors for all
+    cells and timesteps are calculated together.
     """
     k_b = const.k_B.to('eV / K').value
+    adata = at.atomicdata.get_atomicdata(modelpath)
 
-    for _, row in dfpop.drop_duplicates(['modelgridindex', 'timestep', 'Z', 'ion_stage']).iterrows():
-        modelgridindex = int(row.modelgridindex)
-        timestep = int(row.timestep)
-        Z = int(row.Z)
-        ion_stage = int(row.ion_stage)
+    arr_level = dfpop['level'].values
+    arr_newlevel = arr_level.copy()
 
-        ionlevels = at.get_levels(modelpath).query('Z == @Z and ion_stage == @ion_stage').iloc[0].levels
+    # the superlevel number is one more than the highest level of its (cell, timestep, ion) group
+    arr_levelnumber_sl = dfpop.groupby(
+        ['modelgridindex', 'timestep', 'Z', 'ion_stage'], sort=False)['level'].transform('max').values + 1
 
-        gs_g = ionlevels.iloc[0].g
-        gs_energy = ionlevels.iloc[0].energy_ev
+    ltepops = {
+        columnname: (dfpop[columnname].values.astype(float) if columnname in dfpop.columns
+                     else np.full(len(dfpop), np.nan))
+        for columnname, _ in columntemperature_tuples}
 
-        gs_pop = dfpop.query(
-            'modelgridindex == @modelgridindex and timestep == @timestep '
-            'and Z == @Z and ion_stage == @ion_stage and level == 0').iloc[0]['n_NLTE']
+    for (Z, ion_stage), rowindicies in dfpop.groupby(['Z', 'ion_stage'], sort=False).indices.items():
+        Z, ion_stage = int(Z), int(ion_stage)
+        level_energies = adata.level_energies_ev(Z, ion_stage)
+        level_g = adata.level_g(Z, ion_stage)
 
-        masksuperlevel = (
-            (dfpop['modelgridindex'] == modelgridindex) & (dfpop['timestep'] == timestep)
-            & (dfpop['Z'] == Z) & (dfpop['ion_stage'] == ion_stage) & (dfpop['level'] == -1))
-
-        masknotsuperlevel = (
-            (dfpop['modelgridindex'] == modelgridindex) & (dfpop['timestep'] == timestep)
-            & (dfpop['Z'] == Z) & (dfpop['ion_stage'] == ion_stage) & (dfpop['level'] != -1))
-
-        def f_ltepop(x, T_exc, gsg, gse, ionlevels):
-            return (ionlevels.iloc[int(x.level)].g / gsg
-                    * math.exp(- (ionlevels.iloc[int(x.level)].energy_ev - gse) / k_b / T_exc))
+        rows_notsuperlevel = rowindicies[arr_level[rowindicies] != -1]
+        rows_superlevel = rowindicies[arr_level[rowindicies] == -1]
+        rows_superlevel_lte = rows_superlevel[
+            (maxlevel < 0) | (arr_levelnumber_sl[rows_superlevel] <= maxlevel)]
 
         for columnname, T_exc in columntemperature_tuples:
-            dfpop.loc[masknotsuperlevel, columnname] = dfpop.loc[masknotsuperlevel].apply(
-                f_ltepop, args=(T_exc, gs_g, gs_energy, ionlevels), axis=1)
+            boltzmann = level_g / level_g[0] * np.exp(- (level_energies - level_energies[0]) / k_b / T_exc)
+            ltepops[columnname][rows_notsuperlevel] = boltzmann[arr_level[rows_notsuperlevel]]
 
-        if not dfpop[masksuperlevel].empty:
-            levelnumber_sl = dfpop.query(
-                'modelgridindex == @modelgridindex and timestep == @timestep '
-                'and Z == @Z and ion_stage == @ion_stage').level.max() + 1
+            # the sum of the Boltzmann factors from each level number to the top level (and zero above the top)
+            boltzmann_tailsums = np.append(np.cumsum(boltzmann[::-1])[::-1], 0.)
+            ltepops[columnname][rows_superlevel_lte] = boltzmann_tailsums[
+                np.minimum(arr_levelnumber_sl[rows_superlevel_lte], len(boltzmann))]
 
-            if maxlevel < 0 or levelnumber_sl <= maxlevel:
-                if not noprint:
-                    print(f'{at.elsymbols[Z]} {at.roman_numerals[ion_stage]} '
-                          f'has a superlevel at level {levelnumber_sl}')
+        if not noprint:
+            for levelnumber_sl in arr_levelnumber_sl[rows_superlevel_lte]:
+                print(f'{at.elsymbols[Z]} {at.roman_numerals[ion_stage]} '
+                      f'has a superlevel at level {levelnumber_sl}')
 
-                for columnname, T_exc in columntemperature_tuples:
-                    dfpop.loc[masksuperlevel, columnname] = ionlevels.iloc[levelnumber_sl:].eval(
-                        'g / @gs_g * exp(- (energy_ev - @gs_energy) / @k_b / @T_exc)').sum()
+        arr_newlevel[rows_superlevel] = arr_levelnumber_sl[rows_superlevel] + 2
 
-            dfpop.loc[masksuperlevel, 'level'] = levelnumber_sl + 2
+    for columnname, _ in columntemperature_tuples:
+        dfpop[columnname] = ltepops[columnname]
+    dfpop['level'] = arr_newlevel
 
     return dfpop
 
 
-@at.diskcache(savegzipped=True)
 def read_file(nltefilepath):
     """Read NLTE populations from one file."""
 
@@ -155,8 +152,108 @@ def read_file(nltefilepath):
     return dfpop
 
 
-def read_file_filtered(nltefilepath, strquery=None, dfqueryvars=None):
-    dfpopfile = read_file(nltefilepath)
+def convert_nltefile(nltefilepath):
+    """Return a dict with one array per column of an NLTE file, with the rows partitioned by (timestep, Z).
+
+    The rows are sorted by timestep and then Z (keeping the file order within a partition) and the row numbers
+    in the file are kept. The partition_* arrays give the timestep, Z, and first row of each partition.
+    """
+    dfpop = read_file(Path(nltefilepath))
+    if dfpop.empty:
+        dfpop = pd.DataFrame({col: np.array([], dtype=np.int64) for col in ['timestep', 'Z']})
+
+    sortindex = np.lexsort((dfpop['Z'].values, dfpop['timestep'].values))
+    arr_timestep = dfpop['timestep'].values[sortindex]
+    arr_Z = dfpop['Z'].values[sortindex]
+    partitionstarts = np.flatnonzero(
+        np.concatenate([[True], (arr_timestep[1:] != arr_timestep[:-1]) | (arr_Z[1:] != arr_Z[:-1])]))[:len(sortindex)]
+
+    arrays = {
+        'columns': np.array([col.encode('utf-8') for col in dfpop.columns], dtype=np.bytes_),
+        'rownumber': sortindex.astype(np.int64),
+        'partition_timestep': arr_timestep[partitionstarts],
+        'partition_Z': arr_Z[partitionstarts],
+        'partition_start': np.append(partitionstarts, len(sortindex)).astype(np.int64),
+    }
+    for col in dfpop.columns:
+        arrays[f'column_{col}'] = np.ascontiguousarray(dfpop[col].values[sortindex])
+
+    return arrays
+
+
+@at.memcache
+def get_nltestore(nltefilepath):
+    """Return the columnar store of an NLTE file (see convert_nltefile) as a dict of arrays.
+
+    With the disk cache, the file is converted once and each column is memory-mapped, so a query only reads the
+    pages of the selected partitions and columns.
+    """
+    nltefilepath = Path(nltefilepath)
+    if not nltefilepath.is_file() and Path(str(nltefilepath) + '.gz').is_file():
+        nltefilepath = Path(str(nltefilepath) + '.gz')
+
+    if at.enable_diskcache and nltefilepath.is_file():
+        cachename = nltefilepath.name[:-len('.gz')] if nltefilepath.name.endswith('.gz') else nltefilepath.name
+        cachefolder = Path(at.get_diskcache_folders(nltefilepath.parent)[0], f'nltestore-{cachename}')
+        try:
+            return at.get_cached_arrays(cachefolder, nltefilepath, convert_nltefile)
+        except OSError as ex:
+            print(f'Could not use the binary NLTE cache (Error: {ex}). Reading text file instead')
+
+    return convert_nltefile(nltefilepath)
+
+
+def query_nltestore(nltestore, timesteps=None, modelgridindices=None, atomic_numbers=None, ion_stages=None,
+                    levels=None, columns=None):
+    """Return a DataFrame of the rows of an NLTE store that match the selections (None selects all values).
+
+    Only the (timestep, Z) partitions that can match are sliced from the store, the other selections are
+    applied to those rows, and only the requested columns are read. The rows and index are in file order,
+    as with a query on the DataFrame of the whole file.
+    """
+    allcolumns = [col.decode('utf-8') for col in nltestore['columns'].tolist()]
+    if columns is None:
+        columns = allcolumns
+    else:
+        columns = [col for col in allcolumns if col in columns]
+
+    partitionmask = np.ones(len(nltestore['partition_timestep']), dtype=bool)
+    if timesteps is not None:
+        partitionmask &= np.isin(nltestore['partition_timestep'], list(timesteps))
+    if atomic_numbers is not None:
+        partitionmask &= np.isin(nltestore['partition_Z'], list(atomic_numbers))
+
+    partitions = np.flatnonzero(partitionmask)
+    partitionslices = [slice(nltestore['partition_start'][partition], nltestore['partition_start'][partition + 1])
+                       for partition in partitions]
+
+    def get_column(name):
+        if not partitionslices:
+            return np.array([], dtype=nltestore[name].dtype)
+        return np.concatenate([nltestore[name][partitionslice] for partitionslice in partitionslices])
+
+    rowmask = None
+    for col, values in [('modelgridindex', modelgridindices), ('ion_stage', ion_stages), ('level', levels)]:
+        if values is not None and col in allcolumns:
+            colmask = np.isin(get_column(f'column_{col}'), list(values))
+            rowmask = colmask if rowmask is None else rowmask & colmask
+
+    def get_selected_column(name):
+        return get_column(name) if rowmask is None else get_column(name)[rowmask]
+
+    # back to the order of the rows in the file
+    rownumbers = get_selected_column('rownumber')
+    fileorder = np.argsort(rownumbers, kind='stable')
+
+    return pd.DataFrame({col: get_selected_column(f'column_{col}')[fileorder] for col in columns},
+                        index=rownumbers[fileorder], columns=columns)
+
+
+def read_file_filtered(nltefilepath, strquery=None, dfqueryvars=None, timesteps=None, modelgridindices=None,
+                       atomic_numbers=None, ion_stages=None, levels=None, columns=None):
+    dfpopfile = query_nltestore(
+        get_nltestore(nltefilepath), timesteps=timesteps, modelgridindices=modelgridindices,
+        atomic_numbers=atomic_numbers, ion_stages=ion_stages, levels=levels, columns=columns)
 
     if strquery:
         dfpopfile.query(strquery, local_dict=dfqueryvars, inplace=True)
@@ -164,44 +261,56 @@ def read_file_filtered(nltefilepath, strquery=None, dfqueryvars=None):
     return dfpopfile
 
 
-@lru_cache(maxsize=2)
-@at.diskcache(savegzipped=True, funcversion="2020-07-03.1327", saveonly=False)
-def read_files(modelpath, timestep=-1, modelgridindex=-1, dfquery=None, dfqueryvars={}):
-    """Read in NLTE populations from a model for a particular timestep and grid cell."""
+def get_selection_list(value):
+    """Return None for no selection, or a list of selected values from a single value or a sequence."""
+    if value is None:
+        return None
+    if np.ndim(value) == 0:
+        return [value]
+    return list(value)
+
+
+@at.memcache
+def read_files(modelpath, timestep=-1, modelgridindex=-1, dfquery=None, dfqueryvars={},
+               atomic_number=None, ion_stage=None, level=None, columns=None):
+    """Read in NLTE populations from a model for a particular timestep and grid cell.
+
+    The timestep, modelgridindex, atomic_number (Z), ion_stage, and level selections (a value or a list of values)
+    and the columns are applied while reading the columnar NLTE store. dfquery is applied to the selected rows.
+    A timestep or modelgridindex of -1 selects all of them. With lists of timesteps and cells, each of the
+    files of the matching run folders and MPI ranks is read once for all of them.
+    """
+    timesteps, modelgridindices = at.get_timestep_cell_selection(timestep, modelgridindex)
 
     mpiranklist = at.get_mpiranklist(modelpath, modelgridindex=modelgridindex)
 
     dfpop = pd.DataFrame()
 
+    if np.ndim(timestep) == 0:
+        runfolders = at.get_runfolders(modelpath, timestep=timestep)
+    else:
+        runfolders = at.get_runfolders(modelpath, timesteps=timesteps)
+
     nltefilepaths = [Path(folderpath, f'nlte_{mpirank:04d}.out')
-                     for folderpath in at.get_runfolders(modelpath, timestep=timestep) for mpirank in mpiranklist]
+                     for folderpath in runfolders for mpirank in mpiranklist]
 
     dfqueryvars['modelgridindex'] = modelgridindex
     dfqueryvars['timestep'] = timestep
 
-    dfquery_full = ''
-    if timestep >= 0:
-        dfquery_full = 'timestep==@timestep'
-
-    if modelgridindex >= 0:
-        if dfquery_full:
-            dfquery_full += ' and '
-        dfquery_full += 'modelgridindex==@modelgridindex'
-
-    if dfquery:
-        if dfquery_full:
-            dfquery_full = f'({dfquery_full}) and '
-        dfquery_full += f'({dfquery})'
+    readfile = partial(
+        read_file_filtered, strquery=dfquery, dfqueryvars=dfqueryvars,
+        timesteps=timesteps, modelgridindices=modelgridindices,
+        atomic_numbers=get_selection_list(atomic_number), ion_stages=get_selection_list(ion_stage),
+        levels=get_selection_list(level), columns=get_selection_list(columns))
 
     if at.num_processes > 1:
         with multiprocessing.Pool(processes=at.num_processes) as pool:
-            arr_dfnltepop = pool.map(partial(read_file_filtered, strquery=dfquery_full, dfqueryvars=dfqueryvars),
-                                     nltefilepaths)
+            arr_dfnltepop = pool.map(readfile, nltefilepaths)
             pool.close()
             pool.join()
             pool.terminate()
     else:
-        arr_dfnltepop = [read_file_filtered(f, strquery=dfquery_full, dfqueryvars=dfqueryvars) for f in nltefilepaths]
+        arr_dfnltepop = [readfile(f) for f in nltefilepaths]
 
     dfpop = pd.concat(arr_dfnltepop).copy()
 
@@ -448,15 +557,20 @@ def make_plot_levelpop_over_time(modelpaths, args):
         populations = {}
         populationsLTE = {}
 
+        # the level populations at all timesteps from one read
+        dfpop = read_files(modelpath, timestep=tuple(timesteps), modelgridindex=modelgridindex,
+                           atomic_number=Z, ion_stage=ionstage, level=tuple(ionlevels))
+        if 'level' in dfpop:
+            levelpops = {(timestep, level): n_NLTE for timestep, level, n_NLTE in zip(
+                dfpop['timestep'].values, dfpop['level'].values, dfpop['n_NLTE'].values)}
+        else:
+            levelpops = {}
+
         for timestep in timesteps:
-            dfpop = read_files(modelpath, timestep=timestep, modelgridindex=modelgridindex)
-            try:
-                timesteppops = dfpop.loc[(dfpop['Z'] == Z) & (dfpop['ion_stage'] == ionstage)]
-            except KeyError:
+            if not any((timestep, ionlevel) in levelpops for ionlevel in ionlevels):
                 continue
             for ionlevel in ionlevels:
-                populations[(timestep, ionlevel)] = (timesteppops.loc[timesteppops['level']
-                                                                      == ionlevel]['n_NLTE'].values[0])
+                populations[(timestep, ionlevel)] = levelpops[(timestep, ionlevel)]
                 # populationsLTE[(timestep, ionlevel)] = (timesteppops.loc[timesteppops['level']
                 #                                                          == ionlevel]['n_LTE'].values[0])
 
@@ -493,19 +607,17 @@ def make_plot_levelpop_over_time(modelpaths, args):
 def make_plot(modelpath, atomic_number, ionstages_displayed, mgilist, timestep, args):
     """Plot level populations for chosens ions of an element in a cell and timestep of an ARTIS model."""
     modelname = at.get_model_name(modelpath)
-    adata = at.get_levels(modelpath, get_transitions=args.gettransitions)
+    adata = at.atomicdata.get_atomicdata(modelpath, get_transitions=args.gettransitions)
 
     time_days = float(at.get_timestep_time(modelpath, timestep))
     modelname = at.get_model_name(modelpath)
 
-    dfpop = read_files(modelpath, timestep=timestep, modelgridindex=mgilist[0]).copy()
+    dfpop = read_files(modelpath, timestep=timestep, modelgridindex=mgilist[0], atomic_number=atomic_number).copy()
 
     if dfpop.empty:
         print(f'No NLTE population data for modelgrid cell {mgilist[0]} timestep {timestep}')
         return
 
-    dfpop.query('Z == @atomic_number', inplace=True)
-
     # top_ion = 9999
     max_ion_stage = dfpop.ion_stage.max()
 
@@ -554,14 +666,13 @@ def make_plot(modelpath, atomic_number, ionstages_displayed, mgilist, timestep,
             T_e = args.exc_temperature
             T_R = args.exc_temperature
 
-        dfpop = read_files(modelpath, timestep=timestep, modelgridindex=modelgridindex).copy()
+        dfpop = read_files(
+            modelpath, timestep=timestep, modelgridindex=modelgridindex, atomic_number=atomic_number).copy()
 
         if dfpop.empty:
             print(f'No NLTE population data for modelgrid cell {modelgridindex} timestep {timestep}')
             return
 
-        dfpop.query('Z == @atomic_number', inplace=True)
-
         # top_ion = 9999
         max_ion_stage = dfpop.ion_stage.max()
 
@@ -591,7 +702,7 @@ def make_plot(modelpath, atomic_number, ionstages_displayed, mgilist, timestep,
             axes[mgifirstaxindex].set_title(subplot_title, fontsize=10)
 
         for ax, ion_stage in zip(axes[mgifirstaxindex:mgilastaxindex + 1], ion_stage_list):
-            ion_data = adata.query('Z == @atomic_number and ion_stage == @ion_stage').iloc[0]
+            ion_data = adata.ion(atomic_number, ion_stage)
             lastsubplot = modelgridindex == mgilist[-1] and ion_stage == ion_stage_list[-1]
             make_ionsubplot(ax, modelpath, atomic_number, ion_stage, dfpop, ion_data, estimators,
                             T_e, T_R, modelgridindex, timestep, args, lastsubplot=lastsubplot)
@@ -6,7 +6,6 @@ import math
 import multiprocessing
 import os
 from collections import namedtuple
-from functools import lru_cache
 from pathlib import Path
 
 import matplotlib.pyplot as plt
@@ -22,13 +21,24 @@ DEFAULTSPECPATH = '../example_run/spec.out'
 defaultoutputfile = 'plotnonthermal_cell{0:03d}_timestep{1:03d}.pdf'
 
 
-@lru_cache(maxsize=4)
+@at.memcache
 def read_files(modelpath, timestep=-1, modelgridindex=-1):
-    """Read ARTIS -thermal spectrum data into a pandas DataFrame."""
-    nonthermaldata = pd.DataFrame()
+    """Read ARTIS -thermal spectrum data into a pandas DataFrame.
 
+    The timestep and modelgridindex can be a value or a list of values (-1 for all). Only the files of the MPI ranks
+    that hold the selected cells are read (in parallel), and rows of other timesteps and cells are skipped while
+    parsing.
+    """
+    timesteps, modelgridindices = at.get_timestep_cell_selection(timestep, modelgridindex)
     mpiranklist = at.get_mpiranklist(modelpath, modelgridindex=modelgridindex)
-    for folderpath in at.get_runfolders(modelpath, timestep=timestep):
+
+    if np.ndim(timestep) == 0:
+        runfolders = at.get_runfolders(modelpath, timestep=timestep)
+    else:
+        runfolders = at.get_runfolders(modelpath, timesteps=timesteps)
+
+    nonthermalfilepaths = []
+    for folderpath in runfolders:
         for mpirank in mpiranklist:
             nonthermalfile = f'nonthermalspec_{mpirank:04d}.out'
             filepath = Path(folderpath, nonthermalfile)
@@ -38,26 +48,14 @@ def read_files(modelpath, timestep=-1, modelgridindex=-1):
                     print(f'Warning: Could not find {filepath.relative_to(modelpath.parent)}')
                     continue
 
-            if modelgridindex > -1:
+            if modelgridindices is not None:
                 filesize = Path(filepath).stat().st_size / 1024 / 1024
                 print(f'Reading {Path(filepath).relative_to(modelpath.parent)} ({filesize:.2f} MiB)')
 
-            nonthermaldata_thisfile = pd.read_csv(filepath, delim_whitespace=True, error_bad_lines=False)
-            # radfielddata_thisfile[['modelgridindex', 'timestep']].apply(pd.to_numeric)
-
-            if timestep >= 0:
-                nonthermaldata_thisfile.query('timestep==@timestep', inplace=True)
-
-            if modelgridindex >= 0:
-                nonthermaldata_thisfile.query('modelgridindex==@modelgridindex', inplace=True)
-
-            if not nonthermaldata_thisfile.empty:
-                if timestep >= 0 and modelgridindex >= 0:
-                    return nonthermaldata_thisfile
-                else:
-                    nonthermaldata = nonthermaldata.append(nonthermaldata_thisfile.copy(), ignore_index=True)
+            nonthermalfilepaths.append(filepath)
 
-    return nonthermaldata
+    return at.read_rankfiles(
+        nonthermalfilepaths, timesteps=timesteps, modelgridindices=modelgridindices, on_bad_lines='skip')
 
 
 def ar_xs(energy_ev, ionpot_ev, A, B, C, D):
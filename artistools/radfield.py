@@ -4,14 +4,15 @@ import argparse
 import math
 import multiprocessing
 import os
-# import re
+import re
 import sys
+from collections import namedtuple
+from functools import partial
+from itertools import chain
 
 from astropy import constants as const
 from astropy import units as u
-from functools import lru_cache
 from pathlib import Path
-# from itertools import chain
 
 import numpy as np
 import pandas as pd
@@ -20,6 +21,7 @@ import matplotlib.ticker as ticker
 # import matplotlib.patches as mpatches
 
 import artistools as at
+import artistools.atomicdata
 import artistools.spectra
 import artistools.estimators
 import artistools.nltepops
@@ -33,39 +35,36 @@ TWOOVERCLIGHTSQUARED = 2.2253001e-21
 SAHACONST = 2.0706659e-16
 
 
-@lru_cache(maxsize=4)
+@at.memcache
 def read_files(modelpath, timestep=-1, modelgridindex=-1):
-    """Read radiation field data from a list of file paths into a pandas DataFrame."""
-    radfielddata = pd.DataFrame()
+    """Read radiation field data from a list of file paths into a pandas DataFrame.
 
+    The timestep and modelgridindex can be a value or a list of values (-1 for all). Only the files of the MPI ranks
+    that hold the selected cells are read (in parallel), and rows of other timesteps and cells are skipped while
+    parsing.
+    """
+    timesteps, modelgridindices = at.get_timestep_cell_selection(timestep, modelgridindex)
     mpiranklist = at.get_mpiranklist(modelpath, modelgridindex=modelgridindex)
-    for folderpath in at.get_runfolders(modelpath, timestep=timestep):
+
+    if np.ndim(timestep) == 0:
+        runfolders = at.get_runfolders(modelpath, timestep=timestep)
+    else:
+        runfolders = at.get_runfolders(modelpath, timesteps=timesteps)
+
+    radfieldfilepaths = []
+    for folderpath in runfolders:
         for mpirank in mpiranklist:
             radfieldfilename = f'radfield_{mpirank:04d}.out'
-            radfieldfilepath = Path(folderpath, radfieldfilename)
             radfieldfilepath = at.firstexisting(
                 [radfieldfilename + '.xz', radfieldfilename + '.gz', radfieldfilename], path=folderpath)
 
-            if modelgridindex > -1:
+            if modelgridindices is not None:
                 filesize = Path(radfieldfilepath).stat().st_size / 1024 / 1024
                 print(f'Reading {Path(radfieldfilepath).relative_to(modelpath.parent)} ({filesize:.2f} MiB)')
 
-            radfielddata_thisfile = pd.read_csv(radfieldfilepath, delim_whitespace=True)
-            # radfielddata_thisfile[['modelgridindex', 'timestep']].apply(pd.to_numeric)
-
-            if timestep >= 0:
-                radfielddata_thisfile.query('timestep==@timestep', inplace=True)
-
-            if modelgridindex >= 0:
-                radfielddata_thisfile.query('modelgridindex==@modelgridindex', inplace=True)
+            radfieldfilepaths.append(radfieldfilepath)
 
-            if not radfielddata_thisfile.empty:
-                if timestep >= 0 and modelgridindex >= 0:
-                    return radfielddata_thisfile
-                else:
-                    radfielddata = radfielddata.append(radfielddata_thisfile.copy(), ignore_index=True)
-
-    return radfielddata
+    return at.read_rankfiles(radfieldfilepaths, timesteps=timesteps, modelgridindices=modelgridindices)
 
 
 def select_bin(radfielddata, nu=None, lambda_angstroms=None, modelgridindex=None, timestep=None):
@@ -110,17 +109,14 @@ def get_binaverage_field(axis, radfielddata, modelgridindex=None, timestep=None)
 
 
 def j_nu_dbb(arr_nu_hz, W, T):
-    """# CGS units J_nu for dilute blackbody."""
-    k_b = const.k_B.to('eV/K').value
-    h = const.h.to('eV s').value
+    """# CGS units J_nu for dilute blackbody.
 
-    if W > 0.:
-        try:
-            return [W * 1.4745007e-47 * pow(nu_hz, 3) * 1.0 / (math.expm1(h * nu_hz / T / k_b)) for nu_hz in arr_nu_hz]
-        except OverflowError:
-            return 0.
+    W and T can be values or arrays that broadcast with arr_nu_hz. J_nu is zero where W or T is not positive.
+    """
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        arr_j_nu = W * 1.4745007e-47 * np.power(arr_nu_hz, 3) / np.expm1(HOVERKB * arr_nu_hz / T)
 
-    return [0. for _ in arr_nu_hz]
+    return np.where((W > 0.) & (T > 0.) & np.isfinite(arr_j_nu), arr_j_nu, 0.)
 
 
 def get_fullspecfittedfield(radfielddata, xmin, xmax, modelgridindex=None, timestep=None):
@@ -141,9 +137,6 @@ def get_fullspecfittedfield(radfielddata, xmin, xmax, modelgridindex=None, times
 
 def get_fitted_field(radfielddata, modelgridindex=None, timestep=None, print_bins=False, lambdamin=None, lambdamax=None):
     """Return the fitted dilute blackbody made up of all bins."""
-    arr_lambda = []
-    j_lambda_fitted = []
-
     radfielddata_subset = radfielddata.copy().query(
         'bin_num >= 0' +
         (' & modelgridindex==@modelgridindex' if modelgridindex else '') +
@@ -155,40 +148,37 @@ def get_fitted_field(radfielddata, modelgridindex=None, timestep=None, print_bin
     if lambdamax is not None:
         nu_max = const.c.to('angstrom/s').value / lambdamin
 
-    for _, row in radfielddata_subset.iterrows():
-        nu_lower = row['nu_lower']
-        nu_upper = row['nu_upper']
-
-        if lambdamax is not None:
-            if nu_upper > nu_max:
-                continue
-            nu_lower = max(nu_lower, nu_min)
-        if lambdamin is not None:
-            if nu_lower < nu_min:
-                continue
-            nu_upper = min(nu_upper, nu_max)
-
-        if row['W'] >= 0:
-            arr_nu_hz_bin = np.linspace(nu_lower, nu_upper, num=200)
-            arr_j_nu = j_nu_dbb(arr_nu_hz_bin, row['W'], row['T_R'])
-
-            arr_lambda_bin = const.c.to('angstrom/s').value / arr_nu_hz_bin
-            arr_j_lambda_bin = arr_j_nu * arr_nu_hz_bin / arr_lambda_bin
+    arr_nu_lower = radfielddata_subset['nu_lower'].values
+    arr_nu_upper = radfielddata_subset['nu_upper'].values
+    binincluded = np.ones(len(radfielddata_subset), dtype=bool)
 
-            arr_lambda += list(arr_lambda_bin)
-            j_lambda_fitted += list(arr_j_lambda_bin)
-        else:
-            arr_nu_hz_bin = [nu_lower, nu_upper]
-            arr_j_lambda_bin = [0., 0.]
-
-            arr_lambda += [const.c.to('angstrom/s').value / nu for nu in arr_nu_hz_bin]
-            j_lambda_fitted += arr_j_lambda_bin
-
-        lambda_lower = const.c.to('angstrom/s').value / row['nu_upper']
-        lambda_upper = const.c.to('angstrom/s').value / row['nu_lower']
-        if print_bins and (lambdamax is None or lambda_lower < lambdamax) and (lambdamin is None or lambda_upper > lambdamin):
-            print(f"Bin lambda_lower {lambda_lower:.1f} W {row['W']:.1e} "
-                  f"contribs {row['ncontrib']} J_nu_avg {row['J_nu_avg']:.1e}")
+    if lambdamax is not None:
+        binincluded &= ~(arr_nu_upper > nu_max)
+        arr_nu_lower = np.maximum(arr_nu_lower, nu_min)
+    if lambdamin is not None:
+        binincluded &= ~(arr_nu_lower < nu_min)
+        arr_nu_upper = np.minimum(arr_nu_upper, nu_max)
+
+    # a (bin × point) frequency grid. Bins without a fit (W < 0) keep only their end points with zero J.
+    arr_W = radfielddata_subset['W'].values[binincluded, np.newaxis]
+    arr_T_R = radfielddata_subset['T_R'].values[binincluded, np.newaxis]
+    arr_nu_hz_bins = np.linspace(arr_nu_lower[binincluded], arr_nu_upper[binincluded], num=200, axis=1)
+    arr_j_nu_bins = j_nu_dbb(arr_nu_hz_bins, arr_W, arr_T_R)
+
+    pointincluded = np.ones_like(arr_nu_hz_bins, dtype=bool)
+    pointincluded[(arr_W < 0).ravel(), 1:-1] = False
+
+    arr_lambda_bins = const.c.to('angstrom/s').value / arr_nu_hz_bins
+    arr_lambda = arr_lambda_bins[pointincluded]
+    j_lambda_fitted = (arr_j_nu_bins * arr_nu_hz_bins / arr_lambda_bins)[pointincluded]
+
+    if print_bins:
+        for _, row in radfielddata_subset[binincluded].iterrows():
+            lambda_lower = const.c.to('angstrom/s').value / row['nu_upper']
+            lambda_upper = const.c.to('angstrom/s').value / row['nu_lower']
+            if (lambdamax is None or lambda_lower < lambdamax) and (lambdamin is None or lambda_upper > lambdamin):
+                print(f"Bin lambda_lower {lambda_lower:.1f} W {row['W']:.1e} "
+                      f"contribs {row['ncontrib']} J_nu_avg {row['J_nu_avg']:.1e}")
 
     return arr_lambda, j_lambda_fitted
 
@@ -237,73 +227,126 @@ def plot_specout(axis, specfilename, timestep, peak_value=None, scale_factor=Non
     dfspectrum.plot(x='lambda_angstroms', y='f_lambda', ax=axis, label=label, **plotkwargs)
 
 
-@lru_cache(maxsize=128)
+def interpolate_phixs(xgrid, sigmatable, nu_factor):
+    """Return the cross sections at each nu_factor (nu / nu_threshold) for a 2D array of tables on a common grid.
+
+    Row i of nu_factor is evaluated with the table in row i of sigmatable. The cross section is zero below the
+    start of the table and is extrapolated as nu^-3 beyond the end.
+    """
+    xindex = np.clip(np.searchsorted(xgrid, nu_factor, side='right') - 1, 0, len(xgrid) - 2)
+    rowindex = np.arange(sigmatable.shape[0])[:, np.newaxis]
+    sigma_left = sigmatable[rowindex, xindex]
+    sigma_right = sigmatable[rowindex, xindex + 1]
+
+    arr_sigma_bf = sigma_left + (sigma_right - sigma_left) * (
+        (nu_factor - xgrid[xindex]) / (xgrid[xindex + 1] - xgrid[xindex]))
+
+    arr_sigma_bf = np.where(nu_factor < xgrid[0], 0., arr_sigma_bf)
+    arr_sigma_bf = np.where(
+        nu_factor > xgrid[-1], sigmatable[:, -1:] * np.power(xgrid[-1] / nu_factor, 3), arr_sigma_bf)
+
+    return arr_sigma_bf
+
+
 def evaluate_phixs(modelpath, atomic_number, lower_ion_stage, lowerlevelindex, nu_threshold, arr_nu_hz):
-    adata = at.get_levels(modelpath, get_photoionisations=True)
-    lower_ion_data = adata.query('Z == @atomic_number and ion_stage == @lower_ion_stage').iloc[0]
-    lowerlevel = lower_ion_data.levels.iloc[lowerlevelindex]
+    adata = at.atomicdata.get_atomicdata(modelpath, get_photoionisations=True)
+    lowerlevel = adata.levels(atomic_number, lower_ion_stage).iloc[lowerlevelindex]
 
-    from scipy.interpolate import interp1d
     phixstable = lowerlevel.phixstable
-    interp_sigma_bf = interp1d(
-        phixstable[:, 0] * nu_threshold, phixstable[:, 1], kind='linear', bounds_error=True,
-        fill_value=0., assume_sorted=True)
+    nu_factor = np.asarray(arr_nu_hz, dtype=np.float64)[np.newaxis, :] / nu_threshold
+
+    return interpolate_phixs(phixstable[:, 0], phixstable[np.newaxis, :, 1], nu_factor)[0]
+
+
+phixsmatrixtuple = namedtuple('phixsmatrixtuple', [
+    'atomic_number', 'lower_ion_stage', 'lowerlevel', 'upperlevel', 'phixsfrac', 'nu_threshold', 'xgrid', 'sigmatable'])
+
+
+@at.memcache
+def get_phixs_matrix(modelpath, ionlist, max_levels=None):
+    """Return the photoionisation cross section tables for all ions in ionlist as one matrix.
+
+    ionlist is a tuple of (atomic_number, lower_ion_stage). Each row is a photoionisation from one of the first
+    max_levels levels of the lower ion to a target level of the upper ion, with its threshold frequency and the
+    cross section table (multiplied by the target fraction) on the common grid xgrid of nu / nu_threshold.
+    """
+    adata = at.atomicdata.get_atomicdata(modelpath, get_photoionisations=True)
+
+    rowlists = {field: [] for field in phixsmatrixtuple._fields if field not in ['xgrid', 'sigmatable']}
+    sigmarows = []
+    xgrid = np.array([1., 2.])
+    for atomic_number, lower_ion_stage in ionlist:
+        ion_data = adata.ion(atomic_number, lower_ion_stage)
+        upperlevel_energies_ev = adata.level_energies_ev(atomic_number, lower_ion_stage + 1)
+
+        for levelnum, lowerlevel in enumerate(ion_data.levels[:max_levels].itertuples(index=False)):
+            for upperlevelnum, phixsfrac in lowerlevel.phixstargetlist:
+                rowlists['atomic_number'].append(atomic_number)
+                rowlists['lower_ion_stage'].append(lower_ion_stage)
+                rowlists['lowerlevel'].append(levelnum)
+                rowlists['upperlevel'].append(upperlevelnum)
+                rowlists['phixsfrac'].append(phixsfrac)
+                rowlists['nu_threshold'].append(ONEOVERH * (
+                    ion_data.ion_pot - lowerlevel.energy_ev + upperlevel_energies_ev[upperlevelnum]) * EV)
+                xgrid = lowerlevel.phixstable[:, 0]
+                sigmarows.append(lowerlevel.phixstable[:, 1] * phixsfrac)
+
+    return phixsmatrixtuple(
+        **{field: np.array(values, dtype=np.float64 if field in ['phixsfrac', 'nu_threshold'] else np.int64)
+           for field, values in rowlists.items()},
+        xgrid=np.array(xgrid, dtype=np.float64),
+        sigmatable=np.array(sigmarows, dtype=np.float64).reshape(len(sigmarows), len(xgrid)))
 
-    def sigma_bf(nu):
-        nu_factor = nu / nu_threshold
-        if nu_factor < phixstable[0, 0]:
-            return 0.
-        elif nu_factor > phixstable[-1, 0]:
-            # return 0.
-            return phixstable[-1, 1] * math.pow(phixstable[-1, 0] / nu_factor, 3)
 
-        # return np.interp(nu_factor, phixstable[:, 0], phixstable[:, 1], left=0.)
-        return interp_sigma_bf(nu)
+def evaluate_phixs_matrix(phixsmatrix, arr_nu_hz):
+    """Return the bound-free cross sections [cm^2] with a row for each row of phixsmatrix and a column per frequency.
 
-    return np.array([sigma_bf(nu) for nu in arr_nu_hz])
+    arr_nu_hz is either a frequency grid shared by all rows, or a 2D array with a frequency grid for each row.
+    """
+    arr_nu_hz = np.asarray(arr_nu_hz, dtype=np.float64)
+    nu_factor = np.atleast_2d(arr_nu_hz) / phixsmatrix.nu_threshold[:, np.newaxis]
+
+    if len(phixsmatrix.nu_threshold) == 0:
+        return np.zeros((0, arr_nu_hz.shape[-1]))
+
+    return interpolate_phixs(phixsmatrix.xgrid, phixsmatrix.sigmatable, nu_factor)
+
+
+def get_levelpopfracs_lte(adata, atomic_number, ion_stage, T_e, max_levels):
+    """Return the LTE fraction of the ion population in each of the first max_levels levels."""
+    levelpopfactors = (
+        adata.level_g(atomic_number, ion_stage)[:max_levels] *
+        np.exp(-adata.level_energies_ev(atomic_number, ion_stage)[:max_levels] * EV / KB / T_e))
+
+    return levelpopfactors / levelpopfactors.sum()
 
 
 def get_kappa_bf_ion(
         atomic_number, lower_ion_stage, modelgridindex, timestep, modelpath, arr_nu_hz, max_levels):
-    adata = at.get_levels(modelpath, get_photoionisations=True)
+    adata = at.atomicdata.get_atomicdata(modelpath, get_photoionisations=True)
     estimators = at.estimators.read_estimators(modelpath, timestep=timestep, modelgridindex=modelgridindex)
     T_e = estimators[(timestep, modelgridindex)]['Te']
 
-    ion_data = adata.query('Z == @atomic_number and ion_stage == @lower_ion_stage').iloc[0]
-    upper_ion_data = adata.query('Z == @atomic_number and ion_stage == (@lower_ion_stage + 1)').iloc[0]
-
     lowerionpopdensity = estimators[(timestep, modelgridindex)]['populations'][(atomic_number, lower_ion_stage)]
 
-    ion_popfactor_sum = 0
-    for _, level in ion_data.levels[:max_levels].iterrows():
-        ion_popfactor_sum += level.g * math.exp(-level.energy_ev * EV / KB / T_e)
-
-    array_kappa_bf_nu_ion = np.zeros_like(arr_nu_hz)
-    for levelnum, lowerlevel in ion_data.levels[:max_levels].iterrows():
-        levelpopfrac = lowerlevel.g * math.exp(-lowerlevel.energy_ev * EV / KB / T_e) / ion_popfactor_sum
-
-        for upperlevelnum, phixsfrac in lowerlevel.phixstargetlist:
-            upperlevel = upper_ion_data.levels.iloc[upperlevelnum]
+    levelpopfracs = get_levelpopfracs_lte(adata, atomic_number, lower_ion_stage, T_e, max_levels)
 
-            nu_threshold = ONEOVERH * (ion_data.ion_pot - lowerlevel.energy_ev + upperlevel.energy_ev) * EV
+    phixsmatrix = get_phixs_matrix(modelpath, ((atomic_number, lower_ion_stage),), max_levels)
+    arr_sigma_bf = evaluate_phixs_matrix(phixsmatrix, arr_nu_hz)
 
-            arr_sigma_bf = evaluate_phixs(modelpath, atomic_number, lower_ion_stage, levelnum,
-                                          nu_threshold, tuple(arr_nu_hz)) * phixsfrac
-
-            array_kappa_bf_nu_ion += arr_sigma_bf * levelpopfrac * lowerionpopdensity
+    array_kappa_bf_nu_ion = levelpopfracs[phixsmatrix.lowerlevel].dot(arr_sigma_bf) * lowerionpopdensity
 
     return array_kappa_bf_nu_ion
 
 
 def get_recombination_emission(
         atomic_number, upper_ion_stage, arr_nu_hz, modelgridindex, timestep, modelpath, max_levels, use_lte_pops=False):
-    adata = at.get_levels(modelpath, get_photoionisations=True)
+    adata = at.atomicdata.get_atomicdata(modelpath, get_photoionisations=True)
 
     lower_ion_stage = upper_ion_stage - 1
     upperionstr = at.get_ionstring(atomic_number, upper_ion_stage)
     lowerionstr = at.get_ionstring(atomic_number, lower_ion_stage)
-    upper_ion_data = adata.query('Z == @atomic_number and ion_stage == @upper_ion_stage').iloc[0]
-    lower_ion_data = adata.query('Z == @atomic_number and ion_stage == @lower_ion_stage').iloc[0]
+    lower_ion_data = adata.ion(atomic_number, lower_ion_stage)
 
     estimators = at.estimators.read_estimators(modelpath, timestep=timestep, modelgridindex=modelgridindex)
 
@@ -314,65 +357,59 @@ def get_recombination_emission(
     upperionpopdensity = estimators[(timestep, modelgridindex)]['populations'][(atomic_number, upper_ion_stage)]
     print(f'Recombination from {upperionstr} -> {lowerionstr} ({upperionstr} pop = {upperionpopdensity:.1e}/cm3)')
 
+    phixsmatrix = get_phixs_matrix(modelpath, ((atomic_number, lower_ion_stage),), max_levels)
+    lowerlevel_g = adata.level_g(atomic_number, lower_ion_stage)[phixsmatrix.lowerlevel]
+    upperlevel_g = adata.level_g(atomic_number, upper_ion_stage)[phixsmatrix.upperlevel]
+
     if use_lte_pops:
-        upper_level_popfactor_sum = 0
-        for upperlevelnum, upperlevel in lower_ion_data.levels[:200].iterrows():
-            upper_level_popfactor_sum += upperlevel.g * math.exp(-upperlevel.energy_ev * EV / KB / T_e)
+        upper_level_popfactor_sum = np.sum(
+            adata.level_g(atomic_number, lower_ion_stage)[:200] *
+            np.exp(-adata.level_energies_ev(atomic_number, lower_ion_stage)[:200] * EV / KB / T_e))
+
+        levelpopfracs = upperlevel_g * np.exp(
+            -adata.level_energies_ev(atomic_number, upper_ion_stage)[phixsmatrix.upperlevel] * EV / KB / T_e
+        ) / upper_level_popfactor_sum
     else:
-        dfnltepops = at.nltepops.read_files(modelpath, modelgridindex=modelgridindex, timestep=timestep)
-        dfnltepops_upperion = dfnltepops.query('Z==@atomic_number & ion_stage==@upper_ion_stage')
+        dfnltepops_upperion = at.nltepops.read_files(
+            modelpath, modelgridindex=modelgridindex, timestep=timestep,
+            atomic_number=atomic_number, ion_stage=upper_ion_stage)
         upperion_nltepops = {x.level: x['n_NLTE'] for _, x in dfnltepops_upperion.iterrows()}
 
-    arr_j_nu_lowerlevel = {}
-    arr_alpha_dnu = np.zeros_like(arr_nu_hz)
-    alpha_ion2 = 0.
-    nnionfrac = 0.
-    for levelnum, lowerlevel in lower_ion_data.levels[:max_levels].iterrows():
-        for upperlevelnum, phixsfrac in lowerlevel.phixstargetlist:
-            upperlevel = upper_ion_data.levels.iloc[upperlevelnum]
-
-            if use_lte_pops:
-                levelpopfrac = (
-                    upperlevel.g * math.exp(-upperlevel.energy_ev * EV / KB / T_e) / upper_level_popfactor_sum)
-            elif len(upperion_nltepops) == 1:  # top ion has only one level
-                levelpopfrac = upperion_nltepops[0] / upperionpopdensity
-            else:
-                levelpopfrac = upperion_nltepops[upperlevelnum] / upperionpopdensity
-
-            nu_threshold = ONEOVERH * (lower_ion_data.ion_pot - lowerlevel.energy_ev + upperlevel.energy_ev) * EV
-
-            arr_sigma_bf = evaluate_phixs(modelpath, atomic_number, lower_ion_stage, levelnum,
-                                          nu_threshold, tuple(arr_nu_hz)) * phixsfrac
-
-            sfac = (SAHACONST * lowerlevel.g / upperlevel.g *
-                    math.pow(T_e, -1.5) * math.exp(HOVERKB * nu_threshold / T_e))
-
-            arr_alpha_level_dnu = 4. * math.pi * sfac * (
-                TWOOVERCLIGHTSQUARED * arr_sigma_bf *
-                np.power(arr_nu_hz, 2) * np.exp(-HOVERKB * arr_nu_hz / T_e)) * levelpopfrac
-
-            arr_j_nu_lowerlevel[(upperlevelnum, levelnum)] = arr_alpha_level_dnu / 4 / math.pi * H * arr_nu_hz * upperionpopdensity * nne
-
-            arr_alpha_dnu += arr_alpha_level_dnu
-
-            nnionfrac += levelpopfrac
-
-            # arr_nu_hz2 = nu_threshold * lowerlevel.phixstable[:, 0]
-            arr_nu_hz2 = nu_threshold * np.linspace(1.0, 1.0 + 0.03 * (100 + 1), num=3 * 100 + 1, endpoint=False)
-            arr_sigma_bf2 = evaluate_phixs(modelpath, atomic_number, lower_ion_stage, levelnum,
-                                           nu_threshold, tuple(arr_nu_hz2)) * phixsfrac
-            arr_alpha_level_dnu2 = 4. * math.pi * sfac * (
-                TWOOVERCLIGHTSQUARED * arr_sigma_bf2 *
-                np.power(arr_nu_hz2, 2) * np.exp(-HOVERKB * arr_nu_hz2 / T_e)) * levelpopfrac
-            alpha_level2 = np.abs(np.trapz(arr_alpha_level_dnu2, x=arr_nu_hz2))
-            alpha_ion2 += alpha_level2
-
-            # alpha_level = np.abs(np.trapz(arr_alpha_level_dnu, x=arr_nu_hz))
-            lambda_threshold = const.c.to('angstrom/s').value / nu_threshold
-            print(f' {upperionstr} level {upperlevelnum} -> {lowerionstr} level {levelnum}'
-                  f' threshold {lambda_threshold:7.1f} Å'
-                  f' Alpha_R_contrib {alpha_level2:.2e} {lowerlevel.levelname}'
-                  f' upperlevelpop {upperion_nltepops[upperlevelnum]:.2e}')
+        if len(upperion_nltepops) == 1:  # top ion has only one level
+            levelpopfracs = np.full(len(phixsmatrix.upperlevel), upperion_nltepops[0] / upperionpopdensity)
+        else:
+            levelpopfracs = np.array(
+                [upperion_nltepops[upperlevelnum] for upperlevelnum in phixsmatrix.upperlevel]) / upperionpopdensity
+
+    sfacs = (SAHACONST * lowerlevel_g / upperlevel_g *
+             math.pow(T_e, -1.5) * np.exp(HOVERKB * phixsmatrix.nu_threshold / T_e))
+
+    def get_alpha_level_dnu(arr_nu_hz):
+        # recombination coefficient per frequency for each row of phixsmatrix
+        arr_sigma_bf = evaluate_phixs_matrix(phixsmatrix, arr_nu_hz)
+        return 4. * math.pi * (sfacs * levelpopfracs)[:, np.newaxis] * (
+            TWOOVERCLIGHTSQUARED * arr_sigma_bf * np.power(arr_nu_hz, 2) * np.exp(-HOVERKB * arr_nu_hz / T_e))
+
+    arr_alpha_level_dnu = get_alpha_level_dnu(arr_nu_hz)
+    arr_alpha_dnu = arr_alpha_level_dnu.sum(axis=0)
+
+    arr_j_nu_lowerlevel = {
+        (int(upperlevelnum), int(levelnum)): arr_alpha_level_dnu[row] / 4 / math.pi * H * arr_nu_hz *
+        upperionpopdensity * nne
+        for row, (upperlevelnum, levelnum) in enumerate(zip(phixsmatrix.upperlevel, phixsmatrix.lowerlevel))}
+
+    # a grid for each level starting at the threshold
+    arr_nu_hz2 = phixsmatrix.nu_threshold[:, np.newaxis] * np.linspace(
+        1.0, 1.0 + 0.03 * (100 + 1), num=3 * 100 + 1, endpoint=False)[np.newaxis, :]
+    alpha_levels2 = np.abs(np.trapz(get_alpha_level_dnu(arr_nu_hz2), x=arr_nu_hz2, axis=1))
+    alpha_ion2 = alpha_levels2.sum()
+
+    for row, (upperlevelnum, levelnum) in enumerate(zip(phixsmatrix.upperlevel, phixsmatrix.lowerlevel)):
+        lambda_threshold = const.c.to('angstrom/s').value / phixsmatrix.nu_threshold[row]
+        print(f' {upperionstr} level {upperlevelnum} -> {lowerionstr} level {levelnum}'
+              f' threshold {lambda_threshold:7.1f} Å'
+              f' Alpha_R_contrib {alpha_levels2[row]:.2e} {lower_ion_data.levels.levelname.iloc[levelnum]}'
+              f' upperlevelpop {levelpopfracs[row] * upperionpopdensity:.2e}')
 
     alpha_ion = np.abs(np.trapz(arr_alpha_dnu, x=arr_nu_hz))
     print(f'  {upperionstr} Alpha_R = {alpha_ion:.2e}   Alpha_R*nne = {nne*alpha_ion:.2e}')
@@ -394,44 +431,215 @@ def get_ion_gamma_dnu(modelpath, modelgridindex, timestep, atomic_number, ion_st
     T_e = estimators[(timestep, modelgridindex)]['Te']
     T_R = estimators[(timestep, modelgridindex)]['TR']
 
-    adata = at.get_levels(modelpath, get_photoionisations=True)
-    ion_data = adata.query('Z == @atomic_number and ion_stage == @ion_stage').iloc[0]
-    upper_ion_data = adata.query('Z == @atomic_number and ion_stage == (@ion_stage + 1)').iloc[0]
+    adata = at.atomicdata.get_atomicdata(modelpath, get_photoionisations=True)
+    ion_data = adata.ion(atomic_number, ion_stage)
     ionstr = at.get_ionstring(atomic_number, ion_stage)
 
-    ion_popfactor_sum = 0
-    for _, level in ion_data.levels[:max_levels].iterrows():
-        ion_popfactor_sum += level.g * math.exp(-level.energy_ev * EV / KB / T_e)
+    levelpopfracs = get_levelpopfracs_lte(adata, atomic_number, ion_stage, T_e, max_levels)
 
-    arr_gamma_dnu = np.zeros_like(arr_nu_hz)
-    for levelnum, level in ion_data.levels[:max_levels].iterrows():
-        levelpopfrac = level.g * math.exp(-level.energy_ev * EV / KB / T_e) / ion_popfactor_sum
+    arr_corrfactors = 1 - np.exp(-HOVERKB * arr_nu_hz / T_R)
+    assert(min(arr_corrfactors) > 0.50)
+    assert(max(arr_corrfactors) <= 1.)
 
-        for upperlevelnum, phixsfrac in level.phixstargetlist:
-            upperlevel = upper_ion_data.levels.iloc[upperlevelnum]
-            nu_threshold = ONEOVERH * (ion_data.ion_pot - level.energy_ev + upperlevel.energy_ev) * EV
+    phixsmatrix = get_phixs_matrix(modelpath, ((atomic_number, ion_stage),), max_levels)
+    arr_sigma_bf = evaluate_phixs_matrix(phixsmatrix, arr_nu_hz)
+    rowpopfracs = levelpopfracs[phixsmatrix.lowerlevel]
 
-            arr_sigma_bf = evaluate_phixs(modelpath, atomic_number, ion_stage,
-                                          levelnum, nu_threshold, tuple(arr_nu_hz)) * phixsfrac
+    arr_gamma_dnu_per_sigma = 4 * math.pi * ONEOVERH / arr_nu_hz * J_nu_arr * arr_corrfactors
+    arr_gamma_dnu = rowpopfracs.dot(arr_sigma_bf) * arr_gamma_dnu_per_sigma
 
-            arr_corrfactors = 1 - np.exp(-HOVERKB * arr_nu_hz / T_R)
-            assert(min(arr_corrfactors) > 0.50)
-            assert(max(arr_corrfactors) <= 1.)
+    gamma_r_levels = np.abs(np.trapz(arr_sigma_bf * arr_gamma_dnu_per_sigma, x=arr_nu_hz, axis=1)) * rowpopfracs
+    for row, (levelnum, upperlevelnum) in enumerate(zip(phixsmatrix.lowerlevel, phixsmatrix.upperlevel)):
+        lambda_threshold = const.c.to('angstrom/s').value / phixsmatrix.nu_threshold[row]
 
-            arr_gamma_level_dnu = (
-                4 * math.pi * ONEOVERH * arr_sigma_bf / arr_nu_hz * J_nu_arr *
-                arr_corrfactors * levelpopfrac)
+        print(f'  level {levelnum} pop_frac {rowpopfracs[row]:.2f} upperlevel {upperlevelnum}'
+              f' threshold {lambda_threshold:.1f} Å '
+              f' gamma_R_level({ionstr}) {gamma_r_levels[row]:.2e} {ion_data.levels.levelname.iloc[levelnum]}')
 
-            arr_gamma_dnu += arr_gamma_level_dnu
+    return arr_gamma_dnu
 
-            gamma_r_level = np.abs(np.trapz(arr_gamma_level_dnu, x=arr_nu_hz))
-            lambda_threshold = const.c.to('angstrom/s').value / nu_threshold
 
-            print(f'  level {levelnum} pop_frac {levelpopfrac:.2f} upperlevel {upperlevelnum}'
-                  f' threshold {lambda_threshold:.1f} Å '
-                  f' gamma_R_level({ionstr}) {gamma_r_level:.2e} {level.levelname}')
+def get_fitted_field_matrix(radfielddata, arr_nu_hz, fullspec=False):
+    """Return J_nu [erg/s/cm2/Hz/sr] of the fitted dilute blackbodies for each cell in radfielddata.
 
-    return arr_gamma_dnu
+    Returns a list of (timestep, modelgridindex) keys and a matrix with a row for each key and a column for each
+    frequency. Inside the binned range, J_nu is from the fit to the bin containing nu (zero if the bin has no fit).
+    Outside the bins, or everywhere if fullspec is True, the fit to the full spectrum (bin_num -1) is used, and a
+    ValueError naming the cells is raised if any cell has no full spectrum fit.
+    """
+    dffits = radfielddata.query('bin_num >= -1')
+    arr_W = dffits.pivot_table(index=['timestep', 'modelgridindex'], columns='bin_num', values='W')
+    arr_T_R = dffits.pivot_table(index=['timestep', 'modelgridindex'], columns='bin_num', values='T_R')
+
+    if fullspec:
+        inbins = np.zeros(len(arr_nu_hz), dtype=bool)
+        binindex = np.zeros(len(arr_nu_hz), dtype=int)
+    else:
+        dfbinedges = dffits.query('bin_num >= 0').groupby('bin_num')[['nu_lower', 'nu_upper']].first()
+
+        # index of the bin containing each frequency
+        binindex = np.searchsorted(dfbinedges.nu_upper.values, arr_nu_hz, side='left')
+        inbins = binindex < len(dfbinedges)
+        binindex = np.minimum(binindex, len(dfbinedges) - 1)
+        inbins &= (arr_nu_hz >= dfbinedges.nu_lower.values[binindex])
+
+    fullspeccolumn = arr_W.columns.get_loc(-1) if -1 in arr_W.columns else -1
+    if not inbins.all():
+        # the full spectrum fit is needed, so every cell must have one
+        nofullspecfit = arr_W.index if fullspeccolumn < 0 else arr_W.index[np.isnan(arr_W.values[:, fullspeccolumn])]
+        if len(nofullspecfit) > 0:
+            raise ValueError('No full spectrum fit (bin_num -1) for (timestep, modelgridindex) ' +
+                             ', '.join(str(key) for key in nofullspecfit))
+
+    if fullspec:
+        fitcolumns = np.full(len(arr_nu_hz), fullspeccolumn)
+    else:
+        # column of the fit for each frequency
+        fitcolumns = np.where(inbins, arr_W.columns.get_indexer(dfbinedges.index[binindex]), fullspeccolumn)
+
+    arr_j_nu = j_nu_dbb(arr_nu_hz, arr_W.values[:, fitcolumns], arr_T_R.values[:, fitcolumns])
+
+    return list(arr_W.index), arr_j_nu
+
+
+def get_fitted_field_cube(radfielddata, arr_nu_hz, fullspec=False):
+    """Return J_nu [erg/s/cm2/Hz/sr] of the fitted dilute blackbodies for all cells and timesteps in radfielddata.
+
+    Returns the list of cells, the list of timesteps, and a (cell × timestep × frequency) array of J_nu on the
+    frequency grid arr_nu_hz (see get_fitted_field_matrix), which is NaN for cells without data at a timestep.
+    """
+    arr_nu_hz = np.atleast_1d(arr_nu_hz)
+    keys, arr_j_nu = get_fitted_field_matrix(radfielddata, arr_nu_hz, fullspec=fullspec)
+
+    timesteps = sorted({timestep for timestep, _ in keys})
+    modelgridindices = sorted({modelgridindex for _, modelgridindex in keys})
+    arr_timestep, arr_modelgridindex = np.array(keys, dtype=int).reshape(-1, 2).T
+
+    arr_j_nu_cube = np.full((len(modelgridindices), len(timesteps), len(arr_nu_hz)), np.nan)
+    arr_j_nu_cube[np.searchsorted(modelgridindices, arr_modelgridindex),
+                  np.searchsorted(timesteps, arr_timestep)] = arr_j_nu
+
+    return modelgridindices, timesteps, arr_j_nu_cube
+
+
+def get_photoionrates_timestep(
+        radfielddata_timestep, estimators_timestep, ionlist, phixsmatrix, arr_nu_hz, arr_sigma_bf, ionlevelarrays):
+    """Return a list of table rows with the photoionisation rate coefficient and bound-free opacity of each ion.
+
+    All cells in radfielddata_timestep (one timestep) are calculated together from products of the cross section
+    matrix arr_sigma_bf (phixsmatrix row, frequency) and the fitted radiation field of each cell.
+    """
+    keys, arr_j_nu = get_fitted_field_matrix(radfielddata_timestep, arr_nu_hz)
+    hasestimators = [key in estimators_timestep and not estimators_timestep[key]['emptycell'] for key in keys]
+    keys = [key for key, hasestim in zip(keys, hasestimators) if hasestim]
+    arr_j_nu = arr_j_nu[hasestimators]
+
+    T_e = np.array([estimators_timestep[key]['Te'] for key in keys])
+    T_R = np.array([estimators_timestep[key]['TR'] for key in keys])
+
+    # trapezoidal integration weights (the frequency grid can be increasing or decreasing)
+    arr_dnu = np.zeros_like(arr_nu_hz)
+    arr_dnu[:-1] += np.abs(np.diff(arr_nu_hz)) / 2.
+    arr_dnu[1:] += np.abs(np.diff(arr_nu_hz)) / 2.
+
+    # frequency integrals for each cell (row) of each phixsmatrix row (column) with the cell's radiation field
+    arr_corrfactors = -np.expm1(-HOVERKB * arr_nu_hz / T_R[:, np.newaxis])
+    arr_gamma_rows = (4 * math.pi * ONEOVERH * arr_j_nu / arr_nu_hz * arr_corrfactors * arr_dnu).dot(arr_sigma_bf.T)
+    arr_kappaj_rows = (arr_j_nu * arr_dnu).dot(arr_sigma_bf.T)
+    arr_j_integral = arr_j_nu.dot(arr_dnu)
+
+    tablerows = []
+    for atomic_number, ion_stage in ionlist:
+        ionrows = (phixsmatrix.atomic_number == atomic_number) & (phixsmatrix.lower_ion_stage == ion_stage)
+
+        # LTE level populations at the electron temperature of each cell
+        level_g, level_energies_ev = ionlevelarrays[(atomic_number, ion_stage)]
+        levelpopfactors = level_g * np.exp(-level_energies_ev * EV / KB / T_e[:, np.newaxis])
+        levelpopfracs = levelpopfactors / levelpopfactors.sum(axis=1)[:, np.newaxis]
+        rowpopfracs = levelpopfracs[:, phixsmatrix.lowerlevel[ionrows]]
+
+        arr_gamma_R = (rowpopfracs * arr_gamma_rows[:, ionrows]).sum(axis=1)
+        arr_kappaj = (rowpopfracs * arr_kappaj_rows[:, ionrows]).sum(axis=1)
+
+        for cellindex, (timestep, modelgridindex) in enumerate(keys):
+            estim = estimators_timestep[(timestep, modelgridindex)]
+            nnion = estim['populations'].get((atomic_number, ion_stage), 0.)
+            tablerows.append({
+                'timestep': timestep,
+                'modelgridindex': modelgridindex,
+                'Z': atomic_number,
+                'ion_stage': ion_stage,
+                'Te': T_e[cellindex],
+                'TR': T_R[cellindex],
+                'nnion': nnion,
+                'gamma_R': arr_gamma_R[cellindex],
+                'gamma_R_artis': estim.get('gamma_R', {}).get((atomic_number, ion_stage), float('NaN')),
+                'kappa_bf': (nnion * arr_kappaj[cellindex] / arr_j_integral[cellindex]
+                             if arr_j_integral[cellindex] > 0. else 0.),
+            })
+
+    return tablerows
+
+
+def get_photoionrates_table(modelpath, ionlist, timesteps=None, modelgridindices=None, max_levels=20, nu_points=10000):
+    """Return a DataFrame with the photoionisation rate coefficient and bound-free opacity of ions in all cells.
+
+    The rates use the fitted radiation field (all bins) and LTE populations of the first max_levels levels at
+    the cell electron temperature. gamma_R [s^-1] is the photoionisation rate coefficient, gamma_R_artis is the
+    value from the estimators file (if available) and kappa_bf [cm^-1] is the J_nu-weighted mean bound-free
+    opacity of the ion over the frequency grid, which extends from the lowest bin frequency to the end of the
+    cross section tables.
+    """
+    ionlist = tuple((int(atomic_number), int(ion_stage)) for atomic_number, ion_stage in ionlist)
+    radfielddata = read_files(
+        modelpath, timestep=-1 if timesteps is None else tuple(timesteps),
+        modelgridindex=-1 if modelgridindices is None else tuple(modelgridindices))
+
+    estimators = at.estimators.read_estimators(modelpath, timestep=timesteps, modelgridindex=modelgridindices)
+
+    adata = at.atomicdata.get_atomicdata(modelpath, get_photoionisations=True)
+    ionlevelarrays = {
+        (atomic_number, ion_stage): (adata.level_g(atomic_number, ion_stage)[:max_levels],
+                                     adata.level_energies_ev(atomic_number, ion_stage)[:max_levels])
+        for atomic_number, ion_stage in ionlist}
+
+    # the cross sections are the same in every cell, so they are evaluated once for all cells
+    phixsmatrix = get_phixs_matrix(modelpath, ionlist, max_levels)
+    dfbins = radfielddata.query('bin_num >= 0')
+    nu_max = max(dfbins.nu_upper.max(), phixsmatrix.nu_threshold.max(initial=0.) * phixsmatrix.xgrid[-1])
+    arr_nu_hz = np.geomspace(dfbins.nu_lower.min(), nu_max, num=nu_points)
+    arr_sigma_bf = evaluate_phixs_matrix(phixsmatrix, arr_nu_hz)
+
+    timestepdata = [
+        (radfielddata_timestep, {key: estim for key, estim in estimators.items() if key[0] == timestep})
+        for timestep, radfielddata_timestep in radfielddata.groupby('timestep')]
+
+    processtimestep = partial(
+        get_photoionrates_timestep, ionlist=ionlist, phixsmatrix=phixsmatrix, arr_nu_hz=arr_nu_hz,
+        arr_sigma_bf=arr_sigma_bf, ionlevelarrays=ionlevelarrays)
+
+    if at.num_processes > 1:
+        with multiprocessing.Pool(processes=at.num_processes) as pool:
+            tablerowlists = pool.starmap(processtimestep, timestepdata)
+            pool.close()
+            pool.join()
+            pool.terminate()
+    else:
+        tablerowlists = [processtimestep(*args) for args in timestepdata]
+
+    dfrates = pd.DataFrame(list(chain.from_iterable(tablerowlists)), columns=[
+        'timestep', 'modelgridindex', 'Z', 'ion_stage', 'Te', 'TR', 'nnion', 'gamma_R', 'gamma_R_artis', 'kappa_bf'])
+
+    return dfrates.sort_values(['timestep', 'modelgridindex', 'Z', 'ion_stage'], ignore_index=True)
+
+
+def parse_ionstring(strion):
+    """Return (atomic_number, ion_stage) for an ion string like 'Fe II', 'Fe_II', or 'FeII'."""
+    match = re.match(r'^([A-Z][a-z]?)[ _]?([IVX]+)$', strion.strip())
+    if not match or at.get_atomic_number(match.group(1)) < 0:
+        raise ValueError(f'Could not parse ion "{strion}"')
+
+    return at.get_atomic_number(match.group(1)), at.decode_roman_numeral(match.group(2))
 
 
 def calculate_photoionrates(axes, modelpath, radfielddata, modelgridindex, timestep, xmin, xmax, ymax, args):
@@ -443,7 +651,7 @@ def calculate_photoionrates(axes, modelpath, radfielddata, modelgridindex, times
     recomblowerionlist = ((26, 3),)
     photoionlist = ((26, 2),)
     kappalowerionlist = ((26, 2), (26, 3),)
-    adata = at.get_levels(modelpath, get_photoionisations=True)
+    adata = at.atomicdata.get_atomicdata(modelpath, get_photoionisations=True)
 
     fieldlist = []
 
@@ -534,12 +742,12 @@ def calculate_photoionrates(axes, modelpath, radfielddata, modelgridindex, times
 
     for atomic_number, ion_stage in photoionlist:
         ionstr = at.get_ionstring(atomic_number, ion_stage)
-        ion_data = adata.query('Z == @atomic_number and ion_stage == @ion_stage').iloc[0]
+        ion_data = adata.ion(atomic_number, ion_stage)
 
         for levelnum, level in ion_data.levels[:max_levels].iterrows():
             nu_threshold = ONEOVERH * (ion_data.ion_pot - level.energy_ev) * EV
             arr_sigma_bf = evaluate_phixs(modelpath, atomic_number, ion_stage, levelnum,
-                                          nu_threshold, tuple(arr_nu_hz_recomb))
+                                          nu_threshold, arr_nu_hz_recomb)
             if levelnum < 5:
                 axes[0].plot(arraylambda_angstrom_recomb, arr_sigma_bf,
                              label=r'$\sigma_{bf}$' + f'({ionstr} {level.levelname})')
@@ -687,38 +895,13 @@ def plot_celltimestep(
     return True
 
 
-def plot_bin_fitted_field_evolution(axis, radfielddata, nu_line, modelgridindex, **plotkwargs):
-    bin_num, _nu_lower, _nu_upper = select_bin(radfielddata, nu=nu_line, modelgridindex=modelgridindex)
-    # print(f"Selected bin_num {bin_num} to get a binned radiation field estimator")
-
-    radfielddataselected = radfielddata.query(
-        'bin_num == @bin_num and modelgridindex == @modelgridindex'
-        ' and nu_lower <= @nu_line and nu_upper >= @nu_line').copy()
-
-    radfielddataselected['Jb_nu_at_line'] = radfielddataselected.apply(
-        lambda x: j_nu_dbb([nu_line], x.W, x.T_R)[0], axis=1)
-
+def plot_fitted_field_evolution(axis, timesteps, arr_j_nu, nu_line, label, **plotkwargs):
+    """Plot J_lambda at a line over time from the J_nu values of a cell in a get_fitted_field_cube() array."""
     const_c = const.c.to('angstrom/s').value
-    radfielddataselected.eval('Jb_lambda_at_line = Jb_nu_at_line * (@nu_line ** 2) / @const_c', inplace=True)
     lambda_angstroms = const_c / nu_line
 
-    radfielddataselected.plot(x='timestep', y='Jb_lambda_at_line', ax=axis,
-                              label=f'Fitted field from bin at {lambda_angstroms:.1f} Å', **plotkwargs)
-
-
-def plot_global_fitted_field_evolution(axis, radfielddata, nu_line, modelgridindex, **plotkwargs):
-    radfielddataselected = radfielddata.query('bin_num == -1 and modelgridindex == @modelgridindex').copy()
-
-    radfielddataselected['J_nu_fullspec_at_line'] = radfielddataselected.apply(
-        lambda x: j_nu_dbb([nu_line], x.W, x.T_R)[0], axis=1)
-
-    const_c = const.c.to('angstrom/s').value
-    radfielddataselected.eval('J_lambda_fullspec_at_line = J_nu_fullspec_at_line * (@nu_line ** 2) / @const_c',
-                              inplace=True)
-    lambda_angstroms = const_c / nu_line
-
-    radfielddataselected.plot(x='timestep', y='J_lambda_fullspec_at_line', ax=axis,
-                              label=f'Full-spec fitted field at {lambda_angstroms:.1f} Å', **plotkwargs)
+    axis.plot(timesteps, arr_j_nu * (nu_line ** 2) / const_c, label=f'{label} at {lambda_angstroms:.1f} Å',
+              **plotkwargs)
 
 
 def plot_line_estimator_evolution(axis, radfielddata, bin_num, modelgridindex=None,
@@ -765,14 +948,22 @@ def plot_timeevolution(modelpath, outputfile, modelgridindex, args):
     print(f'Top estimators at timestep {timestep} t={time_days:.1f}')
     print(dftopestimators)
 
-    for ax, bin_num_estimator, nu_line in zip(axes, dftopestimators.bin_num.values, dftopestimators.nu_upper.values):
+    # the fitted fields at all of the line frequencies and timesteps
+    _, fittimesteps, arr_j_nu_bins = get_fitted_field_cube(radfielddataselected, dftopestimators.nu_upper.values)
+    _, _, arr_j_nu_fullspec = get_fitted_field_cube(
+        radfielddataselected, dftopestimators.nu_upper.values, fullspec=True)
+
+    for lineindex, (ax, bin_num_estimator, nu_line) in enumerate(
+            zip(axes, dftopestimators.bin_num.values, dftopestimators.nu_upper.values)):
         lambda_angstroms = const_c / nu_line
         print(f"Selected line estimator with bin_num {bin_num_estimator}, lambda={lambda_angstroms:.1f}")
         plot_line_estimator_evolution(ax, radfielddataselected, bin_num_estimator, modelgridindex=modelgridindex)
 
-        plot_bin_fitted_field_evolution(ax, radfielddata, nu_line, modelgridindex=modelgridindex)
+        plot_fitted_field_evolution(
+            ax, fittimesteps, arr_j_nu_bins[0, :, lineindex], nu_line, label='Fitted field from bin')
 
-        plot_global_fitted_field_evolution(ax, radfielddata, nu_line, modelgridindex=modelgridindex)
+        plot_fitted_field_evolution(
+            ax, fittimesteps, arr_j_nu_fullspec[0, :, lineindex], nu_line, label='Full-spec fitted field')
         ax.annotate(
             r'$\lambda$='
             f'{lambda_angstroms:.1f} Å in cell {modelgridindex:d}\n',
@@ -848,6 +1039,16 @@ def addargs(parser):
     parser.add_argument('--photoionrates', action='store_true',
                         help='Suppress the band-average line')
 
+    parser.add_argument('--photoionratetable', action='store_true',
+                        help='Write a table of photoionisation rates and bound-free opacities for all cells and '
+                             'timesteps (or those selected with -timestep and -modelgridindex) instead of plotting')
+
+    parser.add_argument('-ions', default=['Fe II', 'Fe III'], nargs='*',
+                        help='Ions for the photoionisation rate table, e.g., "Fe II" Fe_III CoII')
+
+    parser.add_argument('-maxlevels', type=int, default=20,
+                        help='Number of levels included in the photoionisation rate table')
+
     parser.add_argument('-figscale', type=float, default=1.,
                         help='Scale factor for plot area. 1.0 is for single-column')
 
@@ -865,6 +1066,23 @@ def main(args=None, argsraw=None, **kwargs):
         parser.set_defaults(**kwargs)
         args = parser.parse_args(argsraw)
 
+    if args.photoionratetable:
+        timesteplast = len(at.get_timestep_times_float(args.modelpath))
+        dfrates = get_photoionrates_table(
+            args.modelpath, [parse_ionstring(strion) for strion in args.ions],
+            timesteps=(at.parse_range_list(args.timestep, dictvars={'last': timesteplast})
+                       if args.timestep is not None else None),
+            modelgridindices=(at.parse_range_list(args.modelgridindex)
+                              if args.modelgridindex is not None else None),
+            max_levels=args.maxlevels)
+
+        outputfile = Path(args.outputfile) if args.outputfile else Path('.')
+        if outputfile.is_dir():
+            outputfile = outputfile / 'photoionrates.txt'
+        dfrates.to_csv(outputfile, sep=' ', index=False)
+        print(f'Saved {outputfile}')
+        return 0
+
     if args.xaxis == 'lambda':
         defaultoutputfile = Path('plotradfield_cell{modelgridindex:03d}_ts{timestep:03d}.pdf')
     else:
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""Binary cache of the ARTIS spectrum files spec.out, specpol.out, vspecpol*.out, specpol_res.out, emission*.out, and
+absorption*.out.
+
+Each text file is converted once into a single float64 array with one row per frequency bin (spec.out, specpol.out)
+or one row per (frequency bin, timestep) pair (emission*.out, absorption*.out). The array is saved as a .npy file
+in the cache folder and memory-mapped when loaded, so reading a spectrum or a contribution column is a slice of the
+mapped file instead of another parse of the text.
+"""
+
+import multiprocessing
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import artistools as at
+
+specfilenames = ['spec.out.xz', 'spec.out.gz', 'spec.out']
+emissionfilenames = ['emission.out.xz', 'emission.out.gz', 'emission.out', 'emissionpol.out']
+emissiontruefilenames = ['emissiontrue.out.xz', 'emissiontrue.out.gz', 'emissiontrue.out']
+absorptionfilenames = ['absorption.out.xz', 'absorption.out.gz', 'absorption.out', 'absorptionpol.out']
+
+
+def file_has_header(specfilepath):
+    """spec.out, specpol.out, and vspecpol files start with a row of times, the emission and absorption files do not."""
+    return Path(specfilepath).name.startswith(('spec', 'vspecpol'))
+
+
+def convert_specfile(sourcefilepath):
+    """Return a dict with the numeric data of a spectrum file and its column labels (if it has a header row)."""
+    if file_has_header(sourcefilepath):
+        dfspec = pd.read_csv(sourcefilepath, delim_whitespace=True)
+        # keep the column labels exactly as pandas gives them (e.g., the repeated times in specpol.out)
+        return {
+            'data': np.ascontiguousarray(dfspec.values, dtype=np.float64),
+            'columns': np.array([str(col).encode('utf-8') for col in dfspec.columns], dtype=np.bytes_),
+        }
+
+    dfspec = pd.read_csv(sourcefilepath, delim_whitespace=True, header=None, dtype=np.float64)
+    return {'data': np.ascontiguousarray(dfspec.values, dtype=np.float64)}
+
+
+class SpecCube:
+    """The contents of an ARTIS spectrum file as a 2D array (possibly memory-mapped from the binary cache).
+
+    For spec.out and specpol.out, the rows are frequency bins, the first column is the frequency, and the other
+    columns are timesteps (for specpol.out, the I, Q, and U blocks of timesteps). For emission*.out and
+    absorption*.out, each frequency bin has a row for every timestep and the columns are the emission or absorption
+    processes.
+    """
+
+    def __init__(self, arrays, sourcefilepath):
+        self.sourcefilepath = Path(sourcefilepath)
+        self.data = arrays['data']
+        if 'columns' in arrays:
+            self.columns = [col.decode('utf-8') for col in arrays['columns'].tolist()]
+        else:
+            self.columns = None
+
+    def get_nu(self):
+        """Return the frequency grid (spec.out and specpol.out only)."""
+        assert self.columns is not None
+        return self.data[:, 0]
+
+    def get_timecolumns(self):
+        """Return the time column labels (including any repeated Q and U blocks for specpol.out)."""
+        assert self.columns is not None
+        return self.columns[1:]
+
+    def get_fluxes(self):
+        """Return the (frequency × timestep column) array of f_nu values."""
+        assert self.columns is not None
+        return self.data[:, 1:]
+
+    def get_cube(self, ntimesteps):
+        """Return the emission or absorption data as a (frequency × timestep × process) array view."""
+        assert self.columns is None
+        assert self.data.shape[0] % ntimesteps == 0
+        return self.data.reshape(self.data.shape[0] // ntimesteps, ntimesteps, self.data.shape[1])
+
+    def to_dataframe(self):
+        """Return a DataFrame matching pd.read_csv on the text file. The data is not copied."""
+        if self.columns is None:
+            return pd.DataFrame(self.data, copy=False)
+        return pd.DataFrame(self.data, columns=self.columns, copy=False)
+
+
+class PolarisationData:
+    """The Stokes parameters of specpol.out or a vspecpol file as a (Stokes I, Q, U × frequency × time) array.
+
+    The array is a view of the SpecCube data, so I, Q, and U are not copied. The ratios Q/I and U/I are computed
+    the first time they are requested and then kept.
+    """
+
+    stokesindex = {'I': 0, 'Q': 1, 'U': 2}
+
+    def __init__(self, speccube):
+        self.nu = speccube.get_nu()
+        fluxes = speccube.get_fluxes()
+        ntimesteps = fluxes.shape[1] // 3
+        # the Q and U blocks repeat the times of the I block
+        self.timecolumns = speccube.get_timecolumns()[:ntimesteps]
+        self.stokes = fluxes.reshape(len(self.nu), 3, ntimesteps).transpose(1, 0, 2)
+        self.ratios = {}
+
+    def get_param(self, param):
+        """Return the (frequency × time) array of 'I', 'Q', or 'U', or of the ratio 'Q/I' or 'U/I'."""
+        if param in self.stokesindex:
+            return self.stokes[self.stokesindex[param]]
+
+        if param not in self.ratios:
+            numerator, denominator = param.split('/')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.ratios[param] = self.get_param(numerator) / self.get_param(denominator)
+
+        return self.ratios[param]
+
+    def to_dataframe(self, param='I'):
+        """Return a DataFrame with a nu column and a column for each time, as in the dict of get_polarisation()."""
+        dfstokes = pd.DataFrame(self.get_param(param), columns=self.timecolumns, copy=False)
+        dfstokes.insert(0, 'nu', self.nu)
+        return dfstokes
+
+
+def read_specblocks(specfilepath, nblocks=None):
+    """Return a (block × row × column) array of a file made of equal blocks that each start with a header row.
+
+    This is the layout of specpol_res.out (one block per angle bin) and vspecpol files (one block per observer).
+    The header rows are kept as row 0 of each block. If nblocks is given, any later blocks are ignored.
+    """
+    data = pd.read_csv(specfilepath, delim_whitespace=True, header=None, dtype=np.float64).values
+
+    # the header rows have the same value as the first row in the frequency column
+    blockstarts = np.flatnonzero(data[:, 0] == data[0, 0])
+    blocklength = data.shape[0] // len(blockstarts)
+    assert np.array_equal(blockstarts, np.arange(len(blockstarts)) * blocklength)
+
+    blocks = data.reshape(len(blockstarts), blocklength, data.shape[1])
+    return blocks if nblocks is None else blocks[:nblocks]
+
+
+def add_specblocks(specblocks_sum, specblocks):
+    """Add the fluxes of specblocks into specblocks_sum (the header rows and frequency columns are not summed)."""
+    specblocks_sum[:, 1:, 1:] += specblocks[:, 1:, 1:]
+    return specblocks_sum
+
+
+def sum_specblock_files_worker(specfilepaths, nblocks=None):
+    """Return the summed blocks of a list of files, keeping at most two files in memory."""
+    specblocks_sum = None
+    for specfilepath in specfilepaths:
+        print(f'Reading {specfilepath}')
+        specblocks = read_specblocks(specfilepath, nblocks=nblocks)
+        specblocks_sum = specblocks if specblocks_sum is None else add_specblocks(specblocks_sum, specblocks)
+
+    return specblocks_sum
+
+
+def sum_specblock_files(specfilepaths, nblocks=None):
+    """Return the (block × row × column) sum of many block files (e.g., the vspecpol files of all MPI ranks).
+
+    The files are split into groups that are summed by a process pool, then the partial sums are added pairwise.
+    """
+    specfilepaths = list(specfilepaths)
+    ngroups = min(len(specfilepaths), 4 * at.num_processes)
+    filegroups = [specfilepaths[groupindex::ngroups] for groupindex in range(ngroups)]
+    processfiles = partial(sum_specblock_files_worker, nblocks=nblocks)
+
+    if at.num_processes > 1 and ngroups > 1:
+        with multiprocessing.Pool(processes=at.num_processes) as pool:
+            partialsums = pool.map(processfiles, filegroups)
+            pool.close()
+            pool.join()
+            pool.terminate()
+    else:
+        partialsums = [processfiles(filegroup) for filegroup in filegroups]
+
+    while len(partialsums) > 1:
+        partialsums = [
+            add_specblocks(partialsums[i], partialsums[i + 1]) if i + 1 < len(partialsums) else partialsums[i]
+            for i in range(0, len(partialsums), 2)]
+
+    return partialsums[0]
+
+
+def write_specblock(specblock, outfilepath):
+    """Write one block (header row and frequency rows) in the same text format as the per-rank files."""
+    pd.DataFrame(specblock).to_csv(outfilepath, sep=' ', index=False, header=False)
+    print(f'Saved {outfilepath}')
+
+
+def convert_specpol_res(sourcefilepath):
+    """Return a dict with the (angle × frequency × timestep × Stokes I, Q, U) array of specpol_res.out."""
+    with at.zopen(sourcefilepath, 'rt') as fspec:
+        columns = fspec.readline().split()
+    ntimesteps = (len(columns) - 1) // 3
+
+    blocks = read_specblocks(sourcefilepath)
+    nangles, nnu = blocks.shape[0], blocks.shape[1] - 1
+    stokes = blocks[:, 1:, 1:].reshape(nangles, nnu, 3, ntimesteps).transpose(0, 1, 3, 2)
+
+    return {
+        'nu': np.ascontiguousarray(blocks[0, 1:, 0]),
+        'stokes': np.ascontiguousarray(stokes),
+        'columns': np.array([col.encode('utf-8') for col in columns[:ntimesteps + 1]], dtype=np.bytes_),
+    }
+
+
+@at.memcache
+def get_specpol_res(specfilepath):
+    """Return a dict with the frequencies, the I block column labels, and the Stokes array of specpol_res.out.
+
+    The file is parsed once (or read from the binary cache) and the arrays are shared by all viewing angles.
+    """
+    specfilepath = Path(specfilepath)
+    if at.enable_diskcache:
+        cachefolder = Path(at.get_diskcache_folders(specfilepath.parent)[0], 'speccube-specpol_res.out')
+        try:
+            return at.get_cached_arrays(cachefolder, specfilepath, convert_specpol_res)
+        except OSError as ex:
+            print(f'Could not use the binary spectrum cache (Error: {ex}). Reading text file instead')
+
+    return convert_specpol_res(specfilepath)
+
+
+@at.memcache
+def read_specfile(specfilepath):
+    """Return the arrays of a spectrum text file (see convert_specfile), parsing each file only once."""
+    return convert_specfile(specfilepath)
+
+
+def get_speccube_cachefolder(specfilepath):
+    """Return the binary cache folder of a spectrum file."""
+    cachename = Path(specfilepath).name
+    for suffix in ['.xz', '.gz']:
+        if cachename.endswith(suffix):
+            cachename = cachename[:-len(suffix)]
+    return Path(at.get_diskcache_folders(Path(specfilepath).parent)[0], f'speccube-{cachename}')
+
+
+def get_speccube(specfilepath):
+    """Return a SpecCube for a spectrum file, converting it to the binary cache if it is new or has changed.
+
+    If the disk cache is disabled or not writable, the text file is read into memory instead.
+    """
+    specfilepath = Path(specfilepath)
+    if at.enable_diskcache:
+        try:
+            arrays = at.get_cached_arrays(get_speccube_cachefolder(specfilepath), specfilepath, convert_specfile)
+            return SpecCube(arrays, specfilepath)
+        except OSError as ex:
+            print(f'Could not use the binary spectrum cache (Error: {ex}). Reading text file instead')
+
+    return SpecCube(read_specfile(specfilepath), specfilepath)
+
+
+def get_model_speccube(modelpath, filenames=None):
+    """Return the SpecCube for the first existing file in filenames (default spec.out) in the model folder."""
+    if filenames is None:
+        filenames = specfilenames
+    return get_speccube(at.firstexisting(filenames, path=modelpath))
+
+
+def get_timestep_cube(specfilepath, nnu, ntimesteps, timestepmin, timestepmax):
+    """Return a (frequency × timestep × process) array of an emission or absorption file for a range of timesteps.
+
+    If the file is already in the binary cache, this is a view of the memory-mapped cube, so only the pages of the
+    selected rows are read. Otherwise, the rows of the other timesteps are skipped while parsing the text file
+    (a one-off read of some timesteps does not convert the whole file).
+    The row count must be the number of frequency bins times the number of timesteps.
+    """
+    specfilepath = Path(specfilepath)
+    if at.enable_diskcache and at.read_arraycache(
+            get_speccube_cachefolder(specfilepath), at.get_arraycache_stamp(specfilepath)) is not None:
+        return get_speccube(specfilepath).get_cube(ntimesteps)[:, timestepmin:timestepmax + 1, :]
+
+    rowtimesteps = np.arange(nnu * ntimesteps) % ntimesteps
+    skiprows = np.flatnonzero((rowtimesteps < timestepmin) | (rowtimesteps > timestepmax))
+    dfspec = pd.read_csv(specfilepath, delim_whitespace=True, header=None, dtype=np.float64, skiprows=skiprows)
+    return dfspec.values.reshape(nnu, timestepmax - timestepmin + 1, dfspec.shape[1])
@@ -21,14 +21,20 @@ from astropy import units as u
 import re
 
 import artistools as at
+import artistools.atomicdata
 import artistools.radfield
 import artistools.packets
+import artistools.speccube
 
 hatches = ['', 'x', '-', '\\', '+', 'O', '.', '', 'x', '*', '\\', '+', 'O', '.']  # ,
 
 fluxcontributiontuple = namedtuple(
     'fluxcontribution', 'fluxcontrib linelabel array_flambda_emission array_flambda_absorption color')
 
+# spectra for a list of time windows (rows of f_nu and f_lambda) on a common grid of increasing wavelength.
+# rowindex is the row of each frequency in the spectrum file
+spectramatrixtuple = namedtuple('spectramatrixtuple', 'nu lambda_angstroms f_nu f_lambda rowindex')
+
 
 def get_exspec_bins():
     MNUBINS = 1000
@@ -63,7 +69,11 @@ def stackspectra(spectra_and_factors):
     return stackedspectrum
 
 
-def get_specdata(modelpath, args):
+def get_specdata(modelpath, args, copy=True):
+    """Return the spectra of spec.out (or a Stokes parameter of specpol.out) as a DataFrame.
+
+    With copy=False, the DataFrame can be a read-only view of the cached (memory-mapped) data.
+    """
     polarisationdata = False
     if Path(modelpath, 'specpol.out').is_file():
         specfilename = Path(modelpath) / "specpol.out"
@@ -75,55 +85,107 @@ def get_specdata(modelpath, args):
 
     if polarisationdata:
         # angle = args.plotviewingangle[0]
-        stokes_params = get_polarisation(angle=None, modelpath=modelpath)
+        polarisationdata = get_polarisationdata(modelpath)
         if args is not None and 'stokesparam' in args:
-            specdata = stokes_params[args.stokesparam]
+            specdata = polarisationdata.to_dataframe(args.stokesparam)
         else:
-            specdata = stokes_params['I']
+            specdata = polarisationdata.to_dataframe('I')
     else:
         print(f"Reading {specfilename}")
-        specdata = pd.read_csv(specfilename, delim_whitespace=True)
-        specdata = specdata.rename(columns={'0': 'nu'})
+        specdata = artistools.speccube.get_speccube(specfilename).to_dataframe()
+        specdata = specdata.rename(columns={'0': 'nu'}, copy=False)
 
-    return specdata
+    return specdata.copy() if copy else specdata
 
 
-def get_spectrum(
-        modelpath, timestepmin: int, timestepmax=-1, fnufilterfunc=None,
-        reftime=None, modelnumber=None, args=None):
-    """Return a pandas DataFrame containing an ARTIS emergent spectrum."""
-    if timestepmax < 0:
-        timestepmax = timestepmin
+def get_timewindow_weights(arr_tmid, arr_tdelta, timewindows, reftime=None):
+    """Return a (time window × timestep) matrix that averages the timesteps of each window.
 
-    specdata = get_specdata(modelpath, args)
+    Each (timestepmin, timestepmax) window is weighted by timestep duration, as in stackspectra(). If reftime
+    (days, either one value or one per window) is given, each timestep is also scaled by exp((t_mid - reftime) / 133).
+    """
+    arr_tmid = np.asarray(arr_tmid, dtype=float)
+    arr_tdelta = np.asarray(arr_tdelta, dtype=float)
+    weights = np.zeros((len(timewindows), len(arr_tdelta)))
+    for windowindex, (timestepmin, timestepmax) in enumerate(timewindows):
+        weights[windowindex, timestepmin:timestepmax + 1] = arr_tdelta[timestepmin:timestepmax + 1]
+    weights /= weights.sum(axis=1, keepdims=True)
 
-    nu = specdata.loc[:, 'nu'].values
-    arr_tmid = at.get_timestep_times_float(modelpath, loc='mid')
+    if reftime is not None:
+        reftimes = np.broadcast_to(np.asarray(reftime, dtype=float), (len(timewindows),))
+        weights *= np.exp(arr_tmid[np.newaxis, :] / 133.) / np.exp(reftimes[:, np.newaxis] / 133.)
 
-    def timefluxscale(timestep):
-        if reftime is not None:
-            return math.exp(float(arr_tmid[timestep]) / 133.) / math.exp(reftime / 133.)
-        else:
-            return 1.
+    return weights
 
-    arr_tdelta = at.get_timestep_times_float(modelpath, loc='delta')
 
-    f_nu = stackspectra([
-        (specdata[specdata.columns[timestep + 1]] * timefluxscale(timestep),
-         arr_tdelta[timestep])
-        for timestep in range(timestepmin, timestepmax + 1)])
+def get_spectra_from_fnu_matrix(arr_nu, arr_fnu_timesteps, weights, fnufilterfunc=None):
+    """Return a spectramatrixtuple from the (frequency × timestep) f_nu and a (window × timestep) weight matrix.
+
+    The spectra are sorted by increasing wavelength. The f_nu array can have leading axes (e.g., viewing angle),
+    which are kept in front of the window axis of the result.
+    """
+    arr_fnu = weights @ np.swapaxes(np.asarray(arr_fnu_timesteps), -1, -2)
 
     # best to use the filter on this list because it
     # has regular sampling
     if fnufilterfunc:
         print("Applying filter to ARTIS spectrum")
-        f_nu = fnufilterfunc(f_nu)
+        arr_fnu = np.array([fnufilterfunc(fnu) for fnu in arr_fnu.reshape(-1, arr_fnu.shape[-1])]).reshape(
+            arr_fnu.shape)
 
-    dfspectrum = pd.DataFrame({'nu': nu, 'f_nu': f_nu})
-    dfspectrum.sort_values(by='nu', ascending=False, inplace=True)
+    sortindex = np.argsort(-np.asarray(arr_nu), kind='stable')
+    arr_nu = np.asarray(arr_nu)[sortindex]
+    arr_fnu = arr_fnu[..., sortindex]
+    arr_lambda = const.c.to('angstrom/s').value / arr_nu
 
-    dfspectrum.eval('lambda_angstroms = @c / nu', local_dict={'c': const.c.to('angstrom/s').value}, inplace=True)
-    dfspectrum.eval('f_lambda = f_nu * nu / lambda_angstroms', inplace=True)
+    return spectramatrixtuple(nu=arr_nu, lambda_angstroms=arr_lambda, f_nu=arr_fnu,
+                              f_lambda=arr_fnu * arr_nu / arr_lambda, rowindex=sortindex)
+
+
+def get_spectra(modelpath, timewindows, fnufilterfunc=None, reftime=None, angle=None, res_specdata=None, args=None):
+    """Return the (time window × wavelength) spectra of an ARTIS model as a spectramatrixtuple.
+
+    timewindows is a list of (timestepmin, timestepmax) pairs. The spectrum is from spec.out (or the Stokes
+    parameter of specpol.out selected by args), or from specpol_res.out if angle is given.
+    """
+    if angle is not None:
+        if res_specdata is None:
+            res_specdata = read_specpol_res(modelpath, angle, args=args)
+        specdata = res_specdata[angle]
+    else:
+        specdata = get_specdata(modelpath, args, copy=False)
+
+    arr_tmid = at.get_timestep_times_float(modelpath, loc='mid')
+    arr_tdelta = at.get_timestep_times_float(modelpath, loc='delta')
+    weights = get_timewindow_weights(arr_tmid, arr_tdelta, timewindows, reftime=reftime)
+
+    arr_fnu_timesteps = specdata.values[:, 1:len(arr_tdelta) + 1]
+
+    return get_spectra_from_fnu_matrix(specdata['nu'].values, arr_fnu_timesteps, weights, fnufilterfunc)
+
+
+def spectramatrix_to_dataframe(spectra, windowindex=0):
+    """Return a DataFrame of one spectrum from a spectramatrixtuple, as given by get_spectrum().
+
+    The index is the row number in the spectrum file, as left by sorting the file rows by decreasing frequency.
+    """
+    return pd.DataFrame({
+        'nu': spectra.nu, 'f_nu': spectra.f_nu[windowindex],
+        'lambda_angstroms': spectra.lambda_angstroms, 'f_lambda': spectra.f_lambda[windowindex]},
+        index=spectra.rowindex)
+
+
+def get_spectrum(
+        modelpath, timestepmin: int, timestepmax=-1, fnufilterfunc=None,
+        reftime=None, modelnumber=None, args=None):
+    """Return a pandas DataFrame containing an ARTIS emergent spectrum."""
+    if timestepmax < 0:
+        timestepmax = timestepmin
+
+    spectra = get_spectra(modelpath, [(timestepmin, timestepmax)], fnufilterfunc=fnufilterfunc, reftime=reftime,
+                          args=args)
+
+    dfspectrum = spectramatrix_to_dataframe(spectra)
 
     # if 'redshifttoz' in args and args.redshifttoz[modelnumber] != 0:
     # #     plt.plot(dfspectrum['lambda_angstroms'], dfspectrum['f_lambda'], color='k')
@@ -249,53 +311,40 @@ def get_spectrum_from_packets(
     return pd.DataFrame(dfdict)
 
 
-def read_specpol_res(modelpath, angle=None, args=None):
-    """Return specpol_res data for a given angle"""
+def get_specpol_res_fnu(modelpath, args=None):
+    """Return the frequencies, the column labels, and the (angle × frequency × timestep) Stokes I f_nu array."""
     if Path(modelpath, 'specpol_res.out').is_file():
         specfilename = Path(modelpath) / "specpol_res.out"
     else:
         specfilename = modelpath
 
-    specdata = pd.read_csv(specfilename, delim_whitespace=True, header=None, dtype=str)
+    specpol_res = artistools.speccube.get_specpol_res(specfilename)
+    columns = [col.decode('utf-8') for col in specpol_res['columns'].tolist()]
+    columns[0] = 'nu'
 
-    index_to_split = specdata.index[specdata.iloc[:, 1] == specdata.iloc[0, 1]]
-    # print(len(index_to_split))
-    res_specdata = []
-    for i, index_value in enumerate(index_to_split):
-        if index_value != index_to_split[-1]:
-            chunk = specdata.iloc[index_to_split[i]:index_to_split[i + 1], :]
-        else:
-            chunk = specdata.iloc[index_to_split[i]:, :]
-        res_specdata.append(chunk)
-    # print(res_specdata[0])
-
-    columns = res_specdata[0].iloc[0]
-    # print(columns)
-    for i, res_spec in enumerate(res_specdata):
-        res_specdata[i] = res_specdata[i].rename(columns=columns).drop(res_specdata[i].index[0])
-        # These lines remove the Q and U values from the dataframe (I think)
-        numberofIvalues = len(res_specdata[i].columns.drop_duplicates())
-        res_specdata[i] = res_specdata[i].iloc[:, : numberofIvalues]
-        res_specdata[i] = res_specdata[i].astype(float)
-        res_specdata[i] = res_specdata[i].to_numpy()
+    # only the Stokes I values (angle × frequency × timestep)
+    arr_fnu = np.array(specpol_res['stokes'][:, :, :, 0])
 
     # Averages over 10 bins to reduce noise
-
-    if args.average_every_tenth_viewing_angle:
-        for start_bin in np.arange(start=0, stop=100, step=10):
-            # print(start_bin)
-            for bin_number in range(start_bin+1, start_bin+10):
-                # print(bin_number)
-                res_specdata[start_bin] += res_specdata[bin_number]
-            res_specdata[start_bin] /= 10  # every 10th bin is the average of 10 bins
+    if args is not None and args.average_every_tenth_viewing_angle:
+        # every 10th bin is the average of 10 bins
+        nangles, nnu, ntimesteps = arr_fnu.shape
+        arr_fnu[::10] = arr_fnu.reshape(nangles // 10, 10, nnu, ntimesteps).mean(axis=1)
+        for start_bin in range(0, nangles, 10):
             print(f'bin number {start_bin} = the average of bins {start_bin} to {start_bin + 9}')
 
-        if angle and angle % 10 == 0:
-            print(f"Bin number {angle} is the average of 10 angle bins")
+    return specpol_res['nu'], columns, arr_fnu
 
-    for i, res_spec in enumerate(res_specdata):
-        res_specdata[i] = pd.DataFrame(data=res_specdata[i], columns=columns[:numberofIvalues])
-        res_specdata[i] = res_specdata[i].rename(columns={'0': 'nu'})
+
+def read_specpol_res(modelpath, angle=None, args=None):
+    """Return specpol_res data for a given angle"""
+    arr_nu, columns, arr_fnu = get_specpol_res_fnu(modelpath, args=args)
+
+    if args is not None and args.average_every_tenth_viewing_angle and angle and angle % 10 == 0:
+        print(f"Bin number {angle} is the average of 10 angle bins")
+
+    res_specdata = [pd.DataFrame(data=np.column_stack([arr_nu, arr_fnu_angle]), columns=columns)
+                    for arr_fnu_angle in arr_fnu]
 
     return res_specdata
 
@@ -317,42 +366,19 @@ def get_res_spectrum(
         print("Reading specpol_res.out")
         res_specdata = read_specpol_res(modelpath, angle)
 
-    nu = res_specdata[angle].loc[:, 'nu'].values
-    arr_tmid = at.get_timestep_times_float(modelpath, loc='mid')
-    arr_tdelta = at.get_timestep_times_float(modelpath, loc='delta')
-
-    def timefluxscale(timestep):
-        if reftime is not None:
-            return math.exp(float(arr_tmid[timestep]) / 133.) / math.exp(reftime / 133.)
-        else:
-            return 1.
-    # for angle in args.plotviewingangle:
-    f_nu = stackspectra([(res_specdata[angle][res_specdata[angle].columns[timestep + 1]] * timefluxscale(timestep),
-                          arr_tdelta[timestep])
-                         for timestep in range(timestepmin, timestepmax + 1)])
-
-    # best to use the filter on this list because it
-    # has regular sampling
-    if fnufilterfunc:
-        print("Applying filter to ARTIS spectrum")
-        f_nu = fnufilterfunc(f_nu)
-
-    dfspectrum = pd.DataFrame({'nu': nu, 'f_nu': f_nu})
-    dfspectrum.sort_values(by='nu', ascending=False, inplace=True)
+    spectra = get_spectra(modelpath, [(timestepmin, timestepmax)], fnufilterfunc=fnufilterfunc, reftime=reftime,
+                          angle=angle, res_specdata=res_specdata)
 
-    dfspectrum.eval('lambda_angstroms = @c / nu', local_dict={'c': const.c.to('angstrom/s').value}, inplace=True)
-    dfspectrum.eval('f_lambda = f_nu * nu / lambda_angstroms', inplace=True)
-    return dfspectrum
+    return spectramatrix_to_dataframe(spectra)
 
 
 def make_virtual_spectra_summed_file(modelpath):
     mpiranklist = at.get_mpiranklist(modelpath)
-    vspecpol_data_old = []  # virtual packet spectra for each observer (all directions and opacity choices)
     vpktconfig = at.get_vpkt_config(modelpath)
     nindicies_used = vpktconfig['nobsdirections'] * vpktconfig['nspectraperobs']
     print(f"nobsdirections {vpktconfig['nobsdirections']} nspectraperobs {vpktconfig['nspectraperobs']} (total observers: {nindicies_used})")
+    vspecpolpaths = []
     for mpirank in mpiranklist:
-        print(f"Reading rank {mpirank}")
         vspecpolfilename = f'vspecpol_{mpirank}-0.out'
         vspecpolpath = Path(modelpath, vspecpolfilename)
         if not vspecpolpath.is_file():
@@ -360,30 +386,13 @@ def make_virtual_spectra_summed_file(modelpath):
             if not vspecpolpath.is_file():
                 print(f'Warning: Could not find {vspecpolpath.relative_to(modelpath.parent)}')
                 continue
+        vspecpolpaths.append(vspecpolpath)
 
-        vspecpolfile = pd.read_csv(vspecpolpath, delim_whitespace=True, header=None)
-        # find duplicated header lines
-        index_to_split = vspecpolfile.index[vspecpolfile.iloc[:, 1] == vspecpolfile.iloc[0, 1]]
-        vspecpol_data = []
-        for i, index_value in enumerate(index_to_split[:nindicies_used]):
-            if index_value != index_to_split[-1]:
-                chunk = vspecpolfile.iloc[index_value:index_to_split[i+1], :]
-            else:
-                chunk = vspecpolfile.iloc[index_value:, :]
-            vspecpol_data.append(chunk)
-
-        if len(vspecpol_data_old) > 0:
-            for i in range(len(vspecpol_data)):
-                dftmp = vspecpol_data[i].copy()
-                dftmp.iloc[1:, 1:] += vspecpol_data_old[i].iloc[1:, 1:]
-                vspecpol_data[i] = dftmp
-
-        vspecpol_data_old = vspecpol_data
+    # virtual packet spectra for each observer (all directions and opacity choices) summed over ranks
+    vspecpol_sum = artistools.speccube.sum_specblock_files(vspecpolpaths, nblocks=nindicies_used)
 
-    for spec_index, vspecpol in enumerate(vspecpol_data):
-        outfile = modelpath / f'vspecpol_total-{spec_index}.out'
-        print(f'Saved {outfile}')
-        vspecpol.to_csv(outfile, sep=' ', index=False, header=False)
+    for spec_index, vspecpol in enumerate(vspecpol_sum):
+        artistools.speccube.write_specblock(vspecpol, modelpath / f'vspecpol_total-{spec_index}.out')
 
 
 def make_averaged_vspecfiles(args):
@@ -404,61 +413,62 @@ def make_averaged_vspecfiles(args):
 
     filenames = sorted_by_number(filenames)
 
-    for spec_index, filename in enumerate(filenames):  # vspecpol-total files
-        vspecdata = []
-        for modelpath in args.modelpath:
-            vspecdata.append(pd.read_csv(modelpath / filename, delim_whitespace=True, header=None))
-        for i in range(1, len(vspecdata)):
-            vspecdata[0].iloc[1:, 1:] += vspecdata[i].iloc[1:, 1:]
-
-        vspecdata[0].iloc[1:, 1:] = vspecdata[0].iloc[1:, 1:]/len(vspecdata)
-        vspecdata[0].to_csv(args.modelpath[0] / f'vspecpol_averaged-{spec_index}.out',
-                            sep=' ', index=False, header=False)
+    # sum each vspecpol-total file over the models, with the files for different observers in parallel
+    filepathlists = [[Path(modelpath, filename) for modelpath in args.modelpath] for filename in filenames]
+    if at.num_processes > 1:
+        with multiprocessing.Pool(processes=at.num_processes) as pool:
+            vspecsums = pool.map(artistools.speccube.sum_specblock_files_worker, filepathlists)
+            pool.close()
+            pool.join()
+            pool.terminate()
+    else:
+        vspecsums = [artistools.speccube.sum_specblock_files_worker(filepaths) for filepaths in filepathlists]
 
+    for spec_index, vspecsum in enumerate(vspecsums):
+        vspecdata = vspecsum[0]
+        vspecdata[1:, 1:] /= len(args.modelpath)
+        artistools.speccube.write_specblock(vspecdata, Path(args.modelpath[0], f'vspecpol_averaged-{spec_index}.out'))
 
-def get_polarisation(angle=None, modelpath=None, specdata=None):
-    if specdata is None:
-        if angle is None:
-            specfilename = Path(modelpath, 'specpol.out')
-        else:
-            # alternatively use f'vspecpol_averaged-{angle}.out' ?
-            specfilename = Path(modelpath, f'vspecpol_total-{angle}.out')
-            if not specfilename.exists():
-                print(f"{specfilename} does not exist. Generating all-rank summed vspec files..")
-                make_virtual_spectra_summed_file(modelpath=modelpath)
 
-        print(f"Reading {specfilename}")
-        specdata = pd.read_csv(specfilename, delim_whitespace=True)
-        specdata = specdata.rename(columns={specdata.keys()[0]: 'nu'})
+@at.memcache
+def get_polarisationdata(modelpath, angle=None):
+    """Return the PolarisationData of specpol.out, or of the all-rank summed vspecpol file of a virtual packet angle."""
+    if angle is None:
+        specfilename = Path(modelpath, 'specpol.out')
+    else:
+        # alternatively use f'vspecpol_averaged-{angle}.out' ?
+        specfilename = Path(modelpath, f'vspecpol_total-{angle}.out')
+        if not specfilename.exists():
+            print(f"{specfilename} does not exist. Generating all-rank summed vspec files..")
+            make_virtual_spectra_summed_file(modelpath=modelpath)
 
-    cols_to_split = []
-    stokes_params = {}
-    for i, key in enumerate(specdata.keys()):
-        if specdata.keys()[1] in key:
-            cols_to_split.append(i)
+    print(f"Reading {specfilename}")
+    return artistools.speccube.PolarisationData(artistools.speccube.get_speccube(specfilename))
 
-    stokes_params['I'] = pd.concat([specdata['nu'], specdata.iloc[:, cols_to_split[0]: cols_to_split[1]]], axis=1)
-    stokes_params['Q'] = pd.concat([specdata['nu'], specdata.iloc[:, cols_to_split[1]: cols_to_split[2]]], axis=1)
-    stokes_params['U'] = pd.concat([specdata['nu'], specdata.iloc[:, cols_to_split[2]:]], axis=1)
 
-    for param in ['Q', 'U']:
-        stokes_params[param].columns = stokes_params['I'].keys()
-        stokes_params[param + '/I'] = pd.concat([specdata['nu'],
-                                                 stokes_params[param].iloc[:, 1:]
-                                                 / stokes_params['I'].iloc[:, 1:]], axis=1)
+def get_polarisation(angle=None, modelpath=None, specdata=None):
+    """Return a dict of DataFrames for the Stokes parameters I, Q, U, Q/I, and U/I."""
+    if specdata is None:
+        polarisationdata = get_polarisationdata(modelpath, angle)
+    else:
+        polarisationdata = artistools.speccube.PolarisationData(artistools.speccube.SpecCube({
+            'data': specdata.values,
+            'columns': np.array([str(col).encode('utf-8') for col in specdata.columns], dtype=np.bytes_)},
+            sourcefilepath=''))
 
-    return stokes_params
+    # copy so that changes to the returned DataFrames do not reach the cached data
+    return {param: polarisationdata.to_dataframe(param).copy() for param in ['I', 'Q', 'U', 'Q/I', 'U/I']}
 
 
 def get_vspecpol_spectrum(modelpath, timeavg, angle, args, fnufilterfunc=None):
-    stokes_params = get_polarisation(angle, modelpath=modelpath)
+    polarisationdata = get_polarisationdata(modelpath, angle)
     if 'stokesparam' not in args:
         args.stokesparam = 'I'
-    vspecdata = stokes_params[args.stokesparam]
+    arr_fnu_timesteps = polarisationdata.get_param(args.stokesparam)
 
-    nu = vspecdata.loc[:, 'nu'].values
+    nu = polarisationdata.nu
 
-    arr_tmid = [float(i) for i in vspecdata.columns.values[1:] if i[-2] != '.']
+    arr_tmid = [float(i) for i in polarisationdata.timecolumns if i[-2] != '.']
     arr_tdelta = [l1 - l2 for l1, l2 in zip(arr_tmid[1:], arr_tmid[:-1])] + [arr_tmid[-1] - arr_tmid[-2]]
     def match_closest_time(reftime):
         return str("{}".format(min([float(x) for x in arr_tmid], key=lambda x: abs(x - reftime))))
@@ -469,8 +479,8 @@ def get_vspecpol_spectrum(modelpath, timeavg, angle, args, fnufilterfunc=None):
     else:
         timelower = timeavg
         timeupper = timeavg
-    timestepmin = vspecdata.columns.get_loc(timelower)
-    timestepmax = vspecdata.columns.get_loc(timeupper)
+    timestepmin = polarisationdata.timecolumns.index(timelower)
+    timestepmax = polarisationdata.timecolumns.index(timeupper)
 
     def timefluxscale(timestep):
         if timeavg is not None:
@@ -478,10 +488,10 @@ def get_vspecpol_spectrum(modelpath, timeavg, angle, args, fnufilterfunc=None):
         else:
             return 1.
 
+    # the times from timelower to timeupper inclusive, as when the column numbers included the nu column
     f_nu = stackspectra([
-        (vspecdata[vspecdata.columns[timestep + 1]] * timefluxscale(timestep),
-         arr_tdelta[timestep])
-        for timestep in range(timestepmin-1, timestepmax)])
+        (arr_fnu_timesteps[:, timestep] * timefluxscale(timestep), arr_tdelta[timestep])
+        for timestep in range(timestepmin, timestepmax + 1)])
 
     # best to use the filter on this list because it
     # has regular sampling
@@ -500,11 +510,10 @@ def get_vspecpol_spectrum(modelpath, timeavg, angle, args, fnufilterfunc=None):
 
 def plot_polarisation(modelpath, args):
     angle = args.plotviewingangle[0]
-    stokes_params = get_polarisation(angle=angle, modelpath=modelpath)
-    stokes_params[args.stokesparam].eval(
-        'lambda_angstroms = @c / nu', local_dict={'c': const.c.to('angstrom/s').value}, inplace=True)
+    dfstokes = get_polarisationdata(modelpath, angle).to_dataframe(args.stokesparam)
+    dfstokes.eval('lambda_angstroms = @c / nu', local_dict={'c': const.c.to('angstrom/s').value}, inplace=True)
 
-    timearray = stokes_params[args.stokesparam].keys()[1:-1]
+    timearray = dfstokes.keys()[1:-1]
     (timestepmin, timestepmax, args.timemin, args.timemax) = at.get_time_range(
                     modelpath, args.timestep, args.timemin, args.timemax, args.timedays)
     timeavg = (args.timemin + args.timemax) / 2.
@@ -517,7 +526,7 @@ def plot_polarisation(modelpath, args):
     filterfunc = at.get_filterfunc(args)
     if filterfunc is not None:
         print("Applying filter to ARTIS spectrum")
-        stokes_params[args.stokesparam][timeavg] = filterfunc(stokes_params[args.stokesparam][timeavg])
+        dfstokes[timeavg] = filterfunc(dfstokes[timeavg])
 
     vpkt_config = at.get_vpkt_config(modelpath)
 
@@ -530,8 +539,8 @@ def plot_polarisation(modelpath, args):
         new_lambda_angstroms = []
         binned_flux = []
 
-        wavelengths = stokes_params[args.stokesparam]['lambda_angstroms']
-        fluxes = stokes_params[args.stokesparam][timeavg]
+        wavelengths = dfstokes['lambda_angstroms']
+        fluxes = dfstokes[timeavg]
         nbins = 5
 
         for i in np.arange(0, len(wavelengths-nbins), nbins):
@@ -543,7 +552,7 @@ def plot_polarisation(modelpath, args):
 
         fig = plt.plot(new_lambda_angstroms, binned_flux)
     else:
-        fig = stokes_params[args.stokesparam].plot(x='lambda_angstroms', y=timeavg, label=linelabel)
+        fig = dfstokes.plot(x='lambda_angstroms', y=timeavg, label=linelabel)
 
     if args.ymax is None:
         args.ymax = 0.5
@@ -563,7 +572,7 @@ def plot_polarisation(modelpath, args):
     print(f"Saved {figname}")
 
 
-@lru_cache(maxsize=4)
+@at.memcache
 def get_flux_contributions(
         modelpath, filterfunc=None, timestepmin=0, timestepmax=None, getemission=True, getabsorption=True,
         use_lastemissiontype=False):
@@ -578,37 +587,45 @@ def get_flux_contributions(
         elementlist = at.get_composition_data(modelpath)
     nelements = len(elementlist)
 
+    if timestepmax is None:
+        timestepmax = len(arr_tmid) - 1
+
+    # each timestep is weighted by its duration, as in stackspectra()
+    arr_timestepweight = arr_tdelta[timestepmin:timestepmax + 1] / sum(arr_tdelta[timestepmin:timestepmax + 1])
+
     if getemission:
         if use_lastemissiontype:
-            emissionfilenames = ['emission.out.xz', 'emission.out.gz', 'emission.out', 'emissionpol.out']
+            emissionfilenames = artistools.speccube.emissionfilenames
         else:
-            emissionfilenames = ['emissiontrue.out.xz', 'emissiontrue.out.gz', 'emissiontrue.out']
+            emissionfilenames = artistools.speccube.emissiontruefilenames
 
         emissionfilename = at.firstexisting(emissionfilenames, path=modelpath)
         try:
-            emissionfilesize = Path(emissionfilename).stat().st_siplze / 1024 / 1024
+            emissionfilesize = Path(emissionfilename).stat().st_size / 1024 / 1024
             print(f' Reading {emissionfilename} ({emissionfilesize:.2f} MiB)')
         except AttributeError:
             print(f' Reading {emissionfilename}')
-        emissiondata = pd.read_csv(emissionfilename, delim_whitespace=True, header=None)
-        maxion_float = (emissiondata.shape[1] - 1) / 2 / nelements  # also known as MIONS in ARTIS sn3d.h
+        # (frequency × timestep × process) rows of the selected timesteps only
+        emissiondata = artistools.speccube.get_timestep_cube(
+            emissionfilename, len(arraynu), len(arr_tmid), timestepmin, timestepmax)
+        maxion_float = (emissiondata.shape[2] - 1) / 2 / nelements  # also known as MIONS in ARTIS sn3d.h
         assert maxion_float.is_integer()
         maxion = int(maxion_float)
         print(f' inferred MAXION = {maxion} from emission file using nlements = {nelements} from compositiondata.txt')
 
-        # check that the row count is product of timesteps and frequency bins found in spec.out
-        assert emissiondata.shape[0] == len(arraynu) * len(arr_tmid)
+        # time-averaged f_nu of every emission process at once
+        emission_fnu = np.einsum('ijk,j->ik', emissiondata, arr_timestepweight)
 
     if getabsorption:
-        absorptionfilename = at.firstexisting(['absorption.out.xz', 'absorption.out.gz', 'absorption.out',
-                                               'absorptionpol.out'], path=modelpath)
+        absorptionfilename = at.firstexisting(artistools.speccube.absorptionfilenames, path=modelpath)
         try:
             absorptionfilesize = Path(absorptionfilename).stat().st_size / 1024 / 1024
             print(f' Reading {absorptionfilename} ({absorptionfilesize:.2f} MiB)')
         except AttributeError:
-            print(f' Reading {emissionfilename}')
-        absorptiondata = pd.read_csv(absorptionfilename, delim_whitespace=True, header=None)
-        absorption_maxion_float = absorptiondata.shape[1] / nelements
+            print(f' Reading {absorptionfilename}')
+        absorptiondata = artistools.speccube.get_timestep_cube(
+            absorptionfilename, len(arraynu), len(arr_tmid), timestepmin, timestepmax)
+        absorption_maxion_float = absorptiondata.shape[2] / nelements
         assert absorption_maxion_float.is_integer()
         absorption_maxion = int(absorption_maxion_float)
         if not getemission:
@@ -617,9 +634,9 @@ def get_flux_contributions(
                   'from compositiondata.txt')
         else:
             assert absorption_maxion == maxion
-        assert absorptiondata.shape[0] == len(arraynu) * len(arr_tmid)
+        absorption_fnu = np.einsum('ijk,j->ik', absorptiondata, arr_timestepweight)
     else:
-        absorptiondata = None
+        absorption_fnu = None
 
     array_flambda_emission_total = np.zeros_like(arraylambda, dtype=np.float)
     contribution_list = []
@@ -641,18 +658,12 @@ def get_flux_contributions(
                 # if linelabel.startswith('Fe ') or linelabel.endswith("-free"):
                 #     continue
                 if getemission:
-                    array_fnu_emission = stackspectra(
-                        [(emissiondata.iloc[timestep::len(arr_tmid), selectedcolumn].values,
-                          arr_tdelta[timestep])
-                         for timestep in range(timestepmin, timestepmax + 1)])
+                    array_fnu_emission = emission_fnu[:, selectedcolumn]
                 else:
                     array_fnu_emission = np.zeros_like(arraylambda, dtype=np.float)
 
-                if absorptiondata is not None and selectedcolumn < nelements * maxion:  # bound-bound process
-                    array_fnu_absorption = stackspectra(
-                        [(absorptiondata.iloc[timestep::len(arr_tmid), selectedcolumn].values,
-                          arr_tdelta[timestep])
-                         for timestep in range(timestepmin, timestepmax + 1)])
+                if absorption_fnu is not None and selectedcolumn < nelements * maxion:  # bound-bound process
+                    array_fnu_absorption = absorption_fnu[:, selectedcolumn]
                 else:
                     array_fnu_absorption = np.zeros_like(arraylambda, dtype=np.float)
 
@@ -685,7 +696,7 @@ def get_flux_contributions(
     return contribution_list, array_flambda_emission_total
 
 
-@lru_cache(maxsize=4)
+@at.memcache
 def get_flux_contributions_from_packets(
         modelpath, timelowerdays, timeupperdays, lambda_min, lambda_max, delta_lambda=None,
         getemission=True, getabsorption=True, maxpacketfiles=None, filterfunc=None, groupby='ion', modelgridindex=None,
@@ -694,7 +705,7 @@ def get_flux_contributions_from_packets(
     assert groupby in [None, 'ion', 'line', 'upperterm', 'terms']
 
     if groupby in ['terms', 'upperterm']:
-        adata = at.get_levels(modelpath)
+        adata = at.atomicdata.get_atomicdata(modelpath)
 
     def get_emprocesslabel(emtype):
         if emtype >= 0:
@@ -706,19 +717,13 @@ def get_flux_contributions_from_packets(
                         f'λ{line.lambda_angstroms:.0f} '
                         f'({line.upperlevelindex}-{line.lowerlevelindex})')
             elif groupby == 'terms':
-                upper_config = adata.query(
-                    'Z == @line.atomic_number and ion_stage == @line.ionstage', inplace=False
-                    ).iloc[0].levels.iloc[line.upperlevelindex].levelname
+                upper_config = adata.levels(line.atomic_number, line.ionstage).iloc[line.upperlevelindex].levelname
                 upper_term_noj = upper_config.split('_')[-1].split('[')[0]
-                lower_config = adata.query(
-                    'Z == @line.atomic_number and ion_stage == @line.ionstage', inplace=False
-                    ).iloc[0].levels.iloc[line.lowerlevelindex].levelname
+                lower_config = adata.levels(line.atomic_number, line.ionstage).iloc[line.lowerlevelindex].levelname
                 lower_term_noj = lower_config.split('_')[-1].split('[')[0]
                 return f'{at.get_ionstring(line.atomic_number, line.ionstage)} {upper_term_noj}->{lower_term_noj}'
             elif groupby == 'upperterm':
-                upper_config = adata.query(
-                    'Z == @line.atomic_number and ion_stage == @line.ionstage', inplace=False
-                    ).iloc[0].levels.iloc[line.upperlevelindex].levelname
+                upper_config = adata.levels(line.atomic_number, line.ionstage).iloc[line.upperlevelindex].levelname
                 upper_term_noj = upper_config.split('_')[-1].split('[')[0]
                 return f'{at.get_ionstring(line.atomic_number, line.ionstage)} {upper_term_noj}'
             return f'{at.get_ionstring(line.atomic_number, line.ionstage)} bound-bound'
@@ -762,7 +767,7 @@ def get_flux_contributions_from_packets(
     import artistools.packets
     packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles)
 
-    linelist = at.get_linelist(modelpath)
+    linelist = at.get_linelist(modelpath, returntype='array')
 
     energysum_spectrum_emission_total = np.zeros_like(array_lambda, dtype=np.float)
     array_energysum_spectra = {}
@@ -834,6 +839,14 @@ def get_flux_contributions_from_packets(
                 dfpackets['xindexabsorbed'] = np.digitize(
                     c_ang_s / dfpackets.absorption_freq, bins=array_lambdabinedges, right=True) - 1
 
+        # look up the process label once for each distinct emission/absorption type instead of for every packet
+        if getemission:
+            dfpackets['emprocesskey'] = dfpackets[emtypecolumn].map(
+                {emtype: get_emprocesslabel(emtype) for emtype in dfpackets[emtypecolumn].unique()})
+        if getabsorption:
+            dfpackets['absprocesskey'] = dfpackets['absorption_type'].map(
+                {abstype: get_absprocesslabel(abstype) for abstype in dfpackets['absorption_type'].unique()})
+
         for _, packet in dfpackets.iterrows():
             lambda_rf = c_ang_s / packet.nu_rf
             xindex = int(packet.xindex)
@@ -847,7 +860,7 @@ def get_flux_contributions_from_packets(
                 # if emtype >= 0 and linelist[emtype].upperlevelindex <= 80:
                 #     continue
                 # emprocesskey = get_emprocesslabel(packet.emissiontype)
-                emprocesskey = get_emprocesslabel(packet[emtypecolumn])
+                emprocesskey = packet.emprocesskey
                 # print('packet lambda_cmf: {c_ang_s / packet.nu_cmf}.1f}, lambda_rf {lambda_rf:.1f}, {emprocesskey}')
 
                 if emprocesskey not in array_energysum_spectra:
@@ -859,7 +872,7 @@ def get_flux_contributions_from_packets(
             if getabsorption:
                 abstype = packet.absorption_type
                 if abstype > 0:
-                    absprocesskey = get_absprocesslabel(abstype)
+                    absprocesskey = packet.absprocesskey
 
                     xindexabsorbed = int(packet.xindexabsorbed)  # bin by absorption wavelength
                     # xindexabsorbed = xindex  # bin by final escaped wavelength
@@ -1714,13 +1727,11 @@ def write_flambda_spectra(modelpath, args):
     outdirectory.mkdir(parents=True, exist_ok=True)
 
     if Path(modelpath, 'specpol.out').is_file():
-        specfilename = modelpath / 'specpol.out'
-        specdata = pd.read_csv(specfilename, delim_whitespace=True)
-        timearray = [i for i in specdata.columns.values[1:] if i[-2] != '.']
+        speccube = artistools.speccube.get_model_speccube(modelpath, ['specpol.out'])
+        timearray = [i for i in speccube.get_timecolumns() if i[-2] != '.']
     else:
-        specfilename = at.firstexisting(['spec.out.xz', 'spec.out.gz', 'spec.out'], path=modelpath)
-        specdata = pd.read_csv(specfilename, delim_whitespace=True)
-        timearray = specdata.columns.values[1:]
+        speccube = artistools.speccube.get_model_speccube(modelpath)
+        timearray = speccube.get_timecolumns()
 
     number_of_timesteps = len(timearray)
 
@@ -1734,9 +1745,12 @@ def write_flambda_spectra(modelpath, args):
 
         arr_tmid = at.get_timestep_times_float(modelpath, loc='mid')
 
-        for timestep in range(timestepmin, timestepmax + 1):
+        timesteps = list(range(timestepmin, timestepmax + 1))
+        spectra = get_spectra(modelpath, [(timestep, timestep) for timestep in timesteps])
+
+        for windowindex, timestep in enumerate(timesteps):
 
-            dfspectrum = get_spectrum(modelpath, timestep, timestep)
+            dfspectrum = spectramatrix_to_dataframe(spectra, windowindex)
             tmid = arr_tmid[timestep]
 
             outfilepath = outdirectory / f'spectrum_ts{timestep:02.0f}_{tmid:.0f}d.txt'
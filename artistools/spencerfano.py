@@ -18,6 +18,7 @@ from math import atan
 # from numpy import arctan as atan
 
 import artistools as at
+import artistools.atomicdata
 import artistools.estimators
 import artistools.nltepops
 import artistools.nonthermal
@@ -378,14 +379,11 @@ def get_nne(ions, ionpopdict):
 
 
 def get_index(en_ev, engrid):
-    assert en_ev >= engrid[0]
-    assert en_ev < (engrid[-1] + (engrid[1] - engrid[0]))
+    """Return the index of the last point of the (increasing) energy grid that is below en_ev."""
+    assert np.all(en_ev > engrid[0])
+    assert np.all(en_ev < (engrid[-1] + (engrid[1] - engrid[0])))
 
-    for i, en in enumerate(engrid):
-        if en < en_ev:
-            index = i
-
-    return index
+    return np.searchsorted(engrid, en_ev, side='left') - 1
 
 
 N_e_cache = {}
@@ -507,8 +505,11 @@ def sfmatrix_add_excitation(engrid, dftransitions_ion, nnion, sfmatrix):
 
 
 def sfmatrix_add_ionization_shell(engrid, nnion, shell, sfmatrix):
-    # this code has been optimised and is now an almost unreadable form, but it is the contains the terms
-    # related to ionisation cross sections
+    """Add the ionisation terms of a shell to the Spencer-Fano matrix.
+
+    Row i is for the energy en = engrid[i] and column j is for the primary energy endash = engrid[j] >= en. The
+    terms for all (i, j) pairs are calculated as one array.
+    """
     deltaen = engrid[1] - engrid[0]
     ionpot_ev = shell.ionpot_ev
     J = get_J(shell.Z, shell.ionstage, ionpot_ev)
@@ -521,75 +522,47 @@ def sfmatrix_add_ionization_shell(engrid, nnion, shell, sfmatrix):
     else:
         xsstartindex = get_index(en_ev=ionpot_ev, engrid=engrid)
 
-    for i, en in enumerate(engrid):
-        # P_sum = 0.
-        # if en >= ionpot_ev:
-        #     e_s_min = 0.
-        #     e_s_max = (en - ionpot_ev) / 2.
-        #     delta_e_s = (e_s_max - e_s_min) / 1000.
-        #     for e_s in np.arange(e_s_min, e_s_max, delta_e_s):
-        #         P_sum += Psecondary(e_p=en, e_s=e_s, ionpot_ev=ionpot_ev, J=J) * delta_e_s
-        #
-        #     epsilon_upper = e_s_max + ionpot_ev
-        #     epsilon_lower = e_s_min + ionpot_ev
-        #     P_int = 1. / atan((en - ionpot_ev) / 2. / J) * (atan((epsilon_upper - ionpot_ev) / J) - atan((epsilon_lower - ionpot_ev) / J))
-        #
-        #     print(f"E_p {en} eV, prob integral e_s from {e_s_min:5.2f} eV to {e_s_max:5.2f}: {P_sum:5.2f} analytical {P_int:5.2f}")
+    # endash ranges from en to SF_EMAX, but skip over the zero-cross section points
+    arr_en = engrid[:, np.newaxis]
+    arr_endash = engrid[np.newaxis, xsstartindex:]
+    prefactors = nnion * ar_xs_array[xsstartindex:] / np.arctan((arr_endash - ionpot_ev) / 2. / J) * deltaen
+    assert not np.isnan(prefactors).any()
+    assert not np.isinf(prefactors).any()
 
-        # // endash ranges from en to SF_EMAX, but skip over the zero-cross section points
-        jstart = i if i > xsstartindex else xsstartindex
-        if 2 * en + ionpot_ev < engrid[-1] + (engrid[1] - engrid[0]):
-            secondintegralstartindex = get_index(2 * en + ionpot_ev, engrid)
-        else:
-            secondintegralstartindex = npts + 1
-
-        # integral/J of 1/[1 + (epsilon - ionpot_ev) / J] for epsilon = en + ionpot_ev
-        for j in range(jstart, npts):
-            # j is the matrix column index which corresponds to the piece of the
-            # integral at y(E') where E' >= E and E' = envec(j)
-            endash = engrid[j]
-            prefactor = nnion * ar_xs_array[j] / atan((endash - ionpot_ev) / 2. / J) * deltaen
-            assert not np.isnan(prefactor)
-            assert not np.isinf(prefactor)
-            # assert prefactor >= 0
-
-            # J * atan[(epsilon - ionpot_ev) / J] is the indefinite integral of
-            # 1/(1 + (epsilon - ionpot_ev)^2/ J^2) d_epsilon
-            # in Kozma & Fransson 1992 equation 4
-
-            # KF 92 limit
-            epsilon_upper = (endash + ionpot_ev) / 2
-            # Li+2012 limit
-            # epsilon_upper = (endash + en) / 2
-
-            int_eps_upper = atan((epsilon_upper - ionpot_ev) / J)
-
-            epsilon_lower = endash - en
-            int_eps_lower = atan((epsilon_lower - ionpot_ev) / J)
-            # if epsilon_lower > epsilon_upper:
-            # #     # print(j, jstart, epsilon_lower, epsilon_upper, int_eps_lower, int_eps_upper)
-            #     epsilon_lower, epsilon_upper = epsilon_upper, epsilon_lower
-            #     int_eps_lower, int_eps_upper = int_eps_upper, int_eps_lower
-            # assert epsilon_lower < epsilon_upper
-            # if epsilon_upper > epsilon_lower:
-            sfmatrix[i, j] += prefactor * (int_eps_upper - int_eps_lower)
-
-            epsilon_lower = en + ionpot_ev
-            epsilon_upper = (endash + ionpot_ev) / 2
-            # endash ranges from 2 * en + ionpot_ev to SF_EMAX
-            if j >= secondintegralstartindex + 1:
-                # int_eps_upper = atan((epsilon_upper - ionpot_ev) / J)
-                int_eps_lower = atan((epsilon_lower - ionpot_ev) / J)
-                if epsilon_lower > epsilon_upper:
-                    print(j, secondintegralstartindex, epsilon_lower, epsilon_upper)
-                assert epsilon_lower <= epsilon_upper
-
-                sfmatrix[i, j] -= prefactor * (int_eps_upper - int_eps_lower)
+    # J * atan[(epsilon - ionpot_ev) / J] is the indefinite integral of
+    # 1/(1 + (epsilon - ionpot_ev)^2/ J^2) d_epsilon
+    # in Kozma & Fransson 1992 equation 4
+
+    # KF 92 limit
+    epsilon_upper = (arr_endash + ionpot_ev) / 2
+    # Li+2012 limit
+    # epsilon_upper = (arr_endash + arr_en) / 2
+    int_eps_upper = np.arctan((epsilon_upper - ionpot_ev) / J)
+
+    # integral from epsilon = endash - en
+    shellmatrix = prefactors * (int_eps_upper - np.arctan(((arr_endash - arr_en) - ionpot_ev) / J))
+
+    # minus the integral from epsilon = en + ionpot_ev, where endash ranges from 2 * en + ionpot_ev to SF_EMAX
+    secondintegralstartindex = np.full(npts, npts + 1)
+    hassecondintegral = 2 * engrid + ionpot_ev < engrid[-1] + deltaen
+    secondintegralstartindex[hassecondintegral] = get_index(2 * engrid[hassecondintegral] + ionpot_ev, engrid)
+    insecondintegral = (
+        np.arange(xsstartindex, npts)[np.newaxis, :] >= secondintegralstartindex[:, np.newaxis] + 1)
+
+    epsilon_lower = arr_en + ionpot_ev
+    assert np.all((epsilon_lower <= epsilon_upper) | ~insecondintegral)
+    shellmatrix -= np.where(
+        insecondintegral, prefactors * (int_eps_upper - np.arctan((epsilon_lower - ionpot_ev) / J)), 0.)
+
+    # only the columns with endash >= en
+    sfmatrix[:, xsstartindex:] += np.triu(shellmatrix, k=-xsstartindex)
 
 
 def differentialsfmatrix_add_ionization_shell(engrid, nnion, shell, sfmatrix):
-    # this code has been optimised and is now an almost unreadable form, but it is the contains the terms
-    # related to ionisation cross sections
+    """Add the ionisation terms of a shell to the matrix of the differential form of the Spencer-Fano equation.
+
+    The terms for all rows (energies) are calculated as arrays.
+    """
     delta_en = engrid[1] - engrid[0]
     ionpot_ev = shell.ionpot_ev
     J = get_J(shell.Z, shell.ionstage, ionpot_ev)
@@ -602,71 +575,46 @@ def differentialsfmatrix_add_ionization_shell(engrid, nnion, shell, sfmatrix):
     else:
         xsstartindex = get_index(en_ev=ionpot_ev, engrid=engrid)
 
-    oneoveratangrid = 1. / np.arctan((engrid - ionpot_ev) / 2. / J)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oneoveratangrid = 1. / np.arctan((engrid - ionpot_ev) / 2. / J)
 
+    rows = np.arange(xsstartindex, npts)
+    arr_en = engrid[xsstartindex:]
+
+    # integral of xs_ion(e_p=en, epsilon) with epsilon from I to (I + E) / 2
+    # J * atan[(epsilon - ionpot_ev) / J] is the indefinite integral of
+    # 1/(1 + (epsilon - ionpot_ev)^2/ J^2) d_epsilon
     epsilon_lower_a = ionpot_ev
     int_eps_lower_a = atan((epsilon_lower_a - ionpot_ev) / J)
-    for i in range(xsstartindex, npts):
-        en = engrid[i]
-
-        # integral of xs_ion(e_p=en, epsilon) with epsilon from I to (I + E) / 2
-
-        epsilon_upper = (ionpot_ev + en) / 2.
-
-        if (epsilon_lower_a < epsilon_upper):
-            # P_int = 0.
-            # eps_npts = 1000
-            # delta_eps = (epsilon_upper - epsilon_lower) / eps_npts
-            # for j in range(eps_npts):
-            #     epsilon = epsilon_lower + j * delta_eps
-            #     P_int += Psecondary(e_p=en, epsilon=epsilon, ionpot_ev=ionpot_ev, J=J) * delta_eps
-            #
-            # J * atan[(epsilon - ionpot_ev) / J] is the indefinite integral of
-            # 1/(1 + (epsilon - ionpot_ev)^2/ J^2) d_epsilon
-
-            int_eps_upper = atan((epsilon_upper - ionpot_ev) / J)
-            P_int = 1. / atan((en - ionpot_ev) / 2. / J) * (int_eps_upper - int_eps_lower_a)
-            # if int_eps_lower == int_eps_upper and epsilon_upper != epsilon_lower:
-            # if (abs(P_int2 / P_int - 1.) > 0.2):
-            #     print("warning eps low high int low high", epsilon_lower, epsilon_upper, int_eps_lower, int_eps_upper)
-            #     print(f'{P_int=:.2e} {P_int2=:.2e} Ratio: {P_int2 / P_int:.2f}')
-
-            sfmatrix[i, i] += nnion * ar_xs_array[i] * P_int
-
-        enlambda = min(engrid[-1] - en, en + ionpot_ev)
-        epsilon_lower = ionpot_ev
-        epsilon_upper = enlambda
-        if (epsilon_lower < epsilon_upper):
-            eps_npts = 100
-            delta_eps = (epsilon_upper - epsilon_lower) / eps_npts
-            prefactor = nnion / J / atan((en - ionpot_ev) / 2. / J) * delta_eps
-            for j in range(eps_npts):
-                epsilon = epsilon_lower + j * delta_eps
-                i_enpluseps = get_index(en + epsilon, engrid=engrid)
-                sfmatrix[i, i_enpluseps] -= prefactor * ar_xs_array[i_enpluseps] / (
-                    1 + (((epsilon - ionpot_ev) / J) ** 2))
-
-            # j_lower = get_index(en + epsilon_lower, engrid=engrid)
-            # j_upper = get_index(en + epsilon_upper, engrid=engrid)
-            # if (j_lower < j_upper):
-            #     delta_eps = (epsilon_upper - epsilon_lower) / (j_upper - j_lower)
-            #     prefactor = nnion / J / atan((en - ionpot_ev) / 2. / J) * delta_eps
-            #     print(J, atan((en - ionpot_ev) / 2. / J))
-            #     assert not math.isnan(prefactor)
-            #     assert not math.isinf(prefactor)
-            #     # for j in range(j_lower, j_upper):
-            #     #     en_plus_epsilon = engrid[j]
-            #     #     epsilon = en_plus_epsilon - en
-            #     #     sfmatrix[i, j] -= prefactor * ar_xs_array[j] / (1 + (((epsilon - ionpot_ev) / J) ** 2))
-            #     sfmatrix[i, j_lower:j_upper] -= prefactor * ar_xs_array[j_lower:j_upper] / (1 + ((((engrid[j_lower:j_upper] - en) - ionpot_ev) / J) ** 2))
-
-        if (2 * en + ionpot_ev) < engrid[-1]:
-            epsilon = en + ionpot_ev
-            prefactor = nnion / J / (1 + (((epsilon - ionpot_ev) / J) ** 2)) * delta_en
-            i_endash_lower = get_index(2 * en + ionpot_ev, engrid)
-            # for j in range(i_endash_lower, npts):
-            #     sfmatrix[i, j] -= prefactor * ar_xs_array[j] * oneoveratangrid[j]
-            sfmatrix[i, i_endash_lower:] -= prefactor * ar_xs_array[i_endash_lower:] * oneoveratangrid[i_endash_lower:]
+    epsilon_upper = (ionpot_ev + arr_en) / 2.
+    diagrows = epsilon_lower_a < epsilon_upper
+    int_eps_upper = np.arctan((epsilon_upper[diagrows] - ionpot_ev) / J)
+    P_int = 1. / np.arctan((arr_en[diagrows] - ionpot_ev) / 2. / J) * (int_eps_upper - int_eps_lower_a)
+    sfmatrix[rows[diagrows], rows[diagrows]] += nnion * ar_xs_array[rows[diagrows]] * P_int
+
+    # epsilon from I to min(EMAX - en, en + I) in eps_npts steps
+    enlambda = np.minimum(engrid[-1] - arr_en, arr_en + ionpot_ev)
+    epsilon_lower = ionpot_ev
+    epsrows = epsilon_lower < enlambda
+    eps_npts = 100
+    delta_eps = (enlambda[epsrows] - epsilon_lower) / eps_npts
+    prefactors = nnion / J / np.arctan((arr_en[epsrows] - ionpot_ev) / 2. / J) * delta_eps
+    arr_epsilon = epsilon_lower + np.arange(eps_npts)[np.newaxis, :] * delta_eps[:, np.newaxis]
+    i_enpluseps = get_index(arr_en[epsrows, np.newaxis] + arr_epsilon, engrid=engrid)
+    # several epsilon points can be in the same energy bin
+    np.subtract.at(
+        sfmatrix, (np.broadcast_to(rows[epsrows, np.newaxis], i_enpluseps.shape), i_enpluseps),
+        prefactors[:, np.newaxis] * ar_xs_array[i_enpluseps] / (1 + (((arr_epsilon - ionpot_ev) / J) ** 2)))
+
+    # endash from 2 * en + ionpot_ev to EMAX
+    endashrows = (2 * arr_en + ionpot_ev) < engrid[-1]
+    epsilon = arr_en[endashrows] + ionpot_ev
+    prefactors = nnion / J / (1 + (((epsilon - ionpot_ev) / J) ** 2)) * delta_en
+    i_endash_lower = get_index(2 * arr_en[endashrows] + ionpot_ev, engrid)
+    inendashrange = np.arange(npts)[np.newaxis, :] >= i_endash_lower[:, np.newaxis]
+    with np.errstate(invalid='ignore'):
+        sfmatrix[rows[endashrows]] -= np.where(
+            inendashrange, prefactors[:, np.newaxis] * ar_xs_array * oneoveratangrid, 0.)
 
 
 def get_d_etaexcitation_by_d_en_vec(engrid, yvec, ions, dftransitions, deposition_density_ev):
@@ -918,7 +866,7 @@ def solve_spencerfano(
             popdict = {x.level: x['n_NLTE'] for _, x in dfpops_thision.iterrows()}
 
             print(' and excitation ', end='')
-            ion = adata.query('Z == @Z and ion_stage == @ionstage').iloc[0]
+            ion = adata.ion(Z, ionstage)
             groundlevelnoj = ion.levels.iloc[0].levelname.split('[')[0]
             topgmlevel = ion.levels[ion.levels.levelname.str.startswith(groundlevelnoj)].index.max()
             # topgmlevel = float('inf')
@@ -1671,7 +1619,7 @@ def main(args=None, argsraw=None, **kwargs):
         adata = None
         dfpops = None
     else:
-        adata = at.get_levels(modelpath, get_transitions=True, ionlist=tuple(ions))
+        adata = at.atomicdata.get_atomicdata(modelpath, get_transitions=True, ionlist=tuple(ions))
         dfpops = get_lte_pops(adata, ions, ionpopdict, temperature=6000)
     nnetot = get_nnetot(ions, ionpopdict)
     print(f'     nntot: {nntot:.2e} /cm3')
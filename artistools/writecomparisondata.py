@@ -9,29 +9,27 @@ import pandas as pd
 import artistools as at
 import artistools.estimators
 import artistools.lightcurve
+import artistools.speccube
 
 
 def write_spectra(modelpath, model_id, selected_timesteps, outfile):
-    spec_data = np.loadtxt(Path(modelpath, "spec.out"))
+    speccube = artistools.speccube.get_model_speccube(modelpath)
 
-    times = spec_data[0, 1:]
-    freqs = spec_data[1:, 0]
+    times = np.array(speccube.get_timecolumns(), dtype=np.float64)
+    freqs = speccube.get_nu()
     lambdas = 2.99792458e18 / freqs
 
     # print("\n".join(["{0}, {1}".format(*x) for x in enumerate(times)]))
 
-    fluxes_nu = spec_data[1:, 1:]
+    fluxes_nu = speccube.get_fluxes()
 
     # 1 parsec in cm is 3.086e18
     # area in cm^2 of a spherical of radius 1 Mpc is:
     area = 3.086e18 * 3.086e18 * 1e12 * 4. * 3.141592654
 
-    lum_lambda = np.zeros((len(lambdas), len(times)))
-
     # convert flux to power by multiplying by area
-    for n in range(1000):
-        # 2.99792458e18 is c in Angstrom / second
-        lum_lambda[n, :] = fluxes_nu[n, :] * 2.99792458e18 / lambdas[n] / lambdas[n] * area
+    # 2.99792458e18 is c in Angstrom / second
+    lum_lambda = fluxes_nu * (2.99792458e18 / lambdas / lambdas * area)[:, np.newaxis]
 
     with open(outfile, "w") as f:
         f.write("#NTIMES: {0}\n".format(len(selected_timesteps)))
@@ -4,12 +4,14 @@ import math
 import numpy as np
 import os.path
 import pandas as pd
+import pytest
 from astropy import constants as const
 from pathlib import Path
 
 import artistools as at
 import artistools.deposition
 import artistools.lightcurve
+import artistools.linefluxes
 import artistools.macroatom
 import artistools.makemodel.botyanski2017
 import artistools.nltepops
@@ -23,6 +25,14 @@ outputpath = Path(os.path.dirname(os.path.abspath(__file__)), 'output')
 at.enable_diskcache = False
 
 
+@pytest.fixture
+def diskcache_tmproot(tmp_path, monkeypatch):
+    """Enable the disk cache (including the binary caches) for a test, with the cache files in a temporary folder."""
+    monkeypatch.setattr(at, 'enable_diskcache', True)
+    monkeypatch.setattr(at, 'diskcache_root', tmp_path)
+    return tmp_path
+
+
 def test_timestep_times():
     timestartarray = at.get_timestep_times_float(modelpath, loc='start')
     timedeltarray = at.get_timestep_times_float(modelpath, loc='delta')
@@ -35,10 +45,245 @@ def test_timestep_times():
                 for tstart, tdelta, tmid in zip(timestartarray, timedeltarray, timemidarray)])
 
 
+def test_memcache():
+    cache = at.MemoryCache(budget_bytes=20000)
+    for i in range(4):
+        cache.put(('f', i), np.zeros(1000), modelpath=modelpath)
+    assert cache.info()['entries'] == 2
+    assert cache.info()['evictions'] == 2
+    assert cache.get(('f', 0)) == (False, None)
+    assert cache.get(('f', 3))[0]
+    cache.clear(modelpath=modelpath)
+    assert cache.info()['entries'] == 0 and cache.info()['currbytes'] == 0
+
+    at.get_levels(modelpath)
+    assert at.memorycache.get(('artistools.get_levels', (modelpath,), ()))[0]
+    at.memorycache.clear(modelpath=modelpath)
+    assert not at.memorycache.get(('artistools.get_levels', (modelpath,), ()))[0]
+
+
+def test_get_levels_binarycache(diskcache_tmproot, monkeypatch):
+    import artistools.atomicdata
+    ionlist = ((26, 2), (27, 3))
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(at, 'enable_diskcache', False)
+        dfadata_text = at.get_levels.__wrapped__(modelpath, ionlist=ionlist, get_photoionisations=True)
+
+    dfadata_binary = artistools.atomicdata.get_levels(modelpath, ionlist=ionlist, get_photoionisations=True)
+
+    assert len(dfadata_binary) == len(dfadata_text) == 2
+    for iontext, ionbinary in zip(dfadata_text.itertuples(), dfadata_binary.itertuples()):
+        assert (iontext.Z, iontext.ion_stage, iontext.level_count) == (ionbinary.Z, ionbinary.ion_stage,
+                                                                       ionbinary.level_count)
+        pd.testing.assert_frame_equal(iontext.levels.drop(columns='phixstable'),
+                                      ionbinary.levels.drop(columns='phixstable'))
+        for tabletext, tablebinary in zip(iontext.levels.phixstable, ionbinary.levels.phixstable):
+            assert np.array_equal(tabletext, tablebinary)
+
+
+def test_atomicdata_ionlookup():
+    import artistools.atomicdata
+    adata = artistools.atomicdata.get_atomicdata(modelpath)
+    dfadata = at.get_levels(modelpath)
+    assert len(adata) == len(dfadata)
+    assert (26, 2) in adata
+    ionlevels = dfadata.query('Z == 26 and ion_stage == 2').iloc[0].levels
+    pd.testing.assert_frame_equal(adata.levels(26, 2), ionlevels)
+    assert np.array_equal(adata.level_g(26, 2), ionlevels.g.values)
+    assert np.array_equal(adata.level_energies_ev(26, 2), ionlevels.energy_ev.values)
+
+    # a duplicated pair of levels gives the first transition
+    dftransitions = pd.DataFrame({'lower': [0, 0, 1], 'upper': [1, 1, 2], 'A': [1e3, 2e3, 3e3],
+                                  'collstr': [-1., -1., -1.], 'forbidden': [False, False, False]})
+    adata_trans = artistools.atomicdata.AtomicData(pd.DataFrame(
+        [(26, 2, 3, 16.2, ionlevels[:3], dftransitions)],
+        columns=['Z', 'ion_stage', 'level_count', 'ion_pot', 'levels', 'transitions']))
+    assert adata_trans.get_transition(26, 2, upper=1, lower=0).A == 1e3
+    assert adata_trans.get_transition(26, 2, upper=2, lower=1).A == 3e3
+    assert adata_trans.get_transition(26, 2, upper=2, lower=0) is None
+
+
+def test_parse_atomicdata():
+    import gzip
+    import io
+    with gzip.open(modelpath / 'adata.txt.gz', 'rt') as fadata:
+        adatalines = fadata.readlines()
+
+    # the first three levels of Fe I and the first two of Fe II, with the ion headers changed to match
+    adataslice = ''.join(['26 1 3 7.9021158\n', *adatalines[1:4], '\n', '26 2 2 16.1880399\n', *adatalines[1795:1797]])
+    phixstable = np.array([[1., 2e-18], [1.1, 1e-18]])
+    phixsdict = {(26, 1, 1): ([(0, 1.0)], phixstable)}
+
+    ions = list(at.parse_adata(io.StringIO(adataslice), phixsdict, ionlist=None))
+    assert [(Z, ionstage, level_count, ion_pot) for Z, ionstage, level_count, ion_pot, _ in ions] == [
+        (26, 1, 3, 7.9021158), (26, 2, 2, 16.1880399)]
+    dflevels = ions[0][4]
+    assert list(dflevels.energy_ev) == [0., 0.0515689951914824, 0.0872853709038602]
+    assert list(dflevels.g) == [9., 7., 5.]
+    assert list(dflevels.transition_count) == [448, 510, 482]
+    assert list(dflevels.levelname) == ['3d6_4s2_a5De[4]', '3d6_4s2_a5De[3]', '3d6_4s2_a5De[2]']
+    assert list(dflevels.phixstargetlist) == [[], [(0, 1.0)], []]
+    assert dflevels.phixstable[1] is phixstable
+    assert list(ions[1][4].levelname) == ['3d6(5D)4s_a6De[9/2]', '3d6(5D)4s_a6De[7/2]']
+
+    # an ion that is not in ionlist is skipped
+    ions = list(at.parse_adata(io.StringIO(adataslice), phixsdict, ionlist=((26, 2),)))
+    assert len(ions) == 1
+    assert list(ions[0][4].energy_ev) == [0., 0.0477075073635713]
+
+    transitiondata = (
+        '26 1 2\n'
+        '1 2 1.5e-02 -1.0 1\n'
+        '1 3 2.0e+03 0.5 0\n'
+        '\n'
+        '26 2 3\n'
+        '1 2 3.0e-01 -2.0 1\n'
+        '2 3 4.0e+05 -1.0 0 0.12 extra\n'
+        '1 3 5.0e+00 1.5 0\n')
+
+    transitions = list(at.parse_transitiondata(io.StringIO(transitiondata), ionlist=None))
+    assert [(Z, ionstage) for Z, ionstage, _ in transitions] == [(26, 1), (26, 2)]
+    dftransitions = transitions[0][2]
+    assert list(dftransitions.lower) == [0, 0]
+    assert list(dftransitions.upper) == [1, 2]
+    assert list(dftransitions.A) == [1.5e-2, 2e3]
+    assert list(dftransitions.collstr) == [-1., 0.5]
+    assert list(dftransitions.forbidden) == [True, False]
+
+    # the row with extra columns
+    dftransitions = transitions[1][2]
+    assert list(dftransitions.lower) == [0, 1, 0]
+    assert list(dftransitions.upper) == [1, 2, 2]
+    assert list(dftransitions.A) == [0.3, 4e5, 5.]
+    assert list(dftransitions.collstr) == [-2., -1., 1.5]
+    assert list(dftransitions.forbidden) == [True, False, False]
+
+    transitions = list(at.parse_transitiondata(io.StringIO(transitiondata), ionlist=((26, 2),)))
+    assert [(Z, ionstage, len(dftransitions)) for Z, ionstage, dftransitions in transitions] == [(26, 2, 3)]
+
+
+def test_linelist_array(diskcache_tmproot, monkeypatch):
+    linestatpath = Path(outputpath, 'linestat')
+    linestatpath.mkdir(parents=True, exist_ok=True)
+    with open(linestatpath / 'linestat.out', 'w') as flinestat:
+        flinestat.write('7.155e-05 4.0e-05 1.257e-04 7.378e-05\n26 26 26 28\n2 2 3 2\n15 8 20 7\n7 1 9 1\n')
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(at, 'enable_diskcache', False)
+        linelistdict = at.get_linelist(linestatpath)
+        linelist = at.get_linelist(linestatpath, returntype='array')
+    assert len(linelist) == len(linelistdict) == 4
+    for index, line in linelistdict.items():
+        assert linelist[index] == line
+    assert linelist[1].lowerlevelindex == 0 and math.isclose(linelist[1].lambda_angstroms, 4000.)
+    assert list(linelist.get_lambdarange_indices(7000, 8000)) == [0, 3]
+    assert list(linelist.get_lambdarange_indices(7000, 8000, atomic_number=26, ion_stage=2)) == [0]
+    assert list(linelist.get_lambdarange_indices(0, 1e5, atomic_number=27, ion_stage=2)) == []
+    assert list(linelist.get_closest_indices([3000, 7200, 7300, 20000])) == [1, 0, 3, 2]
+    assert list(linelist.get_closest_indices([3000, 7300], atomic_number=26, ion_stage=2)) == [1, 0]
+
+    linelistbinary = at.get_linelist.__wrapped__(linestatpath, returntype='array')
+    pd.testing.assert_frame_equal(linelistbinary.to_dataframe(), linelist.to_dataframe())
+    pd.testing.assert_frame_equal(linelist.to_dataframe(), at.get_linelist(linestatpath, returntype='dataframe'),
+                                  check_dtype=False, check_index_type=False)
+
+
+def test_speccube(diskcache_tmproot, monkeypatch):
+    import artistools.speccube
+    specdata = pd.read_csv(modelpath / 'spec.out', delim_whitespace=True)
+    emissiondata = pd.read_csv(modelpath / 'emissiontrue.out.gz', delim_whitespace=True, header=None)
+    ntimesteps = len(specdata.columns) - 1
+
+    # without a binary cache, only the rows of some timesteps are read from the text file and nothing is converted
+    partialcube = artistools.speccube.get_timestep_cube(
+        modelpath / 'emissiontrue.out.gz', len(specdata), ntimesteps, 5, 9)
+    assert not artistools.speccube.get_speccube_cachefolder(modelpath / 'emissiontrue.out.gz').exists()
+
+    # with the disk cache disabled, each text file is parsed once
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(at, 'enable_diskcache', False)
+        speccube_text = artistools.speccube.get_model_speccube(modelpath)
+        assert artistools.speccube.get_model_speccube(modelpath).data is speccube_text.data
+
+    speccube = artistools.speccube.get_model_speccube(modelpath)
+    emissioncube = artistools.speccube.get_model_speccube(modelpath, artistools.speccube.emissiontruefilenames)
+    assert isinstance(speccube.data, np.memmap)
+
+    # the public spectrum data is a writable copy of the read-only cache
+    dfspecdata = at.spectra.get_specdata(modelpath, None)
+    assert not np.shares_memory(dfspecdata.values, speccube.data)
+    dfspecdata.iloc[0, 1] = -1.
+    assert speccube.data[0, 1] != -1.
+
+    pd.testing.assert_frame_equal(speccube.to_dataframe(), specdata, check_dtype=False)
+    assert np.array_equal(speccube.get_nu(), specdata['0'].values)
+    assert list(at.get_timestep_times(modelpath)) == list(specdata.columns[1:])
+
+    assert len(speccube.get_timecolumns()) == ntimesteps
+    cube = emissioncube.get_cube(ntimesteps)
+    assert cube.shape == (len(specdata), ntimesteps, emissiondata.shape[1])
+    assert np.array_equal(cube[:, 7, 3], emissiondata.iloc[7::ntimesteps, 3].values)
+    assert np.array_equal(partialcube, cube[:, 5:10, :])
+
+    # once the file is in the binary cache, the timesteps are a view of the memory-mapped cube
+    partialcube_binary = artistools.speccube.get_timestep_cube(
+        modelpath / 'emissiontrue.out.gz', len(specdata), ntimesteps, 5, 9)
+    assert np.shares_memory(partialcube_binary, emissioncube.data)
+    assert np.array_equal(partialcube_binary, partialcube)
+
+
 def test_deposition():
     at.deposition.main(modelpath=modelpath)
 
 
+def test_diskcache_concurrent_processes(tmp_path, monkeypatch):
+    import multiprocessing
+    import time
+    runcountfile = tmp_path / 'runcount.txt'
+
+    def slowfunc(modelpath, x):
+        with runcountfile.open('a') as frun:
+            frun.write('run\n')
+        time.sleep(1.5)  # slow enough to be saved to the cache
+        return x * 2
+
+    monkeypatch.setattr(at, 'enable_diskcache', True)
+    cachedfunc = at.diskcache(quiet=True)(slowfunc)
+    cachefolder = tmp_path / '__artistoolscache__.nosync'
+
+    # a fast function result is not saved, so nothing is written
+    fastfunc = at.diskcache(quiet=True)(lambda modelpath, x: x * 2)
+    assert fastfunc(modelpath=tmp_path, x=21) == 42
+    assert not cachefolder.exists()
+
+    # two processes miss the cache at the same time and both run the function, but only one saves the result
+    mpcontext = multiprocessing.get_context('fork')
+    resultqueue = mpcontext.Queue()
+    processes = [mpcontext.Process(target=lambda: resultqueue.put(cachedfunc(modelpath=tmp_path, x=21)))
+                 for _ in range(2)]
+    for process in processes:
+        process.start()
+    results = [resultqueue.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join()
+
+    assert results == [42, 42]
+    assert runcountfile.read_text().count('run') == 2
+
+    # the saved file was renamed into place, so no partial files (or lock files) are left in the cache folder
+    cachefiles = [cachefile.name for cachefile in cachefolder.iterdir()]
+    assert len(cachefiles) == 1 and cachefiles[0].endswith('.tmp')
+
+    # later calls load the saved result
+    assert cachedfunc(modelpath=tmp_path, x=21) == 42
+    assert runcountfile.read_text().count('run') == 2
+
+    # the cache is checked on each call, so it can be disabled after the decorator is applied
+    monkeypatch.setattr(at, 'enable_diskcache', False)
+    assert cachedfunc(modelpath=tmp_path, x=21) == 42
+    assert runcountfile.read_text().count('run') == 3
+
+
 def test_estimator_snapshot():
     at.estimators.main(modelpath=modelpath, outputfile=outputpath, timedays=300)
 
@@ -60,6 +305,89 @@ def test_lightcurve_magnitudes_plot():
     at.lightcurve.main(modelpath=modelpath, magnitude=True, outputfile=outputpath)
 
 
+def test_lightcurve_filter_response():
+    import argparse
+    filterdir = os.path.join(at.PYDIR, 'data/filters/')
+    args = argparse.Namespace(plotvspecpol=None, plotviewingangle=None, filter=['B', 'H'])
+    filters_dict = at.lightcurve.get_magnitudes(modelpath, args)
+
+    timestep = 60
+    dfspectrum = at.spectra.get_spectrum(modelpath, timestep)
+    for filter_name in ['B', 'H']:
+        zeropointenergyflux, wavefilter, transmission, wavefilter_min, wavefilter_max = at.lightcurve.get_filter_data(
+            filterdir, filter_name)
+        wavelength_from_spectrum, flux = at.lightcurve.get_spectrum_in_filter_range(
+            modelpath, timestep, None, wavefilter_min, wavefilter_max, args, spectrum=dfspectrum)
+
+        # resample the spectrum or the filter, whichever has fewer points
+        if len(wavelength_from_spectrum) > len(wavefilter):
+            transmission = np.interp(np.linspace(min(wavelength_from_spectrum), int(max(wavelength_from_spectrum)),
+                                                 len(wavelength_from_spectrum)), wavefilter, transmission)
+        else:
+            flux = np.interp(np.linspace(wavefilter_min, wavefilter_max, len(wavefilter)),
+                             wavelength_from_spectrum, flux, left=0., right=0.)
+            wavelength_from_spectrum = np.linspace(wavefilter_min, wavefilter_max, len(wavefilter))
+
+        # integrate the filtered spectrum with the trapezoidal rule
+        magnitude = -2.5 * math.log10(
+            abs(np.trapz(flux * transmission, wavelength_from_spectrum)) / zeropointenergyflux) - 25
+        assert math.isclose(filters_dict[filter_name][timestep][1], magnitude, rel_tol=1e-10)
+
+
+def test_lightcurve_viewingangle_magnitudes():
+    import argparse
+    specpolrespath = Path(outputpath, 'specpol_res_viewingangles')
+    specpolrespath.mkdir(parents=True, exist_ok=True)
+    # 10 angle bins with Stokes I fluxes of (1 + angle / 10) times that of angle bin 0
+    arr_nu = 2.99792458e18 / np.linspace(3000, 9000, 60)
+    with open(specpolrespath / 'specpol_res.out', 'w') as fspecpolres:
+        for angle in range(10):
+            fspecpolres.write('0 250.5 260.5 250.5 260.5 250.5 260.5\n')
+            for nu in arr_nu:
+                fnu = (1 + angle / 10) * 1e-10 * nu / arr_nu[0]
+                fspecpolres.write(f'{nu!r} {fnu!r} {2 * fnu!r} 0 0 0 0\n')
+
+    args = argparse.Namespace(filter=['B', 'bol'], average_every_tenth_viewing_angle=False)
+    filters_dicts = at.lightcurve.get_viewingangle_filters_dicts(specpolrespath, args)
+    assert len(filters_dicts) == 10
+    assert [time for time, _ in filters_dicts[4]['B']] == [250.5, 260.5]
+    for filter_name in ['B', 'bol']:
+        for angle in range(10):
+            for timestep in range(2):
+                assert math.isclose(
+                    filters_dicts[angle][filter_name][timestep][1] - filters_dicts[0][filter_name][timestep][1],
+                    -2.5 * math.log10(1 + angle / 10), abs_tol=1e-10)
+
+    # the fits of all light curves at once match the fit of each light curve
+    arr_time = np.linspace(5, 60, 56)
+    magnitudes = np.array([-18 + 0.002 * (arr_time - 15 - angle) ** 2 for angle in range(5)])
+    tmax, peakmag, deltam15 = at.lightcurve.fit_peak_time_mag_deltam15(arr_time, magnitudes, 0, 70)
+    for angle in range(5):
+        assert math.isclose(tmax[angle], 15 + angle, abs_tol=0.05)
+        tmax_single, peakmag_single, deltam15_single = at.lightcurve.fit_peak_time_mag_deltam15(
+            arr_time, magnitudes[angle], 0, 70)
+        assert tmax_single[0] == tmax[angle]
+        assert math.isclose(peakmag_single[0], peakmag[angle], abs_tol=1e-8)
+        assert math.isclose(deltam15_single[0], deltam15[angle], abs_tol=1e-8)
+
+
+def test_linefluxes_pop_volume_sums():
+    dfnltepops = pd.DataFrame({
+        'timestep': [5, 5, 5, 5, 6],
+        'modelgridindex': [0, 2, 0, 1, 3],
+        'level': [1, 1, 2, 2, 1],
+        'n_NLTE': [10., 20., 30., 40., 50.]})
+    shell_volumes = np.array([1., 2., 4., 8.])
+
+    dfsums = at.linefluxes.get_pop_volume_sums(dfnltepops, [1, 2, 3], range(4), shell_volumes)
+
+    # the volume of empty cell 1 goes to cell 2 and the volume of cells after the last cell with data is dropped
+    assert list(dfsums.index) == [5, 6]
+    assert np.allclose(dfsums.loc[5, [1, 2]], [10. * 1. + 20. * (2. + 4.), 30. * 1. + 40. * 2.])
+    assert np.isclose(dfsums.loc[6, 1], 50. * (1. + 2. + 4. + 8.))
+    assert np.isnan(dfsums.loc[5, 3]) and np.isnan(dfsums.loc[6, 2])
+
+
 def test_macroatom():
     at.macroatom.main(modelpath=modelpath, outputfile=outputpath, timestep=10)
 
@@ -79,6 +407,46 @@ def test_nltepops():
     at.nltepops.main(modelpath=modelpath, outputfile=outputpath, timestep=40)
 
 
+def test_nltepops_store(diskcache_tmproot):
+    dfpopfull = pd.read_csv(modelpath / 'nlte_0000.out.gz', delim_whitespace=True)
+
+    nltestore = at.nltepops.get_nltestore.__wrapped__(modelpath / 'nlte_0000.out')
+    assert isinstance(nltestore['column_n_NLTE'], np.memmap)
+    dfpop = at.nltepops.query_nltestore(
+        nltestore, timesteps=[40, 41], atomic_numbers=[26], ion_stages=[2, 3], levels=range(10),
+        columns=['timestep', 'ion_stage', 'level', 'n_NLTE'])
+
+    pd.testing.assert_frame_equal(
+        dfpop, dfpopfull.query('timestep in [40, 41] and Z == 26 and ion_stage in [2, 3] and 0 <= level < 10')[
+            ['timestep', 'ion_stage', 'level', 'n_NLTE']])
+    pd.testing.assert_frame_equal(
+        at.nltepops.read_files(modelpath, timestep=40, modelgridindex=0, atomic_number=27),
+        dfpopfull.query('timestep == 40 and modelgridindex == 0 and Z == 27'))
+
+    # several timesteps and cells in one read
+    pd.testing.assert_frame_equal(
+        at.nltepops.read_files(modelpath, timestep=(20, 40, 41), modelgridindex=(0,), ion_stage=2),
+        dfpopfull.query('timestep in [20, 40, 41] and modelgridindex == 0 and ion_stage == 2'))
+
+
+def test_nltepops_add_lte_pops():
+    k_b = const.k_B.to('eV / K').value
+    dfpop = at.nltepops.read_files(modelpath, timestep=40)
+    superlevelmask = (dfpop['level'] == -1).values
+    dfpop = at.nltepops.add_lte_pops(modelpath, dfpop.copy(), [('n_LTE_T_e', 6000.)], noprint=True)
+
+    adata = at.atomicdata.get_atomicdata(modelpath)
+    for row in dfpop[superlevelmask].itertuples():
+        # the superlevel level number is two more than the first level it contains
+        ionlevels = adata.levels(row.Z, row.ion_stage)
+        ionlevels_sl = ionlevels.iloc[row.level - 2:]
+        assert math.isclose(row.n_LTE_T_e, (ionlevels_sl.g / ionlevels.g.iloc[0] * np.exp(
+            -(ionlevels_sl.energy_ev - ionlevels.energy_ev.iloc[0]) / k_b / 6000.)).sum(), rel_tol=1e-6)
+
+    dfgroundlevels = dfpop[dfpop['level'] == 0]
+    assert len(dfgroundlevels) > 0 and np.all(dfgroundlevels['n_LTE_T_e'] == 1.)
+
+
 def test_nonthermal():
     at.nonthermal.main(modelpath=modelpath, outputfile=outputpath, timestep=70)
 
@@ -87,6 +455,80 @@ def test_radfield():
     at.radfield.main(modelpath=modelpath, modelgridindex=0, outputfile=outputpath)
 
 
+def test_radfield_nonthermal_read_files():
+    for readfiles, filename in [(at.radfield.read_files, 'radfield_0000.out.gz'),
+                                (at.nonthermal.read_files, 'nonthermalspec_0000.out.gz')]:
+        dffull = pd.read_csv(modelpath / filename, delim_whitespace=True)
+
+        pd.testing.assert_frame_equal(readfiles(modelpath), dffull)
+        pd.testing.assert_frame_equal(
+            readfiles(modelpath, timestep=40, modelgridindex=0),
+            dffull.query('timestep == 40 and modelgridindex == 0').reset_index(drop=True))
+        pd.testing.assert_frame_equal(
+            readfiles(modelpath, timestep=(20, 40), modelgridindex=(0,)),
+            dffull.query('timestep in [20, 40]').reset_index(drop=True))
+
+
+def test_radfield_fitted_field_cube():
+    radfielddata = at.radfield.read_files(modelpath)
+    arr_nu_hz = np.array([3e14, 8e14, 1.2e15])
+
+    modelgridindices, timesteps, arr_j_nu = at.radfield.get_fitted_field_cube(radfielddata, arr_nu_hz)
+    _, _, arr_j_nu_fullspec = at.radfield.get_fitted_field_cube(radfielddata, arr_nu_hz, fullspec=True)
+    assert arr_j_nu.shape == arr_j_nu_fullspec.shape == (len(modelgridindices), len(timesteps), len(arr_nu_hz))
+
+    for timestepindex in [0, len(timesteps) // 2, len(timesteps) - 1]:
+        dfcelltimestep = radfielddata.query(
+            'timestep == @timesteps[@timestepindex] and modelgridindex == @modelgridindices[0]')
+        fullspecfit = dfcelltimestep.query('bin_num == -1').iloc[0]
+        for nuindex, nu in enumerate(arr_nu_hz):
+            binfit = dfcelltimestep.query('bin_num >= 0 and nu_lower <= @nu and nu_upper >= @nu').iloc[0]
+            assert np.isclose(arr_j_nu[0, timestepindex, nuindex],
+                              at.radfield.j_nu_dbb(nu, binfit.W, binfit.T_R), rtol=1e-10)
+            assert np.isclose(arr_j_nu_fullspec[0, timestepindex, nuindex],
+                              at.radfield.j_nu_dbb(nu, fullspecfit.W, fullspecfit.T_R), rtol=1e-10)
+
+    # frequencies inside the bins don't need the full spectrum fit, but the others raise a ValueError naming the cells
+    radfielddata_nofullspec = radfielddata.query('bin_num != -1 or modelgridindex != @modelgridindices[0]')
+    at.radfield.get_fitted_field_cube(radfielddata_nofullspec, arr_nu_hz)
+    with pytest.raises(ValueError, match=f'{timesteps[0]}, {modelgridindices[0]}'):
+        at.radfield.get_fitted_field_cube(radfielddata_nofullspec, arr_nu_hz, fullspec=True)
+
+
+def test_radfield_phixs_matrix():
+    arr_nu_hz = const.c.to('angstrom/s').value / np.linspace(50, 20000, num=500)
+    phixsmatrix = at.radfield.get_phixs_matrix(modelpath, ((26, 2), (26, 3)), 20)
+    arr_sigma_bf = at.radfield.evaluate_phixs_matrix(phixsmatrix, arr_nu_hz)
+    assert arr_sigma_bf.shape == (len(phixsmatrix.nu_threshold), len(arr_nu_hz))
+    assert set(phixsmatrix.lower_ion_stage) == {2, 3}
+    for row in [0, len(phixsmatrix.nu_threshold) - 1]:
+        arr_sigma_bf_level = at.radfield.evaluate_phixs(
+            modelpath, 26, phixsmatrix.lower_ion_stage[row], phixsmatrix.lowerlevel[row],
+            phixsmatrix.nu_threshold[row], arr_nu_hz) * phixsmatrix.phixsfrac[row]
+        assert np.allclose(arr_sigma_bf[row], arr_sigma_bf_level, rtol=1e-12, atol=0.)
+    assert arr_sigma_bf[0].max() > 0.
+
+
+def test_radfield_photoionratetable():
+    at.radfield.main(modelpath=modelpath, modelgridindex=0, photoionratetable=True, ions=['Fe II', 'Ni_II'],
+                     outputfile=outputpath)
+    dfrates = pd.read_csv(outputpath / 'photoionrates.txt', delim_whitespace=True)
+    assert len(dfrates) == 2 * len(dfrates.timestep.unique())
+    assert set(dfrates.Z) == {26, 28}
+    assert (dfrates.gamma_R >= 0.).all() and dfrates.gamma_R.max() > 0.
+
+
+def test_radfield_photoionratetable_multiprocess(monkeypatch):
+    ionlist = ((26, 2), (28, 2))
+    monkeypatch.setattr(at, 'num_processes', 1)
+    dfrates_serial = at.radfield.get_photoionrates_table(modelpath, ionlist, modelgridindices=[0])
+
+    # the cross section matrix is sent to the worker processes, so it must be picklable
+    monkeypatch.setattr(at, 'num_processes', 2)
+    dfrates_parallel = at.radfield.get_photoionrates_table(modelpath, ionlist, modelgridindices=[0])
+    pd.testing.assert_frame_equal(dfrates_parallel, dfrates_serial)
+
+
 def test_get_ionrecombratecalibration():
     at.get_ionrecombratecalibration(modelpath=modelpath)
 
@@ -104,6 +546,123 @@ def test_spectra_outputtext():
     at.spectra.main(modelpath=modelpath, output_spectra=True)
 
 
+def test_spectra_get_spectra():
+    timewindows = [(10, 10), (55, 65), (99, 99)]
+    spectra = at.spectra.get_spectra(modelpath, timewindows, reftime=300.)
+    assert spectra.f_lambda.shape == (3, 1000)
+    assert np.all(np.diff(spectra.lambda_angstroms) > 0)
+
+    # the spectrum DataFrame index is the spec.out row of each frequency (spec.out has increasing frequency)
+    dfspectrum = at.spectra.get_spectrum(modelpath, 55, 65, reftime=300.)
+    assert list(dfspectrum.index) == list(range(999, -1, -1))
+    assert np.allclose(dfspectrum['f_lambda'].values, spectra.f_lambda[1], rtol=1e-12, atol=0.)
+
+    # duration-weighted mean of the spec.out columns, each scaled by exp((t_mid - reftime) / 133 d)
+    specdata = pd.read_csv(modelpath / 'spec.out', delim_whitespace=True)
+    arr_nu = specdata['0'].values
+    arr_lambda_angstroms = const.c.to('angstrom/s').value / arr_nu
+    arr_tmid = at.get_timestep_times_float(modelpath, loc='mid')
+    arr_tdelta = at.get_timestep_times_float(modelpath, loc='delta')
+    for windowindex, (timestepmin, timestepmax) in enumerate(timewindows):
+        timesteps = range(timestepmin, timestepmax + 1)
+        arr_fnu = sum(specdata.iloc[:, timestep + 1].values * arr_tdelta[timestep] *
+                      math.exp((arr_tmid[timestep] - 300.) / 133.) for timestep in timesteps)
+        arr_fnu /= sum(arr_tdelta[timestep] for timestep in timesteps)
+        arr_flambda = (arr_fnu * arr_nu / arr_lambda_angstroms)[::-1]
+
+        assert np.allclose(spectra.lambda_angstroms, arr_lambda_angstroms[::-1], rtol=1e-12, atol=0.)
+        assert np.allclose(spectra.f_lambda[windowindex], arr_flambda, rtol=1e-10, atol=0.)
+
+
+def test_spectra_read_specpol_res():
+    import argparse
+    specpolrespath = Path(outputpath, 'specpol_res')
+    specpolrespath.mkdir(parents=True, exist_ok=True)
+    # 20 angle bins of 3 frequencies and 2 timesteps, with the I, Q, and U values given by the angle number
+    with open(specpolrespath / 'specpol_res.out', 'w') as fspecpolres:
+        for angle in range(20):
+            fspecpolres.write('0 250.5 260.5 250.5 260.5 250.5 260.5\n')
+            for nu in [3e15, 2e15, 1e15]:
+                fspecpolres.write(f'{nu:g} {angle} {angle} 0.1 0.1 0.2 0.2\n')
+
+    res_specdata = at.spectra.read_specpol_res(
+        specpolrespath, args=argparse.Namespace(average_every_tenth_viewing_angle=False))
+    assert len(res_specdata) == 20
+    assert list(res_specdata[0].columns) == ['nu', '250.5', '260.5']
+    assert np.array_equal(res_specdata[7]['nu'].values, [3e15, 2e15, 1e15])
+    assert np.all(res_specdata[7]['260.5'].values == 7.)
+
+    res_specdata_avg = at.spectra.read_specpol_res(
+        specpolrespath, args=argparse.Namespace(average_every_tenth_viewing_angle=True))
+    assert np.allclose(res_specdata_avg[10]['250.5'].values, 14.5)
+    assert np.all(res_specdata_avg[11]['250.5'].values == 11.)
+
+
+def test_spectra_polarisationdata():
+    specpolpath = Path(outputpath, 'specpol')
+    specpolpath.mkdir(parents=True, exist_ok=True)
+    # 3 frequencies and 2 times, with Q = 2 I and U = -I
+    with open(specpolpath / 'specpol.out', 'w') as fspecpol:
+        fspecpol.write('0 250.25 260.75 250.25 260.75 250.25 260.75\n')
+        for nu, fnu in [(3e15, 1.), (2e15, 2.), (1e15, 4.)]:
+            fspecpol.write(f'{nu:g} {fnu} {fnu} {2 * fnu} {2 * fnu} {-fnu} {-fnu}\n')
+
+    polarisationdata = at.spectra.get_polarisationdata(specpolpath)
+    assert polarisationdata is at.spectra.get_polarisationdata(specpolpath)
+    assert polarisationdata.stokes.shape == (3, 3, 2)
+    assert polarisationdata.timecolumns == ['250.25', '260.75']
+    assert np.shares_memory(polarisationdata.get_param('Q'), polarisationdata.stokes)
+    assert np.array_equal(polarisationdata.get_param('I')[:, 1], [1., 2., 4.])
+    assert np.all(polarisationdata.get_param('Q/I') == 2.) and np.all(polarisationdata.get_param('U/I') == -1.)
+    assert polarisationdata.get_param('Q/I') is polarisationdata.get_param('Q/I')
+
+    stokes_params = at.spectra.get_polarisation(modelpath=specpolpath)
+    assert list(stokes_params['U'].columns) == ['nu', '250.25', '260.75']
+    assert np.array_equal(stokes_params['U']['260.75'].values, [-1., -2., -4.])
+    stokes_params['Q/I']['260.75'] = 0.
+    assert np.all(polarisationdata.get_param('Q/I') == 2.)
+
+
+def test_spectra_get_vspecpol_spectrum():
+    import argparse
+    vspecpolpath = Path(outputpath, 'vspecpol_spectrum')
+    vspecpolpath.mkdir(parents=True, exist_ok=True)
+    # Stokes I of 2 frequencies and 3 times
+    with open(vspecpolpath / 'vspecpol_total-0.out', 'w') as fvspecpol:
+        fvspecpol.write('0 250.25 260.75 270.25 250.25 260.75 270.25 250.25 260.75 270.25\n')
+        for nu, fnu in [(3e15, 1.), (2e15, 2.)]:
+            fvspecpol.write(f'{nu:g} {fnu} {10 * fnu} {100 * fnu} 0 0 0 0 0 0\n')
+
+    # the times closest to timemin and timemax are both included
+    dfspectrum = at.spectra.get_vspecpol_spectrum(
+        vspecpolpath, 260.75, 0, argparse.Namespace(timemin=250.3, timemax=260.7))
+    arr_tdelta = [10.5, 9.5]
+    arr_scale = [math.exp((250.25 - 260.75) / 133.), 1.]
+    expected_fnu = (1. * arr_tdelta[0] * arr_scale[0] + 10. * arr_tdelta[1] * arr_scale[1]) / sum(arr_tdelta)
+    assert np.allclose(dfspectrum['nu'].values, [3e15, 2e15])
+    assert np.allclose(dfspectrum['f_nu'].values, [expected_fnu, 2 * expected_fnu], rtol=1e-12, atol=0.)
+
+
+def test_spectra_sum_specblock_files():
+    import artistools.speccube
+    vspecpolpath = Path(outputpath, 'vspecpol')
+    vspecpolpath.mkdir(parents=True, exist_ok=True)
+    vspecpolfiles = []
+    for mpirank in range(5):
+        vspecpolfiles.append(vspecpolpath / f'vspecpol_{mpirank}-0.out')
+        with open(vspecpolfiles[-1], 'w') as fvspecpol:
+            for _ in range(3):
+                fvspecpol.write('0 250.5 260.5 250.5 260.5 250.5 260.5\n')
+                for nu in [3e15, 2e15]:
+                    fvspecpol.write(f'{nu:g} {mpirank} 1 0 0 0 0\n')
+
+    vspecpol_sum = artistools.speccube.sum_specblock_files(vspecpolfiles, nblocks=2)
+    assert vspecpol_sum.shape == (2, 3, 7)
+    assert np.array_equal(vspecpol_sum[1, 0], [0, 250.5, 260.5, 250.5, 260.5, 250.5, 260.5])
+    assert np.array_equal(vspecpol_sum[1, 1:, 0], [3e15, 2e15])
+    assert np.all(vspecpol_sum[:, 1:, 1] == 10.) and np.all(vspecpol_sum[:, 1:, 2] == 5.)
+
+
 def test_spectraemissionplot():
     at.spectra.main(modelpath=modelpath, outputfile=outputpath, timemin=290, timemax=320,
                     emissionabsorption=True)
@@ -171,5 +730,59 @@ def test_spencerfano():
     at.spencerfano.main(modelpath=modelpath, timedays=300, makeplot=True, npts=200, outputfile=outputpath)
 
 
+def test_spencerfano_ionisation_matrix():
+    # the ionisation terms of an Fe II shell on small grids, compared to the loop over matrix elements
+    shell = pd.Series({'Z': 26, 'ionstage': 2, 'ionpot_ev': 16.2, 'A': 90., 'B': -60., 'C': 0.2, 'D': -86.})
+    nnion = 1e5
+    for npts, emax in [(30, 300.), (80, 1000.)]:
+        engrid = np.linspace(1., emax, npts)
+        deltaen = engrid[1] - engrid[0]
+        J = at.spencerfano.get_J(shell.Z, shell.ionstage, shell.ionpot_ev)
+        xs = at.nonthermal.get_arxs_array_shell(engrid, shell)
+        xsstartindex = at.spencerfano.get_index(shell.ionpot_ev, engrid)
+
+        sfmatrix_expected = np.zeros((npts, npts))
+        for i, en in enumerate(engrid):
+            for j in range(max(i, xsstartindex), npts):
+                endash = engrid[j]
+                prefactor = nnion * xs[j] / math.atan((endash - shell.ionpot_ev) / 2. / J) * deltaen
+                int_eps_upper = math.atan(((endash + shell.ionpot_ev) / 2 - shell.ionpot_ev) / J)
+                sfmatrix_expected[i, j] += prefactor * (
+                    int_eps_upper - math.atan((endash - en - shell.ionpot_ev) / J))
+                if 2 * en + shell.ionpot_ev < engrid[-1] + deltaen and (
+                        j >= at.spencerfano.get_index(2 * en + shell.ionpot_ev, engrid) + 1):
+                    sfmatrix_expected[i, j] -= prefactor * (
+                        int_eps_upper - math.atan((en + shell.ionpot_ev - shell.ionpot_ev) / J))
+
+        sfmatrix = np.zeros((npts, npts))
+        at.spencerfano.sfmatrix_add_ionization_shell(engrid, nnion, shell, sfmatrix)
+        assert np.allclose(sfmatrix, sfmatrix_expected, rtol=1e-8, atol=1e-12 * np.abs(sfmatrix_expected).max())
+
+        differentialsfmatrix_expected = np.zeros((npts, npts))
+        for i in range(xsstartindex, npts):
+            en = engrid[i]
+            if en > shell.ionpot_ev:
+                differentialsfmatrix_expected[i, i] += nnion * xs[i] / math.atan(
+                    (en - shell.ionpot_ev) / 2. / J) * math.atan(((shell.ionpot_ev + en) / 2. - shell.ionpot_ev) / J)
+            enlambda = min(engrid[-1] - en, en + shell.ionpot_ev)
+            if shell.ionpot_ev < enlambda:
+                delta_eps = (enlambda - shell.ionpot_ev) / 100
+                for epsilon in shell.ionpot_ev + np.arange(100) * delta_eps:
+                    j = at.spencerfano.get_index(en + epsilon, engrid)
+                    differentialsfmatrix_expected[i, j] -= (
+                        nnion / J / math.atan((en - shell.ionpot_ev) / 2. / J) * delta_eps * xs[j] /
+                        (1 + ((epsilon - shell.ionpot_ev) / J) ** 2))
+            if 2 * en + shell.ionpot_ev < engrid[-1]:
+                for j in range(at.spencerfano.get_index(2 * en + shell.ionpot_ev, engrid), npts):
+                    differentialsfmatrix_expected[i, j] -= (
+                        nnion / J / (1 + (en / J) ** 2) * deltaen * xs[j] /
+                        math.atan((engrid[j] - shell.ionpot_ev) / 2. / J))
+
+        differentialsfmatrix = np.zeros((npts, npts))
+        at.spencerfano.differentialsfmatrix_add_ionization_shell(engrid, nnion, shell, differentialsfmatrix)
+        assert np.allclose(differentialsfmatrix, differentialsfmatrix_expected, rtol=1e-8,
+                           atol=1e-12 * np.abs(differentialsfmatrix_expected).max())
+
+
 def test_transitions():
     at.transitions.main(modelpath=modelpath, outputfile=outputpath, timedays=300)